@@ -8,11 +8,13 @@ Define web app.
 '''
 
 import logging, time, os
-from framework import init, add_routes, start, add_template
+from framework import init, add_routes, start, add_template, add_middleware, identity_map_factory, \
+	add_db_stats_route, add_shutdown_hook, add_startup_hook, dump_db_stats, configure_json, \
+	configure_cache, configure_compression, add_static, static_url
 from datetime import datetime
 
-from transwarp import db
-from jinja2 import Environment, FileSystemLoader
+from transwarp import db, orm, log
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 logging.basicConfig(level=logging.INFO)
 
@@ -28,11 +30,28 @@ def init_jinja2(**kw):
 	if path is None:
 		path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 	logging.info('set jinja2 template path: %s' % path)
+	bytecode_cache = kw.get('bytecode_cache', None)
+	if bytecode_cache:
+		# compiled templates on disk, shared by the workers and kept across restarts,
+		# True uses jinja2's directory in the system temp dir:
+		if bytecode_cache is True:
+			bytecode_cache = None
+		else:
+			os.makedirs(bytecode_cache, exist_ok=True)
+		options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
 	env = Environment(loader=FileSystemLoader(path), **options)
 	filters = kw.get('filters', None)
 	if filters is not None:
 		for name, f in filters.items():
 			env.filters[name] = f
+	env.globals['static_url'] = static_url
+	if kw.get('precompile', False):
+		# before the workers fork, so they start with every template loaded:
+		start = time.time()
+		names = env.list_templates(extensions=kw.get('extensions', ('html',)))
+		for name in names:
+			env.get_template(name)
+		logging.info('compiled %d templates in %.3fs.' % (len(names), time.time() - start))
 	add_template(env)
 
 def datetime_filter(t):
@@ -50,14 +69,29 @@ def datetime_filter(t):
 
 def init_database():
 	db.create_engine(**db_config)
+	if orm_config.get('get_batching'):
+		orm.enable_get_batching(orm_config.get('get_batch_window', 0.0))
 
 from config import get_configs
 configs = get_configs()
+log.configure(**configs.get('logging', {}))
+configure_json(**configs.get('json', {}))
+configure_cache(**configs.get('cache', {}))
+configure_compression(**configs.get('compression', {}))
 server_config = configs['server']
 db_config = configs['db']
+orm_config = configs.get('orm', {})
+debug_config = configs.get('debug', {})
 session_config = configs['session']
 init(server_config['host'], server_config['port'])
-init_database()
-init_jinja2(filters=dict(datetime=datetime_filter))
+# every worker opens its own database pool:
+add_startup_hook(init_database)
+add_static(os.path.dirname(os.path.abspath(__file__)), **configs.get('static', {}))
+init_jinja2(filters=dict(datetime=datetime_filter), **configs.get('templates', {}))
 add_routes('handlers')
-start()
+add_middleware(identity_map_factory)
+if debug_config.get('db_stats_route'):
+	add_db_stats_route()
+if debug_config.get('db_stats_dump'):
+	add_shutdown_hook(lambda: dump_db_stats(debug_config.get('db_stats_file')))
+start(server_config.get('workers'), server_config.get('reuse_port', False), server_config.get('shutdown_timeout', 10.0))
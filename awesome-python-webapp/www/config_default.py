@@ -9,13 +9,72 @@ configs = {
 	'port': 3306,
 	'user': 'web-data',
 	'password': 'web-data',
-	'database': 'awesome'
+	'database': 'awesome',
+	'engine': 'mysql',
+	'pool_min_size': 1,
+	'pool_max_size': 10,
+	'pool_timeout': 10.0,
+	'pool_max_lifetime': 3600.0,
+	'pool_max_idle': 600.0,
+	'pool_ping': 30.0,
+	# experimental: server side prepared statements per pooled connection, so far
+	# only tested against transwarp.fakedb, not a MySQL server:
+	'prepared_statements': False
+	},
+	'orm': {
+	'get_batching': True,
+	'get_batch_window': 0.0
+	},
+	'logging': {
+	'level': 'INFO',
+	'levels': {
+		'transwarp.sql': 'WARNING',
+		'transwarp.db': 'WARNING',
+		'framework.access': 'INFO'
+	},
+	'sample': {
+		'framework.request': 100
+	}
+	},
+	'templates': {
+	'auto_reload': False,
+	'precompile': True,
+	# True for jinja2's directory in the system temp dir, or a directory:
+	'bytecode_cache': True
+	},
+	'cache': {
+	'max_bytes': 64 * 1024 * 1024
+	},
+	'compression': {
+	'threshold': 1024,
+	'gzip_level': 6,
+	'brotli_quality': 4,
+	'encodings': ('br', 'gzip'),
+	'executor_threshold': 128 * 1024
+	},
+	'static': {
+	'max_age': 3600,
+	'small_max': 256 * 1024,
+	'cache_max_bytes': 32 * 1024 * 1024
+	},
+	'json': {
+	'encoder': 'auto',
+	'stream_threshold': 1000
+	},
+	'debug': {
+	'db_stats_route': False,
+	'db_stats_dump': False,
+	'db_stats_file': None
 	},
 	'session': {
 	'secret': 'AwEsOmE'
 	},
 	'server': {
 	'host': '127.0.0.1',
-	'port': 9000
+	'port': 9000,
+	'workers': 1,
+	'reuse_port': False,
+	# seconds the requests in flight get to finish when a process stops:
+	'shutdown_timeout': 10.0
 	}
 }
@@ -11,11 +11,24 @@ and starting or stoping the service easily.
 '''
 
 from aiohttp import web
-import asyncio, functools, inspect, os, json, logging
+from urllib import parse
+import asyncio, collections, datetime, decimal, email.utils, functools, hashlib, inspect, itertools, mimetypes, os, json, logging, multiprocessing, re, select, signal, socket, stat, threading, time, zlib
+from transwarp import db, log
+from transwarp.orm import identity_map
 
-def get(path):
+_log = log.get_logger('framework')
+# request details, logged for 1 of every N requests, see log.configure(sample=...):
+_request_log = log.get_logger('framework.request')
+_request_sampler = log.sampler('framework.request')
+# one structured line per request:
+_access_log = log.get_logger('framework.access')
+# render times of templates, at DEBUG:
+_template_log = log.get_logger('framework.template')
+
+def get(path, cache=None):
 	'''
-	Define the decorator @get('/path')
+	Define the decorator @get('/path'), @get('/path', cache=dict(ttl=60)) caches the
+	responses, see _CachePolicy for the keys of cache.
 	'''
 	def decorator(func):
 		@functools.wraps(func)
@@ -23,6 +36,7 @@ def get(path):
 			return func(*args, **kw)
 		wrapper.__method__ = 'GET'
 		wrapper.__route__ = path
+		wrapper.__cache__ = cache
 		return wrapper
 	return decorator
 
@@ -81,15 +95,26 @@ def has_request_arg(fn):
 				(fn.__name__, str(inspect.signature(fn))))
 	return found
 
+class APIError(Exception):
+	'''
+	Error raised by a handler, answered with dict(error, data, message) as JSON.
+	'''
+	def __init__(self, error, data='', message=''):
+		super(APIError, self).__init__(message)
+		self.error = error
+		self.data = data
+		self.message = message
+
 class RequestHandler(object):
 
-	def __init__(self, fn):
+	def __init__(self, fn, cache=None):
 		self._fn = fn
 		self._has_request_arg = has_request_arg(fn)
 		self._has_var_kw_arg = has_var_kw_arg(fn)
 		self._has_named_kw_arg = has_named_kw_args(fn)
 		self._name_kw_args = get_named_kw_args(fn)
 		self._required_kw_args = get_required_kw_args(fn)
+		self._cache = _CachePolicy(**cache) if cache else None
 
 	@asyncio.coroutine
 	def __call__(self, request):
@@ -109,7 +134,7 @@ class RequestHandler(object):
 					kw = dict(**params)
 				else:
 					return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-			if request.method == 'GET':
+			if request.method in ('GET', 'HEAD'):
 				qs = request.query_string
 				if qs:
 					kw = dict()
@@ -128,7 +153,7 @@ class RequestHandler(object):
 			#check named arg:
 			for k, v in request.match_info.items():
 				if k in kw:
-					logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+					_request_log.warning('Duplicate arg name in named arg and kw args: %s', k)
 				kw[k] = v
 		if self._has_request_arg:
 			kw['request'] = request
@@ -137,26 +162,150 @@ class RequestHandler(object):
 			for name in self._required_kw_args:
 				if not name in kw:
 					return web.HTTPBadRequest('Missing argument:%s' % name)
-		logging.info('call with args:%s' % str(kw))
+		if request.get('__verbose__'):
+			_request_log.info('call with args:%s', kw)
 		try:
 			r = yield from self._fn(**kw)
 			return r
 		except APIError as e:
 			return dict(error=e.error, data=e.data, message=e.message)
 
+class _RouteTable(object):
+	'''
+	Immutable snapshot of the routes, middlewares and template engine. The application
+	routes every request to the current table, and registering at runtime builds a new
+	table and swaps it in with one assignment: requests in progress finish with the
+	table they started with, and the listening socket and keep-alive connections are
+	never touched.
+	'''
+	def __init__(self, routes, middlewares, template):
+		self.router = web.UrlDispatcher()
+		for method, path, handler in routes:
+			self.router.add_route(method, path, handler)
+		self.middlewares = tuple(middlewares)
+		self.template = template
+		# route handler -> handler wrapped by the middlewares:
+		self._chains = dict()
+
+	@asyncio.coroutine
+	def _chain(self, app, handler):
+		for factory in reversed(self.middlewares):
+			handler = yield from factory(app, handler)
+		return handler
+
+	@asyncio.coroutine
+	def handler(self, app, match_info):
+		'''
+		The handler of match_info, resolved by this table, wrapped by its middlewares.
+		'''
+		if getattr(match_info, 'http_exception', None) is not None:
+			# 404 or 405, a new handler every time, so not cached:
+			return (yield from self._chain(app, match_info.handler))
+		handler = self._chains.get(match_info.handler)
+		if handler is None:
+			handler = self._chains[match_info.handler] = yield from self._chain(app, match_info.handler)
+		return handler
+
+class _TableResource(web.AbstractResource):
+	'''
+	The only resource of the application's router, it resolves every request with the
+	current _RouteTable and keeps that table in the request: aiohttp sets the match info
+	of the table's route, and _dispatch() runs the middlewares of the same table even if
+	another one was swapped in meanwhile.
+	'''
+	@property
+	def canonical(self):
+		return '/{tail:.*}'
+
+	def url_for(self, **kw):
+		raise RuntimeError('The routes of the current table have no URL builder.')
+
+	@asyncio.coroutine
+	def resolve(self, request):
+		table = _table
+		request['__route_table__'] = table
+		match_info = yield from table.router.resolve(request)
+		# 404 and 405 too, so they go through the middlewares like before:
+		return match_info, set()
+
+	def add_prefix(self, prefix):
+		raise RuntimeError('Cannot add a prefix to the route table.')
+
+	def get_info(self):
+		return dict()
+
+	def raw_match(self, path):
+		return False
+
+	def __len__(self):
+		return len(_table.router.routes())
+
+	def __iter__(self):
+		return iter(_table.router.routes())
+
+@web.middleware
+@asyncio.coroutine
+def _dispatch(request, handler):
+	global _drained
+	_slots.incr(_slot, 'requests')
+	task = asyncio.current_task()
+	_inflight.add(task)
+	try:
+		table = request['__route_table__']
+		request['__template__'] = table.template
+		handler = yield from table.handler(request.app, request.match_info)
+		r = yield from handler(request)
+	except web.HTTPException as e:
+		if e.status >= 500:
+			_slots.incr(_slot, 'errors')
+		raise
+	except:
+		_slots.incr(_slot, 'errors')
+		raise
+	finally:
+		_inflight.discard(task)
+		if _draining:
+			_drained = _drained + 1
+			if not _inflight:
+				_idle.set()
+	if getattr(r, 'status', 200) >= 500:
+		_slots.incr(_slot, 'errors')
+	if _draining and isinstance(r, web.StreamResponse):
+		# no keep-alive while draining, the client reconnects to a serving process:
+		r.force_close()
+	return r
+
+def _swap():
+	'''
+	Build a table of the registered routes, middlewares and template and make it current.
+	A registration that cannot be routed raises here and leaves the current table alone.
+	'''
+	global _table
+	with _table_lock:
+		_table = _RouteTable(_routes, _middleware, _template)
+
 def add_route(fn):
-	global _routes, _isrun
+	global _routes
 	method = getattr(fn, '__method__', None)
 	route = getattr(fn, '__route__', None)
+	cache = getattr(fn, '__cache__', None)
 	if method is None or route is None:
 		raise ValueError('@get or @post not defined in %s.' % str(fn))
 	if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
 		fn = asyncio.coroutine(fn)
-	logging.info('add route %s %s => %s(%s)' % (method, route, fn.__name__, ','.join(inspect.signature(fn).parameters.keys())))
-	_routes.append([method, route, RequestHandler(fn)])
-	if _isrun:
-		restart()
-	#_app.router.add_route(method, route, RequestHandler(fn))
+	_log.info('add route %s %s => %s(%s)', method, route, fn.__name__, ','.join(inspect.signature(fn).parameters.keys()))
+	handler = RequestHandler(fn, cache)
+	# a cached GET answers HEAD from the same cache entry, see cache_factory():
+	methods = (method, 'HEAD') if cache is not None and method == 'GET' else (method,)
+	with _table_lock:
+		n = len(_routes)
+		for m in methods:
+			_routes.append([m, route, handler])
+		try:
+			_swap()
+		except:
+			del _routes[n:]
+			raise
 
 
 def add_routes(module):
@@ -176,42 +325,174 @@ def add_routes(module):
 			if method and route:
 				add_route(fn)
 
-def add_static(path):
+def add_static(path, **kw):
+	'''
+	Serve the files under path/static at /static/, see _StaticFiles for the keyword
+	arguments, and make static_url() give their fingerprinted URLs.
+	'''
+	global _static
 	path = os.path.join(path, 'static')
-	logging.info('add static %s -> %s.' % ('/static/', path))
-	#_app.router.add_static('/static/', path)
+	_log.info('add static %s -> %s.', _STATIC_PREFIX, path)
+	with _table_lock:
+		_static = _StaticFiles(path, _STATIC_PREFIX, **kw)
+		for method in ('GET', 'HEAD'):
+			_routes.append([method, _STATIC_PREFIX + '{filename:.*}', _static.handle])
+		_swap()
+
+def static_url(filename):
+	'''
+	URL of static file filename with the hash of its content in the name, which is
+	served with a one year immutable Cache-Control, in templates:
+	<link rel="stylesheet" href="{{ static_url('css/app.css') }}">
+	'''
+	if _static is None:
+		return _STATIC_PREFIX + filename
+	return _static.url(filename)
 
 def add_middleware(middleware):
-	global _middleware, _isrun
-	_middleware.add(middleware)
-	if _isrun:
-		restart()
+	'''
+	Add a middleware factory, inside the ones added before it.
+	'''
+	global _middleware
+	with _table_lock:
+		if not middleware in _middleware:
+			_middleware.append(middleware)
+			_swap()
+
+def add_shutdown_hook(func):
+	'''
+	Call func() when the server stops, after the requests in flight were drained and
+	before the database engine is closed.
+	'''
+	_shutdown_hooks.append(func)
+
+def db_stats():
+	'''
+	Database statistics: per statement query stats, statement cache and pool counters.
+	'''
+	return dict(queries=db.query_stats(), statements=db.statement_cache_stats(), pool=db.pool_stats())
+
+def add_db_stats_route(path='/__debug/db'):
+	'''
+	Serve db_stats() as JSON on path. Meant for debugging, keep it off the public site.
+	'''
+	@get(path)
+	def debug_db():
+		return db_stats()
+	add_route(debug_db)
+
+def dump_db_stats(path=None, top=20):
+	'''
+	Write db_stats() as JSON to file path, or log the top statements by total time.
+	'''
+	if path is not None:
+		with open(path, 'w') as f:
+			json.dump(db_stats(), f, indent=1, default=_json_default)
+		_log.info('db stats dumped to %s', path)
+		return
+	for d in db.query_stats(top=top):
+		_log.info('[DB STATS] calls=%(calls)d total=%(total).3fs mean=%(mean).4fs p95=%(p95).4fs p99=%(p99).4fs rows=%(rows)d affected=%(affected)d wait=%(wait).3fs: %(sql)s', d)
 
 def add_template(template):
-	global _template, _isrun
-	_template = template
-	if _isrun:
-		restart()
+	global _template
+	with _table_lock:
+		_template = template
+		_swap()
+
+class _WorkerSlots(object):
+	'''
+	Per worker counters in memory shared by the master and the workers it forks. Each
+	worker writes only its own slot, so no lock is needed.
+	'''
+	FIELDS = ('pid', 'started', 'requests', 'errors')
+
+	def __init__(self, n):
+		self.n = n
+		self._a = multiprocessing.RawArray('d', n * len(self.FIELDS))
+
+	def _index(self, slot, field):
+		return slot * len(self.FIELDS) + self.FIELDS.index(field)
+
+	def bind(self, slot, pid):
+		for field in self.FIELDS:
+			self._a[self._index(slot, field)] = 0
+		self._a[self._index(slot, 'pid')] = pid
+		self._a[self._index(slot, 'started')] = time.time()
+
+	def incr(self, slot, field):
+		self._a[self._index(slot, field)] += 1
+
+	def get(self, slot):
+		return dict([(field, self._a[self._index(slot, field)]) for field in self.FIELDS])
 
-def start():
-	global _ip, _port, _isrun, _loop, _app, _routes, _handler, _srv, _middleware
+	def free(self):
+		for slot in range(self.n):
+			if not self._a[self._index(slot, 'pid')]:
+				return slot
+		return None
+
+	def release(self, slot):
+		self._a[self._index(slot, 'pid')] = 0
+
+def start(workers=None, reuse_port=False, shutdown_timeout=10.0):
+	'''
+	Serve until stopped. With workers > 1 the process becomes a master that forks that
+	many workers, each with its own event loop, and supervises them, see _Master.
+	The workers share one socket bound by the master, or with reuse_port each binds its
+	own with SO_REUSEPORT and the kernel balances the connections between them.
+	On stop() or SIGTERM a serving process gives the requests in flight up to
+	shutdown_timeout seconds to finish, see _shutdown().
+	'''
+	global _isrun, _restarting
 	if _ip is None or _port is None:
 		raise Exception('Server uninit.')
 	if _isrun:
 		raise Exception('Server is running.')
+	if workers is not None and workers > 1:
+		_Master(workers, reuse_port, shutdown_timeout).run()
+	else:
+		_slots.bind(_slot, os.getpid())
+		_restarting = False
+		while True:
+			_serve(shutdown_timeout=shutdown_timeout)
+			if not _restarting:
+				break
+			_restarting = False
+			_log.info('restarting server...')
+
+def _serve(sock=None, reuse_port=False, ready=None, shutdown_timeout=10.0):
+	'''
+	Run the startup hooks and serve on this process's event loop, on sock if given,
+	until stop() or SIGTERM, then shut down in order.
+	'''
+	global _ip, _port, _isrun, _loop, _app, _routes, _handler, _srv, _middleware, _engine
+	# the transactions a previous shutdown aborted are gone, new ones commit:
+	db.resume_transactions()
+	engine = db.engine
+	for hook in _startup_hooks:
+		hook()
+	_engine = db.engine if db.engine is not engine else None
 	_loop = asyncio.get_event_loop()
-	_app = web.Application(loop=_loop, middlewares=list(_middleware))
-	_app['__template__'] = _template
+	_swap()
+	# routes and middlewares live in the swappable _table, see _RouteTable:
+	_app = web.Application(loop=_loop, middlewares=[_dispatch])
+	_app.router.register_resource(_TableResource())
 	for route in _routes:
-		logging.info('add router:[%s]' % str(route))
-		if callable(route[2]):
-			logging.info('handler %s can call' % route[2])
-		_app.router.add_route(route[0], route[1], route[2])
-	logging.info('_app.router has %s' % str(_app.router.items()))
+		_log.info('add router:[%s]', route)
 	_handler = _app.make_handler()
-	f = _loop.create_server(_handler, _ip, _port)
+	if sock is not None:
+		f = _loop.create_server(_handler, sock=sock)
+	elif reuse_port:
+		f = _loop.create_server(_handler, _ip, _port, reuse_port=True)
+	else:
+		f = _loop.create_server(_handler, _ip, _port)
 	_srv = _loop.run_until_complete(f)
-	logging.info('server started at %s:%s....' % (_ip, _port))
+	if threading.current_thread() is threading.main_thread():
+		_loop.add_signal_handler(signal.SIGTERM, stop)
+	_log.info('server started at %s:%s....', _ip, _port)
+	if ready is not None:
+		os.write(ready, b'1')
+		os.close(ready)
 	try:
 		_isrun = True
 		_loop.run_forever()
@@ -219,25 +500,304 @@ def start():
 		pass
 	finally:
 		_isrun = False
-		_loop.run_until_complete(_handler.finish_connections(1.0))
+		_loop.run_until_complete(_shutdown(shutdown_timeout))
 		_handler = None
-		_srv.close()
-		_loop.run_until_complete(srv.wait_closed())
 		_srv = None
-		_loop.run_until_complete(_app.finish())
 		_app = None
 
+@asyncio.coroutine
+def _shutdown(timeout):
+	'''
+	Stop accepting connections, give the requests in flight up to timeout seconds to
+	finish, cancel the rest and roll back their transactions, then close the connections,
+	run the shutdown hooks, finish the app and close the database engine if the startup
+	hooks created it; an engine created before start() is left open for its creator.
+	'''
+	global _draining, _drained, _idle, _engine
+	start = time.time()
+	_draining = True
+	_drained = 0
+	_idle = asyncio.Event()
+	_srv.close()
+	if _inflight:
+		_log.info('draining %d requests...', len(_inflight))
+		try:
+			yield from asyncio.wait_for(_idle.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+	drained, cut = _drained, len(_inflight)
+	if cut:
+		_log.warning('%d requests still running after %.1fs, cancelling them.', cut, timeout)
+		# statements already running in the db executor go on, make them roll back:
+		db.abort_transactions()
+		for task in list(_inflight):
+			task.cancel()
+		try:
+			yield from asyncio.wait_for(_idle.wait(), 1.0)
+		except asyncio.TimeoutError:
+			pass
+	if hasattr(_handler, 'shutdown'):
+		yield from _handler.shutdown(1.0)
+	else:
+		yield from _handler.finish_connections(1.0)
+	yield from _srv.wait_closed()
+	for hook in _shutdown_hooks:
+		try:
+			hook()
+		except Exception as e:
+			_log.exception('shutdown hook %s failed: %s', hook, e)
+	if hasattr(_app, 'cleanup'):
+		yield from _app.shutdown()
+		yield from _app.cleanup()
+	else:
+		yield from _app.finish()
+	if _engine is not None and db.engine is _engine:
+		if getattr(db.engine, 'is_async', False):
+			closing = db.close_engine()
+		else:
+			# waits for the executor threads, keep it off the loop:
+			closing = asyncio.get_event_loop().run_in_executor(None, db.close_engine)
+		try:
+			yield from asyncio.wait_for(closing, _ENGINE_CLOSE_TIMEOUT)
+		except asyncio.TimeoutError:
+			_log.warning('database engine did not close in %.1fs.', _ENGINE_CLOSE_TIMEOUT)
+	_engine = None
+	_draining = False
+	_log.info('shutdown in %.2fs: %d requests drained, %d cut off.', time.time() - start, drained, cut)
+
+class _Master(object):
+	'''
+	Pre-fork supervisor: forks the workers, forks a new one for each worker that dies,
+	restarts them one by one on SIGHUP (each replacement is serving before the old one
+	is stopped), stops them all on SIGTERM or SIGINT and logs their counters on SIGUSR1.
+	'''
+	# seconds a stopping worker gets past its shutdown_timeout before it is killed:
+	STOP_GRACE = 10.0
+	# seconds a new worker gets to start serving:
+	READY_TIMEOUT = 30.0
+	# a worker dying younger than this is respawned after a pause:
+	MIN_LIFETIME = 1.0
+	# seconds between the checks of a worker that its master is alive:
+	MASTER_CHECK = 1.0
+
+	def __init__(self, workers, reuse_port=False, shutdown_timeout=10.0):
+		self.workers = workers
+		self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+		self.shutdown_timeout = shutdown_timeout
+		self.stop_timeout = shutdown_timeout + self.STOP_GRACE
+		self.sock = None
+		# pid -> slot:
+		self.children = dict()
+		self.signals = []
+		# counters of workers gone, so the totals survive restarts:
+		self.retired = dict(requests=0, errors=0)
+
+	def run(self):
+		global _slots
+		# room for a replacement next to every worker during a rolling restart:
+		_slots = _WorkerSlots(2 * self.workers)
+		if not self.reuse_port:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.sock.bind((_ip, _port))
+			self.sock.listen(1024)
+		for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD, signal.SIGUSR1):
+			signal.signal(sig, lambda signum, frame: self.signals.append(signum))
+		_log.info('master %d serving %s:%s with %d workers...', os.getpid(), _ip, _port, self.workers)
+		for i in range(self.workers):
+			self.spawn()
+		try:
+			while True:
+				self.reap()
+				while self.signals:
+					sig = self.signals.pop(0)
+					if sig in (signal.SIGTERM, signal.SIGINT):
+						return
+					if sig == signal.SIGHUP:
+						self.roll()
+					elif sig == signal.SIGUSR1:
+						self.log_stats()
+				while len(self.children) < self.workers:
+					self.spawn()
+				time.sleep(0.5)
+		finally:
+			self.stop_all()
+			self.log_stats()
+			if self.sock is not None:
+				self.sock.close()
+
+	def spawn(self):
+		'''
+		Fork a worker and wait until it serves, return its pid or None if it failed.
+		'''
+		slot = _slots.free()
+		if slot is None:
+			_log.warning('no free worker slot.')
+			return None
+		r, w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(r)
+			self._worker(slot, w)
+		os.close(w)
+		self.children[pid] = slot
+		try:
+			readable = select.select([r], [], [], self.READY_TIMEOUT)[0]
+			ok = readable and os.read(r, 1) == b'1'
+		finally:
+			os.close(r)
+		if not ok:
+			_log.warning('worker %d failed to start.', pid)
+			self.kill(pid)
+			return None
+		_log.info('worker %d started.', pid)
+		return pid
+
+	def _worker(self, slot, ready):
+		global _slot
+		code = 0
+		try:
+			_slot = slot
+			_slots.bind(slot, os.getpid())
+			for sig in (signal.SIGHUP, signal.SIGCHLD, signal.SIGUSR1):
+				signal.signal(sig, signal.SIG_DFL)
+			# the master decides when to stop:
+			signal.signal(signal.SIGINT, signal.SIG_IGN)
+			loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(loop)
+			loop.call_later(self.MASTER_CHECK, self._watch_master, loop, os.getppid())
+			_serve(self.sock, self.reuse_port, ready, self.shutdown_timeout)
+		except:
+			_log.exception('worker %d failed.', os.getpid())
+			code = 1
+		finally:
+			os._exit(code)
+
+	def _watch_master(self, loop, ppid):
+		# a worker whose master was killed would serve on forever, holding the port:
+		if os.getppid() != ppid:
+			_log.warning('master %d is gone, worker %d stops.', ppid, os.getpid())
+			stop()
+		else:
+			loop.call_later(self.MASTER_CHECK, self._watch_master, loop, ppid)
+
+	def reap(self):
+		'''
+		Collect the workers that exited, return their pids.
+		'''
+		L = []
+		while self.children:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			slot = self.children.pop(pid, None)
+			if slot is None:
+				continue
+			d = _slots.get(slot)
+			self.retired['requests'] += d['requests']
+			self.retired['errors'] += d['errors']
+			_slots.release(slot)
+			if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+				_log.warning('worker %d died with status %d.', pid, status)
+				if time.time() - d['started'] < self.MIN_LIFETIME:
+					time.sleep(self.MIN_LIFETIME)
+			L.append(pid)
+		return L
+
+	def wait(self, pids, timeout):
+		deadline = time.time() + timeout
+		pids = set(pids)
+		while pids and time.time() < deadline:
+			pids.difference_update(self.reap())
+			pids.intersection_update(self.children)
+			if pids:
+				time.sleep(0.05)
+		return pids
+
+	def kill(self, pid, sig=signal.SIGKILL):
+		try:
+			os.kill(pid, sig)
+		except ProcessLookupError:
+			pass
+
+	def roll(self):
+		'''
+		Replace the workers one at a time, every replacement serves before the worker it
+		replaces stops, so the server keeps its capacity.
+		'''
+		_log.info('rolling restart of %d workers...', len(self.children))
+		for pid in list(self.children):
+			if self.spawn() is None:
+				_log.warning('rolling restart stopped, worker %d kept.', pid)
+				return
+			self.kill(pid, signal.SIGTERM)
+			if self.wait([pid], self.stop_timeout):
+				_log.warning('worker %d did not stop, killing it.', pid)
+				self.kill(pid)
+				self.wait([pid], 1.0)
+
+	def stop_all(self):
+		pids = list(self.children)
+		for pid in pids:
+			self.kill(pid, signal.SIGTERM)
+		for pid in self.wait(pids, self.stop_timeout):
+			_log.warning('worker %d did not stop, killing it.', pid)
+			self.kill(pid)
+		self.wait(pids, 1.0)
+
+	def log_stats(self):
+		for d in worker_stats():
+			_log.info('worker %(pid)d: requests=%(requests)d errors=%(errors)d', d)
+		_log.info('master: requests=%(requests)d errors=%(errors)d including stopped workers', self.totals())
+
+	def totals(self):
+		d = dict(self.retired)
+		for w in worker_stats():
+			d['requests'] += w['requests']
+			d['errors'] += w['errors']
+		return d
+
+def worker_stats():
+	'''
+	Return the counters of the running workers (of this process if it serves alone).
+	'''
+	L = []
+	for slot in range(_slots.n):
+		d = _slots.get(slot)
+		if d['pid']:
+			d['pid'] = int(d['pid'])
+			L.append(d)
+	return L
+
+def add_startup_hook(func):
+	'''
+	Call func() in every serving process before it starts serving: in each worker
+	after the fork, so things like database pools are not shared between processes.
+	'''
+	_startup_hooks.append(func)
+
 def stop():
-	global _isrun, _loop
+	'''
+	Stop serving, from the loop, another thread or a signal handler: the loop stops and
+	the serving process shuts down in order, see _shutdown().
+	'''
 	if not _isrun:
 		return
-	_loop.stop()
-	_loop.close()
-
+	_loop.call_soon_threadsafe(_loop.stop)
 
 def restart():
+	'''
+	Shut down like stop() and serve again with the startup hooks run again. In a worker
+	the process exits once shut down and the master forks a new one in its place.
+	'''
+	global _restarting
+	if not _isrun:
+		return
+	_restarting = True
 	stop()
-	start()
 
 def init(ip, port):
 	global _app, _ip, _port
@@ -246,23 +806,762 @@ def init(ip, port):
 
 	_ip = ip
 	_port = port
-	logging.info('init server at %s:%s...' % (_ip, _port))
+	_log.info('init server at %s:%s...', _ip, _port)
 
 @asyncio.coroutine
 def logger_factory(app, handler):
+	'''
+	Log the details of sampled requests to framework.request, and one line of every
+	request to framework.access:
+	method=GET path=/ status=200 bytes=5120 ms=3.25 remote=127.0.0.1
+	'''
 	@asyncio.coroutine
 	def logger(request):
-		logging.info('Request: %s %s' % (request.method, request.path))
-		logging.info('app is %s, handler is %s' % (app, handler))
-		# yield from asyncio.sleep(0.3)
-		return (yield from handler(request))
+		verbose = _request_sampler() and _request_log.isEnabledFor(logging.INFO)
+		request['__verbose__'] = verbose
+		if verbose:
+			_request_log.info('Request: %s %s', request.method, request.path)
+			_request_log.debug('app is %s, handler is %s', app, handler)
+		start = time.time()
+		r = None
+		status = 500
+		try:
+			r = yield from handler(request)
+			status = getattr(r, 'status', 200)
+			return r
+		except web.HTTPException as e:
+			status = e.status
+			raise
+		finally:
+			if _access_log.isEnabledFor(logging.INFO):
+				_access_log.info('%s', log.Fields(method=request.method, path=request.path, status=status,
+					bytes=getattr(r, 'content_length', None), ms=(time.time() - start) * 1000, remote=request.remote))
 	return logger
 
+class _CachePolicy(object):
+	'''
+	Cache policy of a route:
+	ttl          seconds a response is served from the cache
+	vary_cookie  name, or names, of the cookies whose values are part of the key, like
+	             a session cookie: anonymous requests share one entry
+	vary_query   False ignores the query string
+	depends      tables whose writes drop the responses, None for every table
+	'''
+	__slots__ = ('ttl', 'vary_cookie', 'vary_query', 'depends')
+
+	def __init__(self, ttl=60.0, vary_cookie=None, vary_query=True, depends=None):
+		self.ttl = ttl
+		self.vary_cookie = (vary_cookie,) if isinstance(vary_cookie, str) else tuple(vary_cookie or ())
+		self.vary_query = vary_query
+		self.depends = None if depends is None else tuple(depends)
+
+	def key(self, request):
+		L = [request.path]
+		if self.vary_query:
+			L.append(request.query_string)
+		for name in self.vary_cookie:
+			L.append(request.cookies.get(name))
+		return tuple(L)
+
+# headers of one connection, or made for every response, that are not stored:
+_UNCACHED_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+	'transfer-encoding', 'upgrade', 'content-length', 'date', 'etag', 'set-cookie', 'vary'))
+# headers a 304 repeats from the response it stands for, see RFC 7232 4.1:
+_NOT_MODIFIED_HEADERS = frozenset(('cache-control', 'content-location', 'expires', 'vary'))
+
+class _CachedResponse(object):
+	'''
+	Encoded response as stored by _ResponseCache: status, body and end-to-end headers,
+	with its compressed variants by content encoding, made the first time an encoding
+	is asked for.
+	'''
+	__slots__ = ('expires', 'status', 'headers', 'body', 'etag', 'vary', 'depends', 'size', 'compressible', 'variants')
+
+	def __init__(self, r, policy):
+		self.expires = time.time() + policy.ttl
+		self.status = r.status
+		self.body = r.body
+		self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+		# and the headers Connection names as hop-by-hop:
+		skip = _UNCACHED_HEADERS | set(x.strip().lower() for x in r.headers.get('Connection', '').split(','))
+		self.headers = [(k, v) for k, v in r.headers.items() if k.lower() not in skip]
+		content_type = r.headers.get('Content-Type')
+		if content_type is None:
+			content_type = 'application/octet-stream'
+			self.headers.append(('Content-Type', content_type))
+		self.compressible = 'Content-Encoding' not in r.headers and _compressible(content_type, self.body)
+		vary = [x.strip() for x in r.headers.get('Vary', '').split(',') if x.strip()]
+		for name, varies in (('Cookie', policy.vary_cookie), ('Accept-Encoding', self.compressible)):
+			if varies and name.lower() not in [x.lower() for x in vary]:
+				vary.append(name)
+		self.vary = ', '.join(vary) or None
+		if self.vary is not None:
+			self.headers.append(('Vary', self.vary))
+		self.depends = policy.depends
+		# the body and about what the rest takes:
+		self.size = len(self.body) + 256
+		self.variants = dict()
+
+	def _etag(self, encoding):
+		# every representation has its own strong ETag:
+		return self.etag if encoding is None else '%s-%s"' % (self.etag[:-1], encoding)
+
+	def _not_modified(self, etag):
+		_response_cache.count('not_modified')
+		resp = web.Response(status=304, headers={'ETag': etag})
+		for k, v in self.headers:
+			if k.lower() in _NOT_MODIFIED_HEADERS:
+				resp.headers.add(k, v)
+		return resp
+
+	def _finish(self, resp, etag, encoding):
+		resp.headers['ETag'] = etag
+		if encoding is not None:
+			resp.body = self.variants[encoding]
+			resp.headers['Content-Encoding'] = encoding
+			resp.headers.pop('Content-Length', None)
+		return resp
+
+	def response(self, request, encoding=None):
+		'''
+		A new response from the cache, or a 304 for a matching If-None-Match.
+		'''
+		etag = self._etag(encoding)
+		if _etag_matches(request.headers.get('If-None-Match'), etag):
+			return self._not_modified(etag)
+		resp = web.Response(body=self.body, status=self.status)
+		for k, v in self.headers:
+			resp.headers.add(k, v)
+		return self._finish(resp, etag, encoding)
+
+	def tag(self, r, request, encoding=None):
+		'''
+		Response r this entry was made of, with the ETag and Vary of the entry, or a 304
+		for a matching If-None-Match.
+		'''
+		etag = self._etag(encoding)
+		if _etag_matches(request.headers.get('If-None-Match'), etag):
+			return self._not_modified(etag)
+		if self.vary is not None:
+			r.headers['Vary'] = self.vary
+		return self._finish(r, etag, encoding)
+
+def _etag_matches(header, etag):
+	if not header:
+		return False
+	for tag in header.split(','):
+		tag = tag.strip()
+		if tag == etag or tag == '*' or tag[2:] == etag and tag.startswith('W/'):
+			return True
+	return False
+
+class _ResponseCache(object):
+	'''
+	Thread-safe LRU of encoded responses by request key with TTL, bounded by bytes.
+	invalidate(table) drops the responses depending on table, it is a db write listener,
+	so Model.insert(), update() and delete() and raw writes all invalidate. Every
+	invalidation bumps the generation, so a response made before an invalidation is not
+	stored after it. Each worker process has its own cache: a write in another worker
+	is seen here when the entry expires.
+	'''
+	def __init__(self, max_bytes=64 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.size = 0
+		self.generation = 0
+		self._data = collections.OrderedDict()
+		# table -> keys of the entries depending on it, None -> keys depending on every table:
+		self._tables = dict()
+		self._lock = threading.Lock()
+		self._counters = dict(hits=0, misses=0, not_modified=0, stores=0, evictions=0, expirations=0, invalidations=0)
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is not None:
+				if entry.expires > time.time():
+					self._data.move_to_end(key)
+					self._counters['hits'] += 1
+					return entry
+				self._remove(key)
+				self._counters['expirations'] += 1
+			self._counters['misses'] += 1
+			return None
+
+	def put(self, key, entry, generation):
+		if entry.size > self.max_bytes:
+			return
+		with self._lock:
+			if generation != self.generation:
+				return
+			if key in self._data:
+				self._remove(key)
+			self._data[key] = entry
+			self.size = self.size + entry.size
+			for table in entry.depends or (None,):
+				self._tables.setdefault(table, set()).add(key)
+			self._counters['stores'] += 1
+			while self.size > self.max_bytes:
+				self._remove(next(iter(self._data)))
+				self._counters['evictions'] += 1
+
+	def add_variant(self, key, entry, encoding, body):
+		with self._lock:
+			entry.variants[encoding] = body
+			if self._data.get(key) is not entry:
+				return
+			entry.size = entry.size + len(body)
+			self.size = self.size + len(body)
+			while self.size > self.max_bytes:
+				self._remove(next(iter(self._data)))
+				self._counters['evictions'] += 1
+
+	def _remove(self, key):
+		entry = self._data.pop(key)
+		self.size = self.size - entry.size
+		for table in entry.depends or (None,):
+			keys = self._tables.get(table)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._tables[table]
+
+	def invalidate(self, table=None):
+		'''
+		Drop the responses depending on table, or all if table is None.
+		'''
+		with self._lock:
+			self.generation = self.generation + 1
+			self._counters['invalidations'] += 1
+			if table is None:
+				self._data.clear()
+				self._tables.clear()
+				self.size = 0
+				return
+			for key in self._tables.get(table, set()) | self._tables.get(None, set()):
+				self._remove(key)
+
+	def count(self, name):
+		with self._lock:
+			self._counters[name] += 1
+
+	def stats(self):
+		with self._lock:
+			d = dict(self._counters)
+			d.update(entries=len(self._data), bytes=self.size, max_bytes=self.max_bytes)
+		return d
+
+def _cacheable(r):
+	return isinstance(r, web.Response) and r.status == 200 and isinstance(r.body, bytes) \
+		and not r.cookies and 'no-store' not in r.headers.get('Cache-Control', '')
+
+@asyncio.coroutine
+def cache_factory(app, handler):
+	'''
+	Serve the GET and HEAD requests of routes with a cache policy from the response
+	cache, with a strong ETag and 304 for a matching If-None-Match. Both methods share
+	the entry, a HEAD gets its headers and aiohttp leaves out the body. Only 200 responses
+	with a body and no cookies are stored, never the streamed ones of _stream_json()
+	and _render_stream(), with their end-to-end headers. Compressed variants are
+	stored too, so a hit is never compressed again, see compression_factory.
+	'''
+	@asyncio.coroutine
+	def cache(request):
+		policy = getattr(request.match_info.handler, '_cache', None)
+		if policy is None or not _response_cache.max_bytes or request.method not in ('GET', 'HEAD'):
+			return (yield from handler(request))
+		key = policy.key(request)
+		entry = _response_cache.get(key)
+		r = None
+		if entry is None:
+			generation = _response_cache.generation
+			r = yield from handler(request)
+			if not _cacheable(r):
+				return r
+			entry = _CachedResponse(r, policy)
+			_response_cache.put(key, entry, generation)
+		encoding = _accepted_encoding(request) if entry.compressible else None
+		if encoding is not None and encoding not in entry.variants:
+			_response_cache.add_variant(key, entry, encoding, (yield from _compress(encoding, entry.body)))
+		if r is not None:
+			# a miss sends the handler's own response, with what it would have from the cache:
+			return entry.tag(r, request, encoding)
+		return entry.response(request, encoding)
+	return cache
+
+def configure_cache(max_bytes=None):
+	'''
+	Bound the response cache to max_bytes, 0 disables it.
+	'''
+	if max_bytes is not None:
+		_response_cache.max_bytes = max_bytes
+		_response_cache.invalidate()
+
+def invalidate_cache(table=None):
+	'''
+	Drop the cached responses depending on table, or all of them.
+	'''
+	_response_cache.invalidate(table)
+
+def cache_stats():
+	return _response_cache.stats()
+
+def _gzip(level):
+	def compress(body):
+		# wbits 31 writes the gzip format, without the timestamp of gzip.compress():
+		c = zlib.compressobj(level, zlib.DEFLATED, 31)
+		return c.compress(body) + c.flush()
+	return compress
+
+def _brotli(quality):
+	import brotli
+	return lambda body: brotli.compress(body, quality=quality)
+
+def configure_compression(threshold=None, gzip_level=None, brotli_quality=None, encodings=None, executor_threshold=None):
+	'''
+	Compress text and JSON response bodies of threshold bytes or more, with the first of
+	encodings ('br' if brotli is installed, 'gzip') the client accepts, at gzip_level
+	(1-9) or brotli_quality (0-11). Bodies of executor_threshold bytes or more are
+	compressed in the loop's default executor. encodings=() disables compression.
+	'''
+	global _compress_threshold, _gzip_level, _brotli_quality, _compress_encodings, _compress_executor_threshold
+	if threshold is not None:
+		_compress_threshold = threshold
+	if gzip_level is not None:
+		_gzip_level = gzip_level
+	if brotli_quality is not None:
+		_brotli_quality = brotli_quality
+	if encodings is not None:
+		_compress_encodings = tuple(encodings)
+	if executor_threshold is not None:
+		_compress_executor_threshold = executor_threshold
+	_encoders.clear()
+	for encoding in _compress_encodings:
+		try:
+			_encoders[encoding] = _brotli(_brotli_quality) if encoding == 'br' else _gzip(_gzip_level)
+		except ImportError:
+			_log.info('brotli is not installed, no br encoding.')
+	_response_cache.invalidate()
+
+def _compressible(content_type, body):
+	return isinstance(body, bytes) and len(body) >= _compress_threshold and \
+		(content_type.startswith(_COMPRESSIBLE_TYPES) or '+json' in content_type or '+xml' in content_type)
+
+def _accepted_encodings(request):
+	' the content encodings request accepts, q=0 excluded. '
+	accepted = set()
+	header = request.headers.get('Accept-Encoding')
+	if not header:
+		return accepted
+	for part in header.lower().split(','):
+		name, _, params = part.partition(';')
+		q = params.replace(' ', '').partition('q=')[2]
+		try:
+			if q and float(q) == 0:
+				continue
+		except ValueError:
+			continue
+		accepted.add(name.strip())
+	return accepted
+
+def _accepted_encoding(request):
+	' the encoding to use for request, None if it accepts none of _encoders. '
+	if not _encoders:
+		return None
+	accepted = _accepted_encodings(request)
+	for encoding in _encoders:
+		if encoding in accepted or '*' in accepted:
+			return encoding
+	return None
+
+@asyncio.coroutine
+def _compress(encoding, body):
+	compress = _encoders[encoding]
+	if len(body) < _compress_executor_threshold:
+		return compress(body)
+	# zlib and brotli release the GIL, so this runs beside the loop:
+	return (yield from asyncio.get_event_loop().run_in_executor(None, compress, body))
+
+@asyncio.coroutine
+def compression_factory(app, handler):
+	'''
+	Compress response bodies, see configure_compression(). Responses that already have
+	a Content-Encoding, like the compressed variants of the response cache and the
+	precompressed static files, are sent as they are, and streamed responses, like
+	the ones of _stream_json() and _render_stream(), are not compressed.
+	'''
+	@asyncio.coroutine
+	def compression(request):
+		r = yield from handler(request)
+		if not isinstance(r, web.Response) or 'Content-Encoding' in r.headers or r.status in (204, 304):
+			return r
+		if not _compressible(r.headers.get('Content-Type', ''), r.body):
+			return r
+		vary = r.headers.get('Vary')
+		if not vary:
+			r.headers['Vary'] = 'Accept-Encoding'
+		elif 'Accept-Encoding' not in vary:
+			r.headers['Vary'] = vary + ', Accept-Encoding'
+		encoding = _accepted_encoding(request)
+		if encoding is not None:
+			r.body = yield from _compress(encoding, r.body)
+			r.headers['Content-Encoding'] = encoding
+		return r
+	return compression
+
+class _StaticFile(object):
+	'''
+	Small file held in memory by _StaticFiles, with its compressed variants by content
+	encoding as (body, etag): the .gz sibling on disk, or made on first use.
+	'''
+	__slots__ = ('mtime_ns', 'size', 'etag', 'last_modified', 'content_type', 'body', 'compressible', 'variants', 'cached_bytes')
+
+	def __init__(self, st, content_type, body, gz=None):
+		self.mtime_ns = st.st_mtime_ns
+		self.size = st.st_size
+		# the ETag web.FileResponse gives the same file:
+		self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+		self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+		self.content_type = content_type
+		self.body = body
+		self.compressible = _compressible(content_type, body)
+		self.variants = dict()
+		# bytes counted by _StaticFiles for it:
+		self.cached_bytes = 0
+		if gz is not None:
+			gz_st, gz_body = gz
+			self.variants['gzip'] = (gz_body, '"%x-%x"' % (gz_st.st_mtime_ns, gz_st.st_size))
+
+	def nbytes(self):
+		return len(self.body) + sum([len(v[0]) for v in self.variants.values()])
+
+class _StaticFiles(object):
+	'''
+	Serve the files under root at prefix:
+	* files up to small_max bytes are kept in memory, up to cache_max_bytes in all, and
+	  revalidated with a stat() per request; bigger files and Range requests go out
+	  with sendfile through web.FileResponse;
+	* ETag, Last-Modified and If-None-Match / If-Modified-Since give 304;
+	* a name.<hash>.ext fingerprinted name (see url()) serves name.ext, with a one year
+	  immutable Cache-Control while the hash is current, max_age seconds otherwise;
+	* a file.gz sibling is sent to clients accepting gzip, other compressible files are
+	  compressed once and kept with the file.
+	'''
+	# seconds a fingerprint is used before the file is stat()ed again:
+	FINGERPRINT_CHECK = 1.0
+
+	def __init__(self, root, prefix='/static/', max_age=3600, small_max=256 * 1024, cache_max_bytes=32 * 1024 * 1024):
+		self.root = os.path.abspath(root)
+		self.prefix = prefix
+		self.max_age = max_age
+		self.small_max = small_max
+		self.cache_max_bytes = cache_max_bytes
+		# path -> _StaticFile, least recently used first:
+		self._files = collections.OrderedDict()
+		self._size = 0
+		# filename -> (mtime_ns, size, checked at, hash):
+		self._fingerprints = dict()
+
+	def _path(self, filename):
+		path = os.path.normpath(os.path.join(self.root, filename))
+		return path if path.startswith(self.root + os.sep) else None
+
+	def _stat(self, path):
+		try:
+			st = os.stat(path)
+		except OSError:
+			return None
+		return st if stat.S_ISREG(st.st_mode) else None
+
+	def fingerprint(self, filename):
+		'''
+		Return the hash of the content of filename, None if it is not a file.
+		'''
+		now = time.time()
+		fp = self._fingerprints.get(filename)
+		if fp is not None and now - fp[2] < self.FINGERPRINT_CHECK:
+			return fp[3]
+		path = self._path(filename)
+		st = path and self._stat(path)
+		if st is None:
+			self._fingerprints.pop(filename, None)
+			return None
+		if fp is not None and fp[0] == st.st_mtime_ns and fp[1] == st.st_size:
+			h = fp[3]
+		else:
+			sha1 = hashlib.sha1()
+			with open(path, 'rb') as f:
+				for chunk in iter(lambda: f.read(65536), b''):
+					sha1.update(chunk)
+			h = sha1.hexdigest()[:12]
+		self._fingerprints[filename] = (st.st_mtime_ns, st.st_size, now, h)
+		return h
+
+	def url(self, filename):
+		h = self.fingerprint(filename)
+		if h is None:
+			return self.prefix + filename
+		base, ext = os.path.splitext(filename)
+		return '%s%s.%s%s' % (self.prefix, base, h, ext)
+
+	def _read(self, path, st):
+		with open(path, 'rb') as f:
+			body = f.read()
+		gz_st = self._stat(path + '.gz')
+		if gz_st is None:
+			return body, None
+		with open(path + '.gz', 'rb') as f:
+			return body, (gz_st, f.read())
+
+	def _put(self, path, entry):
+		old = self._files.pop(path, None)
+		if old is not None:
+			self._size = self._size - old.cached_bytes
+		entry.cached_bytes = entry.nbytes()
+		if entry.cached_bytes > self.cache_max_bytes:
+			return
+		self._files[path] = entry
+		self._size = self._size + entry.cached_bytes
+		while self._size > self.cache_max_bytes:
+			self._size = self._size - self._files.popitem(last=False)[1].cached_bytes
+
+	@asyncio.coroutine
+	def handle(self, request):
+		filename = request.match_info['filename']
+		path = self._path(filename)
+		st = path and self._stat(path)
+		immutable = False
+		if st is None:
+			m = _FINGERPRINT_RE.match(filename)
+			if m is not None:
+				filename = m.group(1) + (m.group(3) or '')
+				path = self._path(filename)
+				st = path and self._stat(path)
+				immutable = st is not None and self.fingerprint(filename) == m.group(2)
+		if st is None:
+			raise web.HTTPNotFound()
+		cache_control = 'public, max-age=31536000, immutable' if immutable else 'public, max-age=%d' % self.max_age
+		content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		if st.st_size > self.small_max or 'Range' in request.headers:
+			return self._sendfile(request, path, content_type, cache_control)
+		entry = self._files.get(path)
+		if entry is None or entry.mtime_ns != st.st_mtime_ns or entry.size != st.st_size:
+			body, gz = yield from asyncio.get_event_loop().run_in_executor(None, self._read, path, st)
+			entry = _StaticFile(st, content_type, body, gz)
+			self._put(path, entry)
+		else:
+			self._files.move_to_end(path)
+		accepted = _accepted_encodings(request)
+		encoding = 'gzip' if 'gzip' in entry.variants and 'gzip' in accepted else None
+		if encoding is None and entry.compressible:
+			encoding = _accepted_encoding(request)
+			if encoding is not None and encoding not in entry.variants:
+				entry.variants[encoding] = ((yield from _compress(encoding, entry.body)), '%s-%s"' % (entry.etag[:-1], encoding))
+				self._put(path, entry)
+		body, etag = entry.variants[encoding] if encoding is not None else (entry.body, entry.etag)
+		if_none_match = request.headers.get('If-None-Match')
+		if if_none_match is not None:
+			not_modified = _etag_matches(if_none_match, etag)
+		else:
+			since = request.if_modified_since
+			not_modified = since is not None and int(st.st_mtime) <= since.timestamp()
+		resp = web.Response(status=304) if not_modified else web.Response(body=body)
+		resp.headers['ETag'] = etag
+		resp.headers['Last-Modified'] = entry.last_modified
+		resp.headers['Cache-Control'] = cache_control
+		if entry.compressible or entry.variants:
+			resp.headers['Vary'] = 'Accept-Encoding'
+		if not not_modified:
+			resp.headers['Content-Type'] = content_type
+			resp.headers['Accept-Ranges'] = 'bytes'
+			if encoding is not None:
+				resp.headers['Content-Encoding'] = encoding
+		return resp
+
+	def _sendfile(self, request, path, content_type, cache_control):
+		# FileResponse sends with sendfile and does the Range and conditional requests,
+		# with its Content-Type set it does not guess one from a .gz name:
+		headers = {'Content-Type': content_type, 'Cache-Control': cache_control}
+		if 'gzip' in _accepted_encodings(request) and self._stat(path + '.gz') is not None:
+			path = path + '.gz'
+			headers['Content-Encoding'] = 'gzip'
+			headers['Vary'] = 'Accept-Encoding'
+		return web.FileResponse(path, headers=headers)
+
+@asyncio.coroutine
+def identity_map_factory(app, handler):
+	'''
+	Opt-in middleware that gives every request its own ORM identity map.
+	'''
+	@asyncio.coroutine
+	def identity(request):
+		with identity_map():
+			return (yield from handler(request))
+	return identity
+
+def _json_default(o):
+	# Model and Dict are dicts, every encoder writes them without calling this.
+	# db rows (transwarp.common.Row) are mappings but not dicts:
+	to_dict = getattr(o, 'to_dict', None)
+	if to_dict is not None:
+		return to_dict()
+	if isinstance(o, decimal.Decimal):
+		return float(o)
+	if isinstance(o, (datetime.datetime, datetime.date)):
+		return o.isoformat()
+	if isinstance(o, (set, frozenset)):
+		return list(o)
+	if isinstance(o, bytes):
+		return o.decode('utf-8')
+	return o.__dict__
+
+def _dumps_json(obj):
+	return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def _orjson():
+	import orjson
+	return lambda obj: orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+def _ujson():
+	import ujson
+	return lambda obj: ujson.dumps(obj, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+# encoder name -> function returning its dumps(obj) -> compact JSON bytes, 'auto'
+# takes the first installed:
+_json_encoders = dict(orjson=_orjson, ujson=_ujson, json=lambda: _dumps_json)
+
+def configure_json(encoder=None, stream_threshold=None):
+	'''
+	Choose the encoder of JSON responses: 'orjson' or 'ujson' if installed, 'json' for the
+	standard library or 'auto' for the first installed of them, and the length from which
+	a list in a JSON response is streamed (0 never streams lists), see _stream_json().
+	'''
+	global _json_dumps, _json_stream_threshold
+	if encoder is not None:
+		names = list(_json_encoders) if encoder == 'auto' else [encoder, 'json']
+		for name in names:
+			try:
+				_json_dumps = _json_encoders[name]()
+			except ImportError:
+				if encoder != 'auto':
+					_log.warning('json encoder %s is not installed.', name)
+				continue
+			_log.info('json encoder: %s', name)
+			break
+	if stream_threshold is not None:
+		_json_stream_threshold = stream_threshold
+
+def _stream_key(r):
+	# the key of the first value worth streaming: an iterator, or a long list:
+	for k, v in r.items():
+		if isinstance(v, list):
+			if _json_stream_threshold and len(v) >= _json_stream_threshold:
+				return k
+		elif hasattr(v, '__next__'):
+			return k
+	return None
+
+def _chunks(items, n):
+	it = iter(items)
+	while True:
+		chunk = list(itertools.islice(it, n))
+		if not chunk:
+			return
+		yield chunk
+
+@asyncio.coroutine
+def _write(resp, data):
+	# write() is a coroutine from aiohttp 3 on, before it buffered until drain():
+	w = resp.write(data)
+	if w is not None:
+		yield from w
+	else:
+		yield from resp.drain()
+
+@asyncio.coroutine
+def _stream_json(request, r, key):
+	'''
+	Write dict r as chunked JSON, its other values first, then the items of r[key]
+	_JSON_CHUNK at a time, so the whole body is never in memory at once.
+	r[key] is a long list or an iterator, consumed on the event loop: it must not
+	block, so not the generator of db.iter_select(), whose fetches wait for the
+	database. Load the rows with db.select_async(), db.run_async() or an async engine
+	of transwarp.aiodb first.
+	The response is streamed as it is encoded, so compression_factory sends it
+	uncompressed and cache_factory does not store it.
+	'''
+	resp = web.StreamResponse()
+	resp.content_type = 'application/json;charset=utf-8'
+	resp.enable_chunked_encoding()
+	yield from resp.prepare(request)
+	head = dict((k, v) for k, v in r.items() if k != key)
+	# '{"page":1}' -> '{"page":1,"key":[':
+	yield from _write(resp, b''.join((_json_dumps(head)[:-1], b',' if head else b'', _json_dumps(key), b':[')))
+	sep = b''
+	for chunk in _chunks(r[key], _JSON_CHUNK):
+		yield from _write(resp, sep + _json_dumps(chunk)[1:-1])
+		sep = b','
+	yield from _write(resp, b']}')
+	yield from resp.write_eof()
+	return resp
+
+@asyncio.coroutine
+def _render_stream(request, template, r):
+	'''
+	Render template as it generates, sending the page in chunks of about _RENDER_CHUNK
+	characters, for large pages returned with '__stream__': True.
+	'''
+	start = time.time()
+	t = request['__template__'].get_template(template)
+	resp = web.StreamResponse()
+	resp.content_type = 'text/html;charset=utf-8'
+	resp.enable_chunked_encoding()
+	yield from resp.prepare(request)
+	L = []
+	size = 0
+	for s in t.generate(**r):
+		L.append(s)
+		size = size + len(s)
+		if size >= _RENDER_CHUNK:
+			yield from _write(resp, ''.join(L).encode('utf-8'))
+			L = []
+			size = 0
+	if L:
+		yield from _write(resp, ''.join(L).encode('utf-8'))
+	yield from resp.write_eof()
+	_record_render(template, time.time() - start)
+	return resp
+
+def _record_render(template, elapsed):
+	s = _template_stats.get(template)
+	if s is None:
+		s = _template_stats.setdefault(template, [0, 0.0, 0.0])
+	s[0] = s[0] + 1
+	s[1] = s[1] + elapsed
+	if elapsed > s[2]:
+		s[2] = elapsed
+	if _template_log.isEnabledFor(logging.DEBUG):
+		_template_log.debug('render %s in %.2fms', template, elapsed * 1000)
+
+def template_stats():
+	'''
+	Render count and times in seconds of every template rendered, slowest in total first.
+	'''
+	L = [dict(template=k, renders=n, total=total, mean=total / n, max=m) for k, (n, total, m) in list(_template_stats.items())]
+	L.sort(key=lambda d: d['total'], reverse=True)
+	return L
+
 @asyncio.coroutine
 def response_factory(app, handler):
+	'''
+	Turn what handlers return into responses: bytes, str, 'redirect:' URLs, status codes
+	and dicts, as JSON or rendered with their '__template__'. Long lists and iterators
+	in a JSON dict and templates with '__stream__' are streamed, see _stream_json() and
+	_render_stream(), and skip compression and the response cache.
+	'''
 	@asyncio.coroutine
 	def response(request):
-		logging.info('Response handler.')
+		if request.get('__verbose__'):
+			_request_log.debug('Response handler.')
 		r = yield from handler(request)
 		if isinstance(r, web.StreamResponse):
 			return r
@@ -279,13 +1578,19 @@ def response_factory(app, handler):
 		if isinstance(r, dict):
 			template = r.get('__template__')
 			if template is None:
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o:o.__dict__).encode('utf-8'))
+				key = _stream_key(r)
+				if key is not None:
+					return (yield from _stream_json(request, r, key))
+				resp = web.Response(body=_json_dumps(r))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
-			else:
-				resp = web.Response(body=app['__template__'].get_template(template).render(**r).encode('utf-8'))
-				resp.content_type = 'text/html;charset=utf-8'
-				return resp
+			if r.get('__stream__'):
+				return (yield from _render_stream(request, template, r))
+			start = time.time()
+			resp = web.Response(body=request['__template__'].get_template(template).render(**r).encode('utf-8'))
+			_record_render(template, time.time() - start)
+			resp.content_type = 'text/html;charset=utf-8'
+			return resp
 		if isinstance(r, int) and r >= 100 and r < 600:
 			return web.Response(t)
 		if isinstance(r, tuple) and len(r) == 2:
@@ -303,8 +1608,57 @@ _app = None
 _srv = None
 _handler = None
 _isrun = False
-_middleware = set([response_factory, logger_factory])
+# set by restart() to serve again after the shutdown:
+_restarting = False
+# middleware factories, outermost first:
+_middleware = [logger_factory, compression_factory, cache_factory, response_factory]
 _template = None
 _ip = None
 _port = None
 _routes = []
+_table = None
+_table_lock = threading.RLock()
+_shutdown_hooks = []
+_startup_hooks = []
+
+# tasks of the requests in flight, see _dispatch() and _shutdown():
+_inflight = set()
+_draining = False
+_drained = 0
+_idle = None
+# seconds _shutdown() waits for the database engine to close:
+_ENGINE_CLOSE_TIMEOUT = 5.0
+# the database engine the startup hooks created, the only one _shutdown() closes:
+_engine = None
+
+# see configure_json():
+_json_dumps = _dumps_json
+_json_stream_threshold = 1000
+# items encoded per write when streaming:
+_JSON_CHUNK = 256
+# characters of a streamed page per write:
+_RENDER_CHUNK = 16384
+# template name -> [renders, total seconds, max seconds], see template_stats():
+_template_stats = dict()
+
+_response_cache = _ResponseCache()
+db.add_write_listener(_response_cache.invalidate)
+
+# see configure_compression():
+_compress_threshold = 1024
+_gzip_level = 6
+_brotli_quality = 4
+_compress_encodings = ('br', 'gzip')
+_compress_executor_threshold = 128 * 1024
+# content encoding -> compress(body), in order of preference, set by configure_compression():
+_encoders = dict(gzip=_gzip(_gzip_level))
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+# see add_static():
+_static = None
+_STATIC_PREFIX = '/static/'
+# name.<hash>.ext, see _StaticFiles.url():
+_FINGERPRINT_RE = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)?$')
+# request counters, one slot per worker, see _WorkerSlots:
+_slots = _WorkerSlots(1)
+_slot = 0
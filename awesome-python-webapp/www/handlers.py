@@ -13,7 +13,7 @@ import logging
 
 @get('/')
 def test(request):
-	users = yield from User.find_all()
+	users = yield from User.find_all_async()
 	logging.info('users is %s' % str(users))
 	return {
 	'__template__': 'test.html',
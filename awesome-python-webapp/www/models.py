@@ -17,6 +17,7 @@ class User(Model):
 	User table.
 	'''
 	__table__ = 'users'
+	__cache__ = dict(size=1000, ttl=300.0, negative_ttl=30.0)
 
 	id = StringField(primary_key = True, default = next_id, ddl = 'varchar(50)')
 	email = StringField(updatable = False, ddl = 'varchar(50)')
@@ -24,13 +25,14 @@ class User(Model):
 	admin = BooleanField()
 	name = StringField(ddl = 'varchar(50)')
 	image = StringField(ddl = 'varchar(50)')
-	create_at = FloatField(updatable = False, default = time.time)
+	created_at = FloatField(updatable = False, default = time.time)
 
 class Blog(Model):
 	'''
 	Blog table.
 	'''
 	__table__ = 'blogs'
+	__cache__ = dict(size=500, ttl=60.0, negative_ttl=10.0)
 
 	id = StringField(primary_key = True, default = next_id, ddl = 'varchar(50)')
 	user_id = StringField(updatable = False, ddl = 'varchar(50)', foreign_key = True, foreign_table_name = 'user', foreign_field = 'id')
@@ -39,7 +41,7 @@ class Blog(Model):
 	title = StringField(ddl = 'varchar(50)')
 	summary = StringField(ddl = 'varchar(200)')
 	content = TextField()
-	create_at = FloatField(updatable = False, default = time.time)
+	created_at = FloatField(updatable = False, default = time.time)
 
 class Comment(Model):
 	'''
@@ -53,7 +55,7 @@ class Comment(Model):
 	user_name = StringField(ddl = 'varchar(50)')
 	user_image = StringField(ddl = 'varchar(50)')
 	content = TextField()
-	create_at = FloatField(updatable = False, default= time.time)
+	created_at = FloatField(updatable = False, default= time.time)
 	context_id = StringField(ddl = 'varchar(50)') #被回复评论的id
 
 class Tag(Model):
@@ -61,6 +63,7 @@ class Tag(Model):
 	Tag table. Store blog's tag.
 	'''
 	__table__ = 'tags'
+	__cache__ = dict(size=500, ttl=600.0, negative_ttl=60.0)
 
 	id = StringField(primary_key = True, default = next_id, ddl = 'varchar(50)')
 	content = StringField(ddl = 'varchar(50)')
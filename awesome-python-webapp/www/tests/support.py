@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Helpers of the tests: a fresh engine over transwarp.fakedb and a fresh event loop per
+test, so no MySQL server is needed, and a framework server in a thread. Run from the
+www directory:
+	python3 -m unittest discover tests
+'''
+
+import asyncio, http.client, itertools, socket, threading, time, unittest
+from transwarp import db
+import framework
+
+_databases = itertools.count()
+
+class EngineTestCase(unittest.TestCase):
+	'''
+	Create the global engine before every test and close it after. engine is the
+	engine type passed to db.create_engine(), tables are created by setUp().
+	'''
+	engine = 'fake_mysql'
+	engine_kw = dict()
+	tables = ()
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.database = 'test%d' % next(_databases)
+		db.create_engine('test', 'test', self.database, engine=self.engine, **self.engine_kw)
+		for sql in self.tables:
+			self.wait(db.update_async(sql))
+
+	def tearDown(self):
+		r = db.close_engine()
+		if r is not None:
+			self.loop.run_until_complete(r)
+		self.loop.close()
+		asyncio.set_event_loop(None)
+
+	def wait(self, aw):
+		' run awaitable aw on the loop of the test and return its result. '
+		return self.loop.run_until_complete(aw)
+
+class ServerTestCase(unittest.TestCase):
+	'''
+	Serve framework on a free port of 127.0.0.1 in a thread of its own before every test
+	and stop it after. The routes are the functions of routes, added by setUp().
+	'''
+	routes = ()
+	shutdown_timeout = 1.0
+
+	def setUp(self):
+		framework._routes = []
+		framework._table = None
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			self.port = s.getsockname()[1]
+		framework.init('127.0.0.1', self.port)
+		for fn in self.routes:
+			framework.add_route(fn)
+		self.thread = threading.Thread(target=self._serve)
+		self.thread.start()
+		self.wait_until(lambda: framework._isrun)
+
+	def wait_until(self, ready, timeout=5):
+		deadline = time.time() + timeout
+		while not ready():
+			if time.time() > deadline or not self.thread.is_alive():
+				self.fail('Timed out waiting for the server.')
+			time.sleep(0.01)
+
+	def _serve(self):
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try:
+			framework.start(shutdown_timeout=self.shutdown_timeout)
+		finally:
+			loop.close()
+			asyncio.set_event_loop(None)
+
+	def tearDown(self):
+		framework.stop()
+		self.thread.join(10)
+		self.assertFalse(self.thread.is_alive())
+
+	def connect(self):
+		return http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+
+	def request(self, method, path, headers=None, body=None, conn=None):
+		' send a request, on conn if given, and return (status, headers, body). '
+		c = conn or self.connect()
+		try:
+			c.request(method, path, body=body, headers=headers or dict())
+			r = c.getresponse()
+			return r.status, r.headers, r.read()
+		finally:
+			if conn is None:
+				c.close()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio, time, unittest
+from unittest import mock
+from transwarp import db, aiodb
+from tests.support import EngineTestCase
+
+class AsyncEngineTest(EngineTestCase):
+
+	engine = 'fake'
+	engine_kw = dict(pool_max_size=3, pool_timeout=0.1)
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_statements(self):
+		self.assertEqual(self.wait(aiodb.insert('user', id=1, name='Alice')), 1)
+		self.assertEqual(self.wait(aiodb.insert_many('user', [dict(id=2, name='Bob'), dict(id=3, name='Eve')], max_rows=1)), 2)
+		self.assertEqual(self.wait(aiodb.update('update user set name=? where id=?', 'Ada', 1)), 1)
+		self.assertEqual(self.wait(aiodb.select_one('select * from user where id=?', 1)).name, 'Ada')
+		self.assertIsNone(self.wait(aiodb.select_one('select * from user where id=?', 9)))
+		self.assertEqual(self.wait(aiodb.select_int('select count(*) from user')), 3)
+		with self.assertRaises(db.MultiColumnsError):
+			self.wait(aiodb.select_int('select id, name from user'))
+
+	def test_blocking_calls_are_refused(self):
+		with self.assertRaises(db.DBError):
+			db.select('select * from user')
+
+	def test_nested_transactions(self):
+		@asyncio.coroutine
+		def inner():
+			yield from aiodb.insert('user', id=2, name='inner')
+			raise ValueError('rollback')
+		@asyncio.coroutine
+		def outer():
+			yield from aiodb.insert('user', id=1, name='outer')
+			yield from aiodb.run_in_transaction(inner)
+		with self.assertRaises(ValueError):
+			self.wait(aiodb.run_in_transaction(outer))
+		self.assertEqual(self.wait(aiodb.select_int('select count(*) from user')), 0)
+		@asyncio.coroutine
+		def ok():
+			yield from aiodb.insert('user', id=1, name='outer')
+			self.assertTrue(db.in_transaction())
+		self.wait(aiodb.run_in_transaction(ok))
+		self.assertEqual(self.wait(aiodb.select_int('select count(*) from user')), 1)
+
+	def test_spawned_task_does_not_share_the_connection(self):
+		@asyncio.coroutine
+		def child():
+			self.assertFalse(db.in_transaction())
+			return (yield from aiodb.select_int('select count(*) from user'))
+		@asyncio.coroutine
+		def parent():
+			yield from aiodb.insert('user', id=1, name='uncommitted')
+			# the children run concurrently on their own connections and see the last commit:
+			return (yield from asyncio.gather(child(), child()))
+		self.assertEqual(self.wait(aiodb.run_in_transaction(parent)), [0, 0])
+		self.assertEqual(self.wait(aiodb.select_int('select count(*) from user')), 1)
+		self.assertEqual(db.pool_stats()['in_use'], 0)
+
+	def test_connection_refuses_concurrent_statements(self):
+		@asyncio.coroutine
+		def main():
+			conn = yield from db.engine.acquire()
+			try:
+				return (yield from asyncio.gather(conn.raw.execute('select 1', ()), conn.raw.execute('select 2', ()), return_exceptions=True))
+			finally:
+				yield from db.engine.release(conn)
+		first, second = self.wait(main())
+		self.assertEqual(first, (['1'], [(1,)], -1))
+		self.assertIsInstance(second, db.DBError)
+
+	def test_pool_is_bounded(self):
+		@asyncio.coroutine
+		def hold():
+			conns = []
+			for i in range(3):
+				conns.append((yield from db.engine.acquire()))
+			try:
+				yield from db.engine.acquire()
+			finally:
+				for conn in conns:
+					yield from db.engine.release(conn)
+		with self.assertRaises(db.PoolTimeoutError):
+			self.wait(hold())
+		self.assertEqual(db.pool_stats()['size'], 3)
+		self.wait(asyncio.gather(*[aiodb.select_int('select 1') for i in range(20)]))
+		self.assertLessEqual(db.pool_stats()['size'], 3)
+
+	def test_close_wakes_waiting_tasks(self):
+		pool = db.engine._pool
+		pool.timeout = 30.0
+		@asyncio.coroutine
+		def main():
+			conns = []
+			for i in range(3):
+				conns.append((yield from pool.acquire()))
+			waiter = asyncio.ensure_future(pool.acquire())
+			yield from asyncio.sleep(0.01)
+			try:
+				yield from db.close_engine()
+				return (yield from asyncio.wait_for(waiter, 1.0))
+			finally:
+				for conn in conns:
+					yield from pool.release(conn)
+		start = time.time()
+		with self.assertRaisesRegex(db.DBError, 'closed'):
+			self.wait(main())
+		self.assertLess(time.time() - start, 1.0)
+		self.assertEqual(pool.stats()['size'], 0)
+
+class AiomysqlConnectionTest(unittest.TestCase):
+	'''
+	_AiomysqlConnection against a mock with the protocol of an aiomysql connection,
+	no server needed.
+	'''
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		self.cursor = mock.Mock(execute=mock.AsyncMock(), fetchall=mock.AsyncMock(return_value=[(1, 'Alice')]), close=mock.AsyncMock(),
+			description=(('id', 3), ('name', 253)), rowcount=1)
+		self.raw = mock.Mock(cursor=mock.AsyncMock(return_value=self.cursor), commit=mock.AsyncMock(), rollback=mock.AsyncMock(), ping=mock.AsyncMock())
+		self.conn = aiodb._AiomysqlConnection(self.raw)
+
+	def tearDown(self):
+		self.loop.close()
+
+	def wait(self, aw):
+		return self.loop.run_until_complete(aw)
+
+	def test_select(self):
+		self.assertEqual(self.wait(self.conn.execute('select * from user where id=%s', (1,))), (['id', 'name'], [(1, 'Alice')], 1))
+		self.cursor.execute.assert_awaited_once_with('select * from user where id=%s', (1,))
+		self.cursor.close.assert_awaited_once_with()
+
+	def test_write_fetches_nothing(self):
+		self.cursor.description = None
+		self.cursor.rowcount = 2
+		self.assertEqual(self.wait(self.conn.execute('delete from user', ())), ([], [], 2))
+		self.cursor.fetchall.assert_not_awaited()
+		self.cursor.close.assert_awaited_once_with()
+
+	def test_failed_statement_closes_the_cursor(self):
+		self.cursor.execute.side_effect = ValueError('syntax')
+		with self.assertRaises(ValueError):
+			self.wait(self.conn.execute('selec 1', ()))
+		self.cursor.close.assert_awaited_once_with()
+		# and the connection takes the next statement:
+		self.cursor.execute.side_effect = None
+		self.assertEqual(self.wait(self.conn.execute('select 1', ()))[0], ['id', 'name'])
+
+	def test_transaction_calls(self):
+		self.raw.get_transaction_status.return_value = True
+		self.assertTrue(self.conn.in_transaction)
+		self.wait(self.conn.commit())
+		self.wait(self.conn.rollback())
+		self.wait(self.conn.ping())
+		self.wait(self.conn.close())
+		self.raw.commit.assert_awaited_once_with()
+		self.raw.rollback.assert_awaited_once_with()
+		self.raw.ping.assert_awaited_once_with(reconnect=False)
+		self.raw.close.assert_called_once_with()
+
+if __name__ == '__main__':
+	unittest.main()
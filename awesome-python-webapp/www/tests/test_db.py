@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio, contextvars, threading, time, unittest
+from unittest import mock
+from transwarp import db, fakedb
+from transwarp.common import Row
+from tests.support import EngineTestCase
+
+class ConnectionPoolTest(EngineTestCase):
+
+	engine_kw = dict(pool_min_size=1, pool_max_size=2, pool_timeout=0.05)
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_warm_up_opens_min_size(self):
+		self.assertEqual(db.pool_stats()['size'], 1)
+
+	def test_connections_are_reused(self):
+		for i in range(5):
+			db.select('select * from user')
+		stats = db.pool_stats()
+		self.assertEqual(stats['created'], 1)
+		self.assertEqual(stats['checkouts'], 6)
+
+	def test_checkout_times_out_when_exhausted(self):
+		a, b = db.engine.connect(), db.engine.connect()
+		try:
+			with self.assertRaises(db.PoolTimeoutError):
+				db.engine.connect()
+			self.assertEqual(db.pool_stats()['timeouts'], 1)
+		finally:
+			db.engine.release(a)
+			db.engine.release(b)
+		self.assertEqual(db.pool_stats()['in_use'], 0)
+
+	def test_threads_share_bounded_pool(self):
+		errors = []
+		def work():
+			try:
+				for i in range(10):
+					db.select('select * from user')
+			except Exception as e:
+				errors.append(e)
+		db.engine._pool.timeout = 5.0
+		threads = [threading.Thread(target=work) for i in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(errors, [])
+		self.assertLessEqual(db.pool_stats()['created'], 2)
+
+	def test_release_rolls_back_open_transaction(self):
+		conn = db.engine.connect()
+		cursor = conn.cursor()
+		cursor.execute('insert into user (id, name) values (%s, %s)', (1, 'Alice'))
+		cursor.close()
+		db.engine.release(conn)
+		self.assertEqual(db.select('select * from user'), [])
+
+	def test_close_refuses_checkouts(self):
+		db.engine.close()
+		with self.assertRaises(db.DBError):
+			db.engine.connect()
+
+class RowTest(EngineTestCase):
+
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_rows_share_their_columns(self):
+		db.insert_many('user', [dict(id=1, name='Alice'), dict(id=2, name='Bob')])
+		a, b = db.select('select * from user order by id')
+		self.assertIsInstance(a, Row.Row)
+		self.assertIs(a._columns, b._columns)
+		self.assertEqual((a.id, a['name'], b.get('name'), b.get('nope', 0)), (1, 'Alice', 'Bob', 0))
+		with self.assertRaises(TypeError):
+			a['name'] = 'Eve'
+
+class QueryStatsTest(EngineTestCase):
+
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_normalize(self):
+		stats = db._QueryStats()
+		self.assertEqual(stats.normalize("select * from user where id=12 and name='a''b'"), 'select * from user where id=? and name=?')
+		self.assertEqual(stats.normalize('select * from user where id in (?,?, ?)'), 'select * from user where id in (?+)')
+		self.assertEqual(stats.normalize('insert into t (a,b) values (?,?),(?,?)'), 'insert into t (a,b) values (?+),...')
+
+	def test_bounded(self):
+		stats = db._QueryStats(max_statements=2, samples=4)
+		for i in range(10):
+			stats.record('select %d from a' % i, 0.1)
+			stats.record('select x from b%d' % i, 0.2)
+		L = stats.stats()
+		self.assertEqual(sorted([d['sql'] for d in L]), ['<other>', 'select ? from a', 'select x from b0'])
+		other = [d for d in L if d['sql'] == '<other>'][0]
+		self.assertEqual(other['calls'], 9)
+		self.assertAlmostEqual(other['p99'], 0.2)
+
+	def test_statements_are_recorded(self):
+		db.reset_query_stats()
+		db.insert_many('user', [dict(id=1, name='a'), dict(id=2, name='b')])
+		for i in range(3):
+			db.select('select * from user where id=?', i)
+		with self.assertRaises(Exception):
+			db.select('select * from nope')
+		stats = dict([(d['sql'], d) for d in db.query_stats()])
+		sel = stats['select * from user where id=?']
+		self.assertEqual((sel['calls'], sel['rows'], sel['errors']), (3, 2, 0))
+		self.assertEqual(stats['insert into `user` (`id`,`name`) values (?+),...']['affected'], 2)
+		self.assertEqual(stats['select * from nope']['errors'], 1)
+		self.assertLessEqual(sel['p50'], sel['max'])
+
+class PreparedStatementsTest(EngineTestCase):
+
+	engine_kw = dict(prepared_statements=True)
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_prepared_cursors_are_reused(self):
+		db.insert('user', id=1, name='Alice')
+		before = db.statement_cache_stats()
+		for i in range(3):
+			self.assertEqual(db.select_one('select * from user where id=?', 1).name, 'Alice')
+		after = db.statement_cache_stats()
+		self.assertEqual(after['prepared_misses'] - before['prepared_misses'], 1)
+		self.assertEqual(after['prepared_hits'] - before['prepared_hits'], 2)
+		self.assertEqual(db.select('select * from user where id=?', 2), [])
+
+	def test_unread_rows_are_drained_before_reuse(self):
+		db.insert('user', id=1, name='Alice')
+		db.insert('user', id=2, name='Bob')
+		before = db.statement_cache_stats()
+		for i in range(2):
+			self.assertIn(db.select_one('select * from user order by id').name, ('Alice', 'Bob'))
+		self.assertEqual(db.statement_cache_stats()['prepared_hits'] - before['prepared_hits'], 1)
+		self.assertEqual([r.name for r in db.select('select * from user order by id')], ['Alice', 'Bob'])
+
+	def test_falls_back_without_driver_support(self):
+		conn = db.engine.connect()
+		try:
+			with mock.patch.object(conn.raw, 'cursor', side_effect=NotImplementedError):
+				self.assertIsNone(conn.prepared_cursor('select 1'))
+		finally:
+			db.engine.release(conn)
+
+class InsertManyTest(EngineTestCase):
+
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_batches_by_rows_and_bytes(self):
+		rows = [dict(id=i, name='x' * 10) for i in range(5)]
+		self.assertEqual([len(args) for sql, args in db._insert_batches('user', rows, 2, None)], [4, 4, 2])
+		self.assertEqual(len(list(db._insert_batches('user', rows, None, 40))), 5)
+		self.assertEqual(db.insert_many('user', rows, max_rows=2), 5)
+		self.assertEqual(db.select_int('select count(*) from user'), 5)
+
+	def test_rows_must_have_the_same_columns(self):
+		with self.assertRaises(db.DBError):
+			db.insert_many('user', [dict(id=1, name='a'), dict(id=2)])
+
+	def test_empty(self):
+		self.assertEqual(db.insert_many('user', []), 0)
+
+class IterSelectTest(EngineTestCase):
+
+	tables = ('create table user (id int primary key, name text)',)
+
+	def setUp(self):
+		super(IterSelectTest, self).setUp()
+		db.insert_many('user', [dict(id=i, name='u%d' % i) for i in range(10)])
+
+	def test_yields_every_row(self):
+		self.assertEqual([u.id for u in db.iter_select('select * from user order by id', batch_size=3)], list(range(10)))
+		self.assertEqual(db.pool_stats()['in_use'], 0)
+
+	def test_holds_one_connection_until_closed(self):
+		it = db.iter_select('select * from user order by id', batch_size=3)
+		self.assertEqual(next(it).id, 0)
+		self.assertEqual(db.pool_stats()['in_use'], 1)
+		it.close()
+		stats = db.pool_stats()
+		self.assertEqual(stats['in_use'], 0)
+		# a connection with unread rows is dropped instead of drained:
+		self.assertEqual(stats['closed'], 1)
+
+	def test_reads_through_the_transaction(self):
+		with db.transaction():
+			db.insert('user', id=10, name='uncommitted')
+			ids = [u.id for u in db.iter_select('select id from user where id>=?', 8, batch_size=1)]
+		self.assertEqual(ids, [8, 9, 10])
+
+_var = contextvars.ContextVar('test_db_var', default=None)
+
+class AsyncBridgeTest(EngineTestCase):
+
+	tables = ('create table user (id int primary key, name text)',)
+
+	def test_runs_off_the_loop_thread(self):
+		def work():
+			return threading.current_thread(), _var.get()
+		@asyncio.coroutine
+		def main():
+			_var.set('request')
+			return (yield from db.run_async(work))
+		thread, value = self.wait(main())
+		self.assertIsNot(thread, threading.current_thread())
+		self.assertEqual(value, 'request')
+
+	def test_awaitable_statements(self):
+		self.assertEqual(self.wait(db.insert_async('user', id=1, name='Alice')), 1)
+		self.assertEqual(self.wait(db.insert_many_async('user', [dict(id=2, name='Bob'), dict(id=3, name='Eve')])), 2)
+		self.assertEqual(self.wait(db.update_async('update user set name=? where id=?', 'Ada', 1)), 1)
+		self.assertEqual(self.wait(db.select_one_async('select name from user where id=?', 1)).name, 'Ada')
+		self.assertEqual(self.wait(db.select_int_async('select count(*) from user')), 3)
+		self.assertEqual([u.id for u in self.wait(db.select_async('select id from user order by id'))], [1, 2, 3])
+
+	def test_concurrent_calls_do_not_block_the_loop(self):
+		db.close_engine()
+		db.create_engine('test', 'test', self.database + 'slow', engine='fake_mysql', fake_latency=0.05, pool_max_size=10)
+		start = time.time()
+		self.wait(asyncio.gather(*[db.select_int_async('select 1') for i in range(10)]))
+		self.assertLess(time.time() - start, 0.5)
+
+	def test_transaction_async(self):
+		def transfer(fail):
+			db.insert('user', id=10, name='tx')
+			if fail:
+				raise ValueError('rollback')
+		with self.assertRaises(ValueError):
+			self.wait(db.transaction_async(transfer, True))
+		self.assertEqual(db.select_int('select count(*) from user'), 0)
+		self.wait(db.transaction_async(transfer, False))
+		self.assertEqual(db.select_int('select count(*) from user'), 1)
+
+class CreateEngineTest(unittest.TestCase):
+
+	def tearDown(self):
+		db.close_engine()
+
+	def test_failed_warm_up_leaves_no_engine(self):
+		with mock.patch.object(fakedb, 'connect', side_effect=db.DBError('no server')):
+			with self.assertRaises(db.DBError):
+				db.create_engine('test', 'test', 'create_engine', engine='fake_mysql')
+		self.assertIsNone(db.engine)
+		db.create_engine('test', 'test', 'create_engine', engine='fake_mysql')
+		self.assertEqual(db.select_int('select 1'), 1)
+
+	def test_removed_statement_cache_size_is_accepted(self):
+		db.create_engine('test', 'test', 'create_engine', engine='fake_mysql', statement_cache_size=10)
+		self.assertEqual(db.select_int('select count(*) from (select ? as a)', 1), 1)
+
+	def test_engine_is_created_once(self):
+		db.create_engine('test', 'test', 'create_engine', engine='fake_mysql')
+		with self.assertRaises(db.DBError):
+			db.create_engine('test', 'test', 'create_engine', engine='fake_mysql')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Run the doctests of the modules that need no database server.
+'''
+
+import doctest, unittest
+from transwarp import fakedb, log
+from transwarp.common import Dict, Row
+
+def load_tests(loader, tests, ignore):
+	for module in (Dict, Row, fakedb, log):
+		tests.addTests(doctest.DocTestSuite(module))
+	return tests
+
+if __name__ == '__main__':
+	unittest.main()
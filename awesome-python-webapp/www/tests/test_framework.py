@@ -0,0 +1,736 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio, datetime, decimal, gzip, http.client, json, os, signal, socket, subprocess, sys, tempfile, threading, time, unittest
+from unittest import mock
+from jinja2 import DictLoader, Environment
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import framework
+from transwarp import db
+from transwarp.common import Row
+from tests.support import ServerTestCase
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+@framework.get('/blog/{id}')
+def get_blog(id):
+	return dict(id=id)
+
+class RouteTableTest(ServerTestCase):
+
+	routes = (get_blog,)
+
+	def test_path_arguments(self):
+		status, headers, body = self.request('GET', '/blog/7')
+		self.assertEqual(status, 200)
+		self.assertEqual(json.loads(body.decode('utf-8')), dict(id='7'))
+
+	def test_not_found_goes_through_the_middlewares(self):
+		status, headers, body = self.request('GET', '/missing')
+		self.assertEqual(status, 404)
+
+	def test_swap_under_load_loses_no_request(self):
+		results, errors, stop = [], [], threading.Event()
+		def client():
+			conn = self.connect()
+			try:
+				while not stop.is_set():
+					status, headers, body = self.request('GET', '/blog/1', conn=conn)
+					results.append((status, json.loads(body.decode('utf-8'))))
+			except Exception as e:
+				errors.append(e)
+			finally:
+				conn.close()
+		threads = [threading.Thread(target=client) for i in range(4)]
+		for t in threads:
+			t.start()
+		for i in range(50):
+			@framework.get('/added/%d' % i)
+			def added(i=i):
+				return dict(added=i)
+			framework.add_route(added)
+			time.sleep(0.005)
+		stop.set()
+		for t in threads:
+			t.join(10)
+		self.assertEqual(errors, [])
+		self.assertTrue(len(results) > 50)
+		self.assertEqual([r for r in results if r != (200, dict(id='1'))], [])
+		status, headers, body = self.request('GET', '/added/49')
+		self.assertEqual((status, json.loads(body.decode('utf-8'))), (200, dict(added=49)))
+
+_cancelled = []
+
+@framework.get('/sleep/{seconds}')
+@asyncio.coroutine
+def sleep(seconds):
+	try:
+		yield from asyncio.sleep(float(seconds))
+	except asyncio.CancelledError:
+		_cancelled.append(seconds)
+		raise
+	return dict(slept=seconds)
+
+# what the handlers raised, see record_errors():
+_errors = []
+
+@asyncio.coroutine
+def record_errors(app, handler):
+	@asyncio.coroutine
+	def record(request):
+		try:
+			return (yield from handler(request))
+		except BaseException as e:
+			_errors.append(e)
+			raise
+	return record
+
+@framework.get('/fail/{kind}')
+def fail(kind):
+	if kind == 'api':
+		raise framework.APIError('value:invalid', 'email', 'Invalid email.')
+	raise ValueError(kind)
+
+class ShutdownTest(ServerTestCase):
+
+	routes = (get_blog, sleep, fail)
+
+	def test_handler_errors(self):
+		status, headers, body = self.request('GET', '/fail/api')
+		self.assertEqual(status, 200)
+		self.assertEqual(json.loads(body.decode('utf-8')), dict(error='value:invalid', data='email', message='Invalid email.'))
+		self.assertEqual(self.request('GET', '/fail/other')[0], 500)
+		self.assertEqual([type(e) for e in _errors], [ValueError])
+
+	def setUp(self):
+		del _cancelled[:]
+		del _errors[:]
+		self.hooks = []
+		framework.add_startup_hook(self.started)
+		framework.add_shutdown_hook(self.stopped)
+		framework.add_middleware(record_errors)
+		super(ShutdownTest, self).setUp()
+
+	def tearDown(self):
+		super(ShutdownTest, self).tearDown()
+		framework._middleware.remove(record_errors)
+		framework._startup_hooks.remove(self.started)
+		framework._shutdown_hooks.remove(self.stopped)
+
+	def started(self):
+		self.hooks.append('start')
+
+	def stopped(self):
+		self.hooks.append('stop')
+
+	def background(self, path):
+		' request path in a thread, return the thread and the list that gets its result. '
+		result = []
+		def run():
+			try:
+				result.append(self.request('GET', path)[0])
+			except Exception as e:
+				result.append(e)
+		t = threading.Thread(target=run)
+		t.start()
+		self.wait_until(lambda: framework._inflight)
+		return t, result
+
+	def test_stop_from_another_thread(self):
+		framework.stop()
+		self.thread.join(5)
+		self.assertFalse(self.thread.is_alive())
+		self.assertEqual(self.hooks, ['start', 'stop'])
+
+	def test_request_in_flight_is_drained(self):
+		t, result = self.background('/sleep/0.3')
+		framework.stop()
+		t.join(5)
+		self.thread.join(5)
+		self.assertEqual(result, [200])
+		self.assertEqual(_cancelled, [])
+
+	def test_request_past_timeout_is_cancelled(self):
+		t, result = self.background('/sleep/30')
+		start = time.time()
+		framework.stop()
+		self.thread.join(10)
+		t.join(5)
+		self.assertFalse(self.thread.is_alive())
+		self.assertLess(time.time() - start, self.shutdown_timeout + 2)
+		self.assertEqual(_cancelled, ['30'])
+		self.assertEqual([type(e) for e in _errors], [asyncio.CancelledError])
+		self.assertNotEqual(result, [200])
+
+	def test_restart_serves_again(self):
+		framework.restart()
+		self.wait_until(lambda: self.hooks == ['start', 'stop', 'start'] and framework._isrun)
+		self.assertEqual(self.request('GET', '/blog/2')[0], 200)
+		self.assertTrue(self.thread.is_alive())
+
+class EngineRestartTest(ServerTestCase):
+	'''
+	The startup hook opens an engine unless one is open, as app.py does, and records it.
+	'''
+	routes = (sleep,)
+	# create the engine before the server starts, not in the startup hook:
+	engine_before_start = False
+
+	def setUp(self):
+		self.engines = []
+		if self.engine_before_start:
+			self.create_engine()
+		framework.add_startup_hook(self.open_engine)
+		super(EngineRestartTest, self).setUp()
+
+	def tearDown(self):
+		super(EngineRestartTest, self).tearDown()
+		framework._startup_hooks.remove(self.open_engine)
+		db.close_engine()
+
+	def create_engine(self):
+		db.create_engine('test', 'test', 'test_engine_restart', engine='fake_mysql')
+		db.update('create table tag (name text)')
+
+	def open_engine(self):
+		if db.engine is None:
+			self.create_engine()
+		self.engines.append(db.engine)
+
+	def restart(self):
+		n = len(self.engines)
+		framework.restart()
+		self.wait_until(lambda: len(self.engines) > n and framework._isrun)
+
+	def commit(self, name):
+		with db.transaction():
+			db.insert('tag', name=name)
+		return db.select_int('select count(*) from tag where name=?', name)
+
+	def test_restart_after_cut_off_request_commits(self):
+		t = threading.Thread(target=lambda: self.request('GET', '/sleep/30'))
+		t.start()
+		self.wait_until(lambda: framework._inflight)
+		self.restart()
+		t.join(5)
+		if self.engine_before_start:
+			self.assertIs(self.engines[1], self.engines[0])
+		else:
+			self.assertIsNot(self.engines[1], self.engines[0])
+		self.assertIs(db.engine, self.engines[1])
+		self.assertEqual(self.commit('after'), 1)
+
+class EngineBeforeStartRestartTest(EngineRestartTest):
+
+	engine_before_start = True
+
+@framework.get('/posts/{n}', cache=dict(ttl=60))
+def posts(n):
+	return dict(page=1, posts=[dict(id=i, title='post %d' % i) for i in range(int(n))])
+
+@framework.get('/numbers')
+def numbers():
+	return dict(numbers=(i for i in range(3000)))
+
+class JsonEncodingTest(unittest.TestCase):
+
+	def setUp(self):
+		self._saved = framework._json_dumps
+
+	def tearDown(self):
+		framework._json_dumps = self._saved
+
+	def test_default(self):
+		row = Row.Row(Row.Columns(['id', 'name']), (1, 'Alice'))
+		obj = dict(row=row, price=decimal.Decimal('1.5'), day=datetime.date(2015, 5, 1), tags={'a'}, raw=b'x')
+		expected = dict(row=dict(id=1, name='Alice'), price=1.5, day='2015-05-01', tags=['a'], raw='x')
+		for encoder in ('json', 'orjson'):
+			framework.configure_json(encoder)
+			self.assertEqual(json.loads(framework._json_dumps(obj).decode('utf-8')), expected)
+
+	def test_missing_encoder_falls_back_to_json(self):
+		def missing():
+			raise ImportError('missing')
+		with mock.patch.dict(framework._json_encoders, ujson=missing):
+			framework.configure_json('ujson')
+		self.assertIs(framework._json_dumps, framework._dumps_json)
+
+	def test_stream_key(self):
+		self.assertEqual(framework._stream_key(dict(page=1, items=list(range(10)))), None)
+		self.assertEqual(framework._stream_key(dict(page=1, items=list(range(framework._json_stream_threshold)))), 'items')
+		self.assertEqual(framework._stream_key(dict(page=1, items=iter([]))), 'items')
+
+class JsonResponseTest(ServerTestCase):
+
+	routes = (posts, numbers)
+
+	def setUp(self):
+		super(JsonResponseTest, self).setUp()
+		framework.configure_cache()
+
+	def get(self, path):
+		status, headers, body = self.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+		self.assertEqual(status, 200)
+		if headers.get('Content-Encoding') == 'gzip':
+			body = gzip.decompress(body)
+		return headers, json.loads(body.decode('utf-8'))
+
+	def test_short_list_is_one_compressed_body(self):
+		headers, d = self.get('/posts/100')
+		self.assertEqual(len(d['posts']), 100)
+		self.assertEqual(headers.get('Content-Encoding'), 'gzip')
+		self.assertIsNotNone(headers.get('Content-Length'))
+
+	def test_long_list_is_streamed(self):
+		n = framework._json_stream_threshold + framework._JSON_CHUNK + 1
+		headers, d = self.get('/posts/%d' % n)
+		self.assertEqual(d, posts(n))
+		self.assertEqual(headers.get('Transfer-Encoding'), 'chunked')
+		# streamed responses skip compression and the response cache:
+		self.assertIsNone(headers.get('Content-Encoding'))
+		entries = framework.cache_stats()['entries']
+		self.get('/posts/%d' % n)
+		self.assertEqual(framework.cache_stats()['entries'], entries)
+
+	def test_iterator_is_streamed(self):
+		headers, d = self.get('/numbers')
+		self.assertEqual(d, dict(numbers=list(range(3000))))
+		self.assertEqual(headers.get('Transfer-Encoding'), 'chunked')
+
+_TEMPLATES = dict(page='<h1>{{ title }}</h1>{% for i in items %}<p>{{ i }}</p>{% endfor %}')
+
+@framework.get('/page/{n}')
+def page(n):
+	return {'__template__': 'page', 'title': 'Page', 'items': range(int(n))}
+
+@framework.get('/stream/{n}')
+def stream(n):
+	return {'__template__': 'page', '__stream__': True, 'title': 'Page', 'items': range(int(n))}
+
+class TemplateTest(ServerTestCase):
+
+	routes = (page, stream)
+
+	def setUp(self):
+		framework.add_template(Environment(loader=DictLoader(_TEMPLATES)))
+		framework._template_stats.clear()
+		super(TemplateTest, self).setUp()
+
+	def tearDown(self):
+		super(TemplateTest, self).tearDown()
+		framework._template = None
+
+	def test_render(self):
+		status, headers, body = self.request('GET', '/page/2')
+		self.assertEqual((status, body), (200, b'<h1>Page</h1><p>0</p><p>1</p>'))
+		self.assertEqual(headers['Content-Type'], 'text/html;charset=utf-8')
+
+	def test_stream_renders_the_same_page_in_chunks(self):
+		n = 5000
+		status, headers, streamed = self.request('GET', '/stream/%d' % n)
+		self.assertEqual(status, 200)
+		self.assertEqual(headers.get('Transfer-Encoding'), 'chunked')
+		self.assertGreater(len(streamed), framework._RENDER_CHUNK)
+		self.assertEqual(streamed, self.request('GET', '/page/%d' % n)[2])
+
+	def test_template_stats(self):
+		for i in range(3):
+			self.request('GET', '/page/1')
+		self.request('GET', '/stream/1')
+		# a streamed render is recorded after the last chunk is sent:
+		self.wait_until(lambda: framework.template_stats()[0]['renders'] == 4)
+		stats = framework.template_stats()
+		self.assertEqual([d['template'] for d in stats], ['page'])
+		self.assertGreaterEqual(stats[0]['max'], stats[0]['mean'])
+
+@framework.get('/tags', cache=dict(ttl=60, depends=['tag']))
+def tags():
+	return dict(tags=[x.name for x in db.select('select name from tag order by name')])
+
+@framework.get('/page', cache=dict(ttl=60))
+def cached_page():
+	r = web.Response(body=b'<p>page</p>' * 200, reason='Fresh', content_type='text/html')
+	r.headers['Cache-Control'] = 'public, max-age=60'
+	r.headers['Expires'] = 'Thu, 01 Jan 2037 00:00:00 GMT'
+	r.headers['Vary'] = 'Accept-Language'
+	r.headers['Link'] = '</a.css>; rel=preload'
+	return r
+
+_searches = []
+
+@framework.get('/search', cache=dict(ttl=60))
+def search(*, q):
+	_searches.append(q)
+	return dict(q=q)
+
+@framework.get('/latest', cache=dict(ttl=60, vary_query=False))
+def latest(*, q=''):
+	_searches.append(q)
+	return dict(q=q)
+
+class CachedResponseTest(unittest.TestCase):
+
+	def test_stores_end_to_end_headers(self):
+		r = web.Response(body=b'x' * 2000, content_type='text/html')
+		for k, v in (('Cache-Control', 'max-age=60'), ('Link', '</a.css>'), ('Connection', 'X-Hop'), ('X-Hop', '1'),
+				('Keep-Alive', 'timeout=5'), ('Transfer-Encoding', 'chunked'), ('Content-Length', '2000'), ('ETag', '"old"'), ('Vary', 'Accept-Language')):
+			r.headers[k] = v
+		entry = framework._CachedResponse(r, framework._CachePolicy(vary_cookie='session'))
+		self.assertEqual(sorted(k for k, v in entry.headers), ['Cache-Control', 'Content-Type', 'Link', 'Vary'])
+		self.assertEqual(entry.vary, 'Accept-Language, Cookie, Accept-Encoding')
+
+class ResponseCacheTest(ServerTestCase):
+
+	routes = (tags, cached_page, search, latest)
+
+	def setUp(self):
+		framework.invalidate_cache()
+		db.create_engine('test', 'test', 'test_response_cache', engine='fake_mysql')
+		db.update('create table tag (name text)')
+		db.update('insert into tag (name) values (?)', 'a')
+		super(ResponseCacheTest, self).setUp()
+
+	def tearDown(self):
+		super(ResponseCacheTest, self).tearDown()
+		# the server leaves open the engine it did not create:
+		self.assertIsNotNone(db.engine)
+		db.close_engine()
+
+	def get(self, path, method='GET', **headers):
+		c = self.connect()
+		try:
+			c.request(method, path, headers=headers)
+			r = c.getresponse()
+			return r, r.read()
+		finally:
+			c.close()
+
+	def test_miss_sends_the_handler_response(self):
+		r, body = self.get('/page')
+		self.assertEqual((r.status, r.reason), (200, 'Fresh'))
+		hit, hit_body = self.get('/page')
+		self.assertEqual((hit.status, hit.reason), (200, 'OK'))
+		self.assertEqual(hit_body, body)
+		for name in ('ETag', 'Cache-Control', 'Expires', 'Vary', 'Link', 'Content-Type'):
+			self.assertEqual(hit.getheader(name), r.getheader(name))
+		self.assertEqual(r.getheader('Vary'), 'Accept-Language, Accept-Encoding')
+
+	def test_head_shares_the_entry_of_get(self):
+		del _searches[:]
+		miss, body = self.get('/search?q=h', method='HEAD')
+		self.assertEqual((miss.status, body), (200, b''))
+		r, body = self.get('/search?q=h')
+		self.assertEqual(json.loads(body.decode('utf-8')), dict(q='h'))
+		self.assertEqual(_searches, ['h'])
+		hit, hit_body = self.get('/page', method='HEAD')
+		r, body = self.get('/page')
+		for head in (hit, self.get('/page', method='HEAD')[0]):
+			self.assertEqual((head.status, head.read()), (200, b''))
+			for name in ('ETag', 'Cache-Control', 'Vary', 'Link', 'Content-Type', 'Content-Length'):
+				self.assertEqual(head.getheader(name), r.getheader(name))
+		self.assertEqual(int(r.getheader('Content-Length')), len(body))
+		self.assertEqual(self.get('/page', method='HEAD', **{'If-None-Match': r.getheader('ETag')})[0].status, 304)
+
+	def test_compressed_miss_and_hit(self):
+		r, body = self.get('/page', **{'Accept-Encoding': 'gzip'})
+		hit, hit_body = self.get('/page', **{'Accept-Encoding': 'gzip'})
+		self.assertEqual(r.getheader('Content-Encoding'), 'gzip')
+		self.assertEqual(gzip.decompress(body), b'<p>page</p>' * 200)
+		self.assertEqual((hit_body, hit.getheader('ETag')), (body, r.getheader('ETag')))
+		self.assertNotEqual(r.getheader('ETag'), self.get('/page')[0].getheader('ETag'))
+
+	def test_not_modified_repeats_caching_headers(self):
+		etag = self.get('/page')[0].getheader('ETag')
+		for i in range(2):
+			r, body = self.get('/page', **{'If-None-Match': etag})
+			self.assertEqual((r.status, body), (304, b''))
+			self.assertEqual(r.getheader('ETag'), etag)
+			self.assertEqual(r.getheader('Cache-Control'), 'public, max-age=60')
+			self.assertEqual(r.getheader('Expires'), 'Thu, 01 Jan 2037 00:00:00 GMT')
+			self.assertEqual(r.getheader('Vary'), 'Accept-Language, Accept-Encoding')
+			self.assertIsNone(r.getheader('Link'))
+
+	def test_query_string(self):
+		del _searches[:]
+		for q in ('a', 'b', 'a'):
+			self.assertEqual(json.loads(self.get('/search?q=%s' % q)[1].decode('utf-8')), dict(q=q))
+		self.assertEqual(_searches, ['a', 'b'])
+		del _searches[:]
+		for q in ('a', 'b'):
+			self.assertEqual(json.loads(self.get('/latest?q=%s' % q)[1].decode('utf-8')), dict(q='a'))
+		self.assertEqual(_searches, ['a'])
+
+	def tag_names(self):
+		return json.loads(self.get('/tags')[1].decode('utf-8'))['tags']
+
+	def test_invalidation_waits_for_commit(self):
+		self.assertEqual(self.tag_names(), ['a'])
+		with db.transaction():
+			db.update('insert into tag (name) values (?)', 'b')
+			invalidations = framework.cache_stats()['invalidations']
+			# served from the cache, a miss would read the committed rows only:
+			self.assertEqual(self.tag_names(), ['a'])
+			self.assertEqual(framework.cache_stats()['invalidations'], invalidations)
+		self.assertEqual(framework.cache_stats()['invalidations'], invalidations + 1)
+		self.assertEqual(self.tag_names(), ['a', 'b'])
+
+	def test_rollback_keeps_the_cache(self):
+		self.assertEqual(self.tag_names(), ['a'])
+		invalidations = framework.cache_stats()['invalidations']
+		with self.assertRaises(ValueError):
+			with db.transaction():
+				db.update('insert into tag (name) values (?)', 'b')
+				raise ValueError('rollback')
+		self.assertEqual(framework.cache_stats()['invalidations'], invalidations)
+		self.assertEqual(self.tag_names(), ['a'])
+
+_TEXT = '<p>compress me</p>' * 200
+
+@framework.get('/text/{n}')
+def text(n):
+	return _TEXT[:int(n)]
+
+@framework.get('/binary')
+def binary():
+	return _TEXT.encode('utf-8')
+
+@framework.get('/encoded')
+def encoded():
+	r = web.Response(body=gzip.compress(_TEXT.encode('utf-8')), content_type='text/html')
+	r.headers['Content-Encoding'] = 'gzip'
+	return r
+
+@unittest.skipIf(brotli is None, 'brotli is not installed')
+class AcceptEncodingTest(unittest.TestCase):
+
+	def setUp(self):
+		framework.configure_compression()
+
+	def accepted(self, header):
+		return framework._accepted_encoding(make_mocked_request('GET', '/', headers={'Accept-Encoding': header}))
+
+	def test_negotiation(self):
+		self.assertEqual(framework._accepted_encodings(make_mocked_request('GET', '/', headers={'Accept-Encoding': 'gzip;q=0, BR, deflate;q=0.5'})), {'br', 'deflate'})
+		self.assertEqual(self.accepted('gzip, deflate, br'), 'br')
+		self.assertEqual(self.accepted('gzip;q=1.0, br;q=0'), 'gzip')
+		self.assertEqual(self.accepted('*'), 'br')
+		self.assertEqual(self.accepted('identity'), None)
+		self.assertEqual(framework._accepted_encoding(make_mocked_request('GET', '/')), None)
+
+class CompressionTest(ServerTestCase):
+
+	routes = (text, binary, encoded)
+
+	def tearDown(self):
+		super(CompressionTest, self).tearDown()
+		framework.configure_compression(threshold=1024, encodings=('br', 'gzip'), executor_threshold=128 * 1024)
+
+	def get(self, path, accept):
+		status, headers, body = self.request('GET', path, headers={'Accept-Encoding': accept})
+		self.assertEqual(status, 200)
+		return headers.get('Content-Encoding'), headers.get('Vary'), body
+
+	@unittest.skipIf(brotli is None, 'brotli is not installed')
+	def test_encodings(self):
+		n = len(_TEXT)
+		encoding, vary, body = self.get('/text/%d' % n, 'gzip, br')
+		self.assertEqual((encoding, vary, brotli.decompress(body)), ('br', 'Accept-Encoding', _TEXT.encode('utf-8')))
+		encoding, vary, body = self.get('/text/%d' % n, 'gzip')
+		self.assertEqual((encoding, vary, gzip.decompress(body)), ('gzip', 'Accept-Encoding', _TEXT.encode('utf-8')))
+		self.assertEqual(self.get('/text/%d' % n, 'identity'), (None, 'Accept-Encoding', _TEXT.encode('utf-8')))
+
+	def test_small_and_binary_bodies_are_not_compressed(self):
+		self.assertEqual(self.get('/text/100', 'gzip'), (None, None, _TEXT[:100].encode('utf-8')))
+		self.assertEqual(self.get('/binary', 'gzip'), (None, None, _TEXT.encode('utf-8')))
+
+	def test_encoded_response_is_sent_as_is(self):
+		encoding, vary, body = self.get('/encoded', 'gzip, br')
+		self.assertEqual((encoding, gzip.decompress(body)), ('gzip', _TEXT.encode('utf-8')))
+
+	def test_configure(self):
+		framework.configure_compression(threshold=10, encodings=('gzip',), executor_threshold=1)
+		encoding, vary, body = self.get('/text/100', 'br, gzip')
+		self.assertEqual((encoding, gzip.decompress(body)), ('gzip', _TEXT[:100].encode('utf-8')))
+		framework.configure_compression(encodings=())
+		self.assertEqual(self.get('/text/100', 'br, gzip')[0], None)
+
+_CSS = b'body { color: black; }\n' * 100
+
+class StaticFilesTest(ServerTestCase):
+
+	def setUp(self):
+		super(StaticFilesTest, self).setUp()
+		self.tmp = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmp.name, 'static')
+		os.mkdir(self.root)
+		for name, body in (('app.css', _CSS), ('big.bin', os.urandom(5000)), ('pre.js', b'var a = 1;' * 200), ('pre.js.gz', b'not really gzip')):
+			self.write(name, body)
+		framework.add_static(self.tmp.name, small_max=4096)
+
+	def tearDown(self):
+		super(StaticFilesTest, self).tearDown()
+		framework._static = None
+		self.tmp.cleanup()
+
+	def write(self, name, body):
+		with open(os.path.join(self.root, name), 'wb') as f:
+			f.write(body)
+
+	def get(self, path, **headers):
+		return self.request('GET', path, headers=headers)
+
+	def test_small_file_and_conditional_requests(self):
+		status, headers, body = self.get('/static/app.css')
+		self.assertEqual((status, body), (200, _CSS))
+		self.assertEqual(headers['Content-Type'], 'text/css')
+		self.assertEqual(headers['Cache-Control'], 'public, max-age=3600')
+		etag, last_modified = headers['ETag'], headers['Last-Modified']
+		self.assertEqual(self.get('/static/app.css', **{'If-None-Match': etag})[0], 304)
+		self.assertEqual(self.get('/static/app.css', **{'If-Modified-Since': last_modified})[0], 304)
+		self.assertEqual(self.get('/static/missing.css')[0], 404)
+
+	def test_changed_file_is_read_again(self):
+		etag = self.get('/static/app.css')[1]['ETag']
+		self.write('app.css', b'p {}')
+		st = os.stat(os.path.join(self.root, 'app.css'))
+		os.utime(os.path.join(self.root, 'app.css'), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+		status, headers, body = self.get('/static/app.css', **{'If-None-Match': etag})
+		self.assertEqual((status, body), (200, b'p {}'))
+
+	def test_compression(self):
+		status, headers, body = self.get('/static/app.css', **{'Accept-Encoding': 'gzip'})
+		self.assertEqual((headers['Content-Encoding'], headers['Vary']), ('gzip', 'Accept-Encoding'))
+		self.assertEqual(gzip.decompress(body), _CSS)
+		# the .gz sibling is sent as it is:
+		status, headers, body = self.get('/static/pre.js', **{'Accept-Encoding': 'gzip, br'})
+		self.assertEqual((headers['Content-Encoding'], body), ('gzip', b'not really gzip'))
+
+	def test_big_file_and_range(self):
+		with open(os.path.join(self.root, 'big.bin'), 'rb') as f:
+			data = f.read()
+		status, headers, body = self.get('/static/big.bin')
+		self.assertEqual((status, body), (200, data))
+		status, headers, body = self.get('/static/big.bin', Range='bytes=10-19')
+		self.assertEqual((status, body), (206, data[10:20]))
+
+	def test_fingerprinted_url(self):
+		url = framework.static_url('app.css')
+		self.assertRegex(url, r'^/static/app\.[0-9a-f]{12}\.css$')
+		status, headers, body = self.get(url)
+		self.assertEqual((status, body), (200, _CSS))
+		self.assertEqual(headers['Cache-Control'], 'public, max-age=31536000, immutable')
+		status, headers, body = self.get('/static/app.000000000000.css')
+		self.assertEqual((status, headers['Cache-Control']), (200, 'public, max-age=3600'))
+		self.assertEqual(framework.static_url('missing.css'), '/static/missing.css')
+
+	def test_path_outside_root(self):
+		self.assertIsNone(framework._static._path('../secret'))
+		self.assertEqual(self.get('/static/%2e%2e/secret')[0], 404)
+
+_PREFORK = '''
+import os, sys
+import framework
+
+@framework.get('/pid')
+def pid():
+	return dict(pid=os.getpid())
+
+framework.init('127.0.0.1', int(sys.argv[1]))
+framework.add_route(pid)
+framework.start(workers=2, shutdown_timeout=1.0)
+'''
+
+class PreforkTest(unittest.TestCase):
+
+	def setUp(self):
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			self.port = s.getsockname()[1]
+		www = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		self.master = subprocess.Popen([sys.executable, '-c', _PREFORK, str(self.port)], cwd=www, stderr=subprocess.DEVNULL)
+		self.workers = self.wait_workers(lambda pids: len(pids) == 2)
+
+	def tearDown(self):
+		if self.master.poll() is None:
+			self.master.terminate()
+		self.master.wait(10)
+		for pid in self.children() | self.workers:
+			try:
+				os.kill(pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+
+	def children(self):
+		try:
+			with open('/proc/%d/task/%d/children' % (self.master.pid, self.master.pid)) as f:
+				return set(int(x) for x in f.read().split())
+		except OSError:
+			return set()
+
+	def wait_workers(self, ready):
+		deadline = time.time() + 10
+		while time.time() < deadline:
+			pids = self.children()
+			if ready(pids):
+				return pids
+			time.sleep(0.05)
+		self.fail('Workers not ready: %s' % self.children())
+
+	def get_pid(self):
+		c = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+		try:
+			c.request('GET', '/pid')
+			r = c.getresponse()
+			self.assertEqual(r.status, 200)
+			return json.loads(r.read().decode('utf-8'))['pid']
+		finally:
+			c.close()
+
+	def test_workers_serve(self):
+		pids = set(self.get_pid() for i in range(10))
+		self.assertTrue(pids <= self.workers)
+
+	def test_dead_worker_is_replaced(self):
+		pid = self.get_pid()
+		os.kill(pid, signal.SIGKILL)
+		pids = self.wait_workers(lambda pids: len(pids) == 2 and pid not in pids)
+		self.assertIn(self.get_pid(), pids)
+
+	def test_rolling_restart(self):
+		os.kill(self.master.pid, signal.SIGHUP)
+		pids = self.wait_workers(lambda pids: len(pids) == 2 and not pids & self.workers)
+		self.assertIn(self.get_pid(), pids)
+
+	def test_workers_stop_when_the_master_is_killed(self):
+		self.master.kill()
+		self.master.wait(10)
+		deadline = time.time() + 10
+		while time.time() < deadline and self.alive(self.workers):
+			time.sleep(0.1)
+		self.assertEqual(self.alive(self.workers), set())
+
+	def alive(self, pids):
+		L = set()
+		for pid in pids:
+			try:
+				with open('/proc/%d/stat' % pid) as f:
+					# a zombie waits for init to reap it, it serves no more:
+					if f.read().rsplit(')', 1)[1].split()[0] != 'Z':
+						L.add(pid)
+			except OSError:
+				pass
+		return L
+
+	def test_sigterm_stops_all(self):
+		os.kill(self.master.pid, signal.SIGTERM)
+		self.assertEqual(self.master.wait(10), 0)
+		for pid in self.workers:
+			with self.assertRaises(ProcessLookupError):
+				os.kill(pid, 0)
+
+if __name__ == '__main__':
+	unittest.main()
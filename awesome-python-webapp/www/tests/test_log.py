@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib, io, logging, unittest
+from transwarp import benchmark, db, log
+
+class _Arg(str):
+	' A str argument that counts how often it is formatted. '
+	formatted = 0
+
+	def __str__(self):
+		self.formatted = self.formatted + 1
+		return 'arg'
+
+	__repr__ = __str__
+
+class _Records(logging.Handler):
+	def __init__(self):
+		super(_Records, self).__init__()
+		self.records = []
+
+	def emit(self, record):
+		self.records.append(record)
+
+class LogTestCase(unittest.TestCase):
+	'''
+	Save and restore the levels and samplers touched by log.configure().
+	'''
+	names = ('transwarp.db', 'transwarp.sql', 'framework.request', 'framework.access')
+
+	def setUp(self):
+		root = logging.getLogger()
+		self._saved = (root.level, [logging.getLogger(name).level for name in self.names], log.sampler('framework.request').every)
+		self.handler = _Records()
+		root.addHandler(self.handler)
+
+	def tearDown(self):
+		root = logging.getLogger()
+		root.removeHandler(self.handler)
+		root.setLevel(self._saved[0])
+		for name, level in zip(self.names, self._saved[1]):
+			logging.getLogger(name).setLevel(level)
+		log.sampler('framework.request').every = self._saved[2]
+
+class ConfigureTest(LogTestCase):
+
+	def test_levels_by_name_and_number(self):
+		log.configure(level='warning', levels={'transwarp.sql': 'INFO', 'transwarp.db': logging.ERROR})
+		self.assertEqual(logging.getLogger().level, logging.WARNING)
+		self.assertEqual(logging.getLogger('transwarp.sql').level, logging.INFO)
+		self.assertEqual(logging.getLogger('transwarp.db').level, logging.ERROR)
+
+	def test_sampler_is_shared(self):
+		log.configure(sample={'framework.request': 4})
+		s = log.sampler('framework.request')
+		self.assertIs(s, log.sampler('framework.request'))
+		self.assertEqual(s.every, 4)
+		self.assertEqual(sum(s() for i in range(40)), 10)
+
+	def test_fields_are_formatted_when_emitted(self):
+		arg = _Arg('arg')
+		fields = log.Fields(path=arg)
+		log.configure(levels={'framework.access': 'WARNING'})
+		log.get_logger('framework.access').info('%s', fields)
+		self.assertEqual(arg.formatted, 0)
+		log.configure(levels={'framework.access': 'INFO'})
+		log.get_logger('framework.access').info('%s', fields)
+		self.assertEqual(self.handler.records[-1].getMessage(), 'path=arg')
+		self.assertTrue(arg.formatted)
+
+class SqlLogTest(LogTestCase):
+
+	def setUp(self):
+		super(SqlLogTest, self).setUp()
+		db.create_engine('test', 'test', 'test_log', engine='fake_mysql')
+		db.update('create table t (id int primary key, name text)')
+
+	def tearDown(self):
+		db.close_engine()
+		super(SqlLogTest, self).tearDown()
+
+	def test_disabled_sql_log_skips_formatting(self):
+		arg = _Arg('arg')
+		log.configure(level='INFO', levels={'transwarp.sql': 'WARNING'})
+		db.select('select * from t where name=?', arg)
+		self.assertEqual(arg.formatted, 0)
+		self.assertFalse([r for r in self.handler.records if r.name == 'transwarp.sql'])
+
+	def test_enabled_sql_log(self):
+		log.configure(level='INFO', levels={'transwarp.sql': 'INFO'})
+		db.select('select * from t where name=?', 'Alice')
+		messages = [r.getMessage() for r in self.handler.records if r.name == 'transwarp.sql']
+		self.assertTrue([m for m in messages if 'Alice' in m])
+
+class BenchmarkTest(unittest.TestCase):
+
+	def test_bench_logging_runs_the_real_paths(self):
+		out = io.StringIO()
+		with contextlib.redirect_stdout(out):
+			benchmark.bench_logging(10)
+		lines = out.getvalue().splitlines()
+		self.assertEqual([x.split('  ')[1].strip() for x in lines[1:]], ['eager calls, INFO', 'eager calls, WARNING', 'request, production', 'request, WARNING'])
+		self.assertIsNone(db.engine)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio, threading, time, unittest
+from unittest import mock
+from transwarp import benchmark, db, orm
+from transwarp.orm import Model, IntegerField, StringField, FloatField, TextField
+from tests.support import EngineTestCase
+
+class User(Model):
+	__table__ = 'user'
+	id = IntegerField(primary_key=True)
+	name = StringField()
+	created_at = FloatField()
+
+class Blog(Model):
+	__table__ = 'blog'
+	id = IntegerField(primary_key=True)
+	user_id = IntegerField(foreign_key=True, foreign_table_name='user', foreign_field='id')
+	title = StringField()
+	content = TextField()
+	created_at = FloatField()
+
+class Stamped(Model):
+	__table__ = 'stamped'
+	id = IntegerField(primary_key=True)
+	name = StringField()
+	created_at = FloatField()
+
+	def pre_update(self):
+		self.created_at = self.created_at + 100.0
+
+_TABLES = (
+	'create table user (id int primary key, name text, created_at real)',
+	'create table blog (id int primary key, user_id int, title text, content text, created_at real)',
+	'create table stamped (id int primary key, name text, created_at real)',
+)
+
+class ModelTestCase(EngineTestCase):
+
+	tables = _TABLES
+
+	def setUp(self):
+		super(ModelTestCase, self).setUp()
+		for i in range(1, 4):
+			User(id=i, name='user%d' % i, created_at=float(i)).insert()
+
+class ModelTest(ModelTestCase):
+
+	def test_objects_from_rows(self):
+		u = User.get(1)
+		self.assertIsInstance(u, User)
+		self.assertEqual(dict(u), dict(id=1, name='user1', created_at=1.0))
+		u.name = 'changed'
+		self.assertEqual(u._update_query()[1:], ['changed', 1])
+
+class CompiledSqlTest(unittest.TestCase):
+
+	def test_statements_are_compiled_once(self):
+		self.assertEqual(User.__get_sql__, 'select * from `user` where `id`=?')
+		self.assertEqual(User.__insert_sql__, 'insert into `user` (`id`,`name`,`created_at`) values (?,?,?)')
+		self.assertEqual(User.__update_sql__, 'update `user` set `name`=?,`created_at`=? where `id`=?')
+		self.assertEqual(User.__delete_sql__, 'delete from `user` where `id`=?')
+		self.assertEqual([k for k, default in Comment.__insert_fields__], ['id', 'content', 'created_at'])
+		self.assertEqual(Comment.__insert_fields__[1][1](), '')
+
+class DirtyTrackingTest(ModelTestCase):
+
+	def updates(self):
+		return [st for st in db.query_stats() if st['sql'].startswith('update')]
+
+	def test_writes_only_changed_columns(self):
+		u = User.get(1)
+		db.reset_query_stats()
+		u.update()
+		self.assertEqual(self.updates(), [])
+		u.name = 'changed'
+		u.update()
+		self.assertEqual([st['sql'] for st in self.updates()], ['update `user` set `name`=? where `id`=?'])
+		db.reset_query_stats()
+		u.update()
+		self.assertEqual(self.updates(), [])
+		self.assertEqual(User.get(1).name, 'changed')
+
+	def test_save_force_writes_everything(self):
+		u = User.get(2)
+		db.reset_query_stats()
+		u.save(force=True)
+		self.assertEqual([st['sql'] for st in self.updates()], [User.__update_sql__])
+
+	def test_new_objects_write_everything(self):
+		u = User(id=2, name='replaced', created_at=7.0)
+		self.assertEqual(u._update_query()[0], User.__update_sql__)
+		u.update()
+		self.assertEqual(User.get(2).created_at, 7.0)
+
+	def test_pre_update_runs_only_when_writing(self):
+		Stamped(id=1, name='user1', created_at=1.0).insert()
+		u = Stamped.get(1)
+		db.reset_query_stats()
+		u.update()
+		self.assertEqual(self.updates(), [])
+		self.assertEqual(u.created_at, 1.0)
+		u.name = 'changed'
+		u.update()
+		self.assertEqual([st['sql'] for st in self.updates()], ['update `stamped` set `name`=?,`created_at`=? where `id`=?'])
+		self.assertEqual(dict(Stamped.get(1)), dict(id=1, name='changed', created_at=101.0))
+		db.reset_query_stats()
+		u.update()
+		self.assertEqual(self.updates(), [])
+
+	def test_loaded_objects_have_no_dict(self):
+		u = User.get(1)
+		self.assertFalse(hasattr(u, '__dict__') and u.__dict__)
+		u.name = 'changed'
+		u.update()
+		self.assertFalse(hasattr(u, '__dict__') and u.__dict__)
+
+	def test_original_values_cost_no_more_than_the_row(self):
+		# bytes/row kept by the objects as bench_rows() prints it, the values tuple
+		# shared with the row is the only snapshot cost:
+		n = 2000
+		names, rows = benchmark._cursor(n)
+		kept = dict((func, benchmark._measure(func, names, rows)[1] // n) for func in (benchmark._dict_models, benchmark._row_models))
+		self.assertLessEqual(kept[benchmark._row_models], kept[benchmark._dict_models])
+
+class AsyncModelTest(ModelTestCase):
+
+	def test_finders(self):
+		self.assertEqual(self.wait(User.get_async(2)).name, 'user2')
+		self.assertIsNone(self.wait(User.get_async(9)))
+		self.assertEqual(self.wait(User.find_first_async('name=?', 'user3')).id, 3)
+		self.assertEqual(len(self.wait(User.find_by_async('id>?', 1))), 2)
+		self.assertEqual(len(self.wait(User.find_all_async())), 3)
+		self.assertEqual(self.wait(User.count_all_async()), 3)
+		self.assertEqual(self.wait(User.count_by_async('id<?', 3)), 2)
+
+	def test_writes(self):
+		u = self.wait(User(id=4, name='Ada', created_at=4.0).insert_async())
+		u.name = 'Eve'
+		self.wait(u.update_async())
+		self.assertEqual(User.get(4).name, 'Eve')
+		self.wait(u.delete_async())
+		self.assertIsNone(User.get(4))
+
+class BlogTestCase(ModelTestCase):
+
+	def setUp(self):
+		super(BlogTestCase, self).setUp()
+		for i in range(1, 5):
+			Blog(id=i, user_id=(i % 3) + 1, title='title%d' % i, content='content%d' % i, created_at=float(i)).insert()
+		db.reset_query_stats()
+
+	def queries(self, table):
+		return sum([st['calls'] for st in db.query_stats() if ('`%s`' % table) in st['sql'] or (' %s ' % table) in st['sql']])
+
+class ProjectionTest(BlogTestCase):
+
+	def test_only_and_defer(self):
+		b = Blog.get(1, only=['title'])
+		self.assertEqual(sorted(b.keys()), ['id', 'title'])
+		b = Blog.find_first('id=?', 1, defer=True)
+		self.assertNotIn('content', b)
+		self.assertEqual(b.title, 'title1')
+		with self.assertRaises(ValueError):
+			Blog.find_all(only=['nope'])
+
+	def test_deferred_field_loads_for_the_whole_result(self):
+		L = Blog.find_all(defer=['content'])
+		db.reset_query_stats()
+		self.assertEqual(L[0].content, 'content1')
+		self.assertEqual([b.content for b in L], ['content1', 'content2', 'content3', 'content4'])
+		self.assertEqual(self.queries('blog'), 1)
+
+	def test_unloaded_deferred_field_is_not_written(self):
+		b = Blog.get(2, defer=True)
+		b.title = 'changed'
+		sql = b._update_query()[0]
+		self.assertIn('title', sql)
+		self.assertNotIn('content', sql)
+
+	def test_deferred_field_on_the_loop(self):
+		@asyncio.coroutine
+		def handler():
+			L = yield from Blog.find_all_async(defer=True)
+			with self.assertRaises(db.DBError):
+				L[0].content
+			yield from L[0].load_deferred_async()
+			return [b.content for b in L]
+		self.assertEqual(self.wait(handler()), ['content1', 'content2', 'content3', 'content4'])
+
+class IdentityMapTest(ModelTestCase):
+
+	def test_same_object_within_the_map(self):
+		self.assertIsNot(User.get(1), User.get(1))
+		with orm.identity_map():
+			u = User.get(1)
+			db.reset_query_stats()
+			self.assertIs(User.get(1), u)
+			self.assertEqual(db.query_stats(), [])
+			L = User.find_all()
+			self.assertIs([x for x in L if x.id == 1][0], u)
+			self.assertIs(User.get(2), [x for x in L if x.id == 2][0])
+
+	def test_writes_update_the_map(self):
+		with orm.identity_map():
+			u = User(id=9, name='new', created_at=9.0).insert()
+			self.assertIs(User.get(9), u)
+			u.delete()
+			self.assertIsNone(User.get(9))
+
+	def test_async_tasks_share_the_map_of_their_request(self):
+		@asyncio.coroutine
+		def request():
+			with orm.identity_map():
+				a, b = yield from asyncio.gather(User.get_async(3), User.get_async(3))
+				c = yield from User.get_async(3)
+				return a, b, c
+		a, b, c = self.wait(request())
+		self.assertIs(c, a)
+
+class Tag(Model):
+	__table__ = 'tag'
+	__cache__ = dict(size=2, ttl=60.0, negative_ttl=60.0)
+	id = IntegerField(primary_key=True)
+	name = StringField()
+
+class ReadCacheTest(EngineTestCase):
+
+	tables = ('create table tag (id int primary key, name text)',)
+
+	def setUp(self):
+		super(ReadCacheTest, self).setUp()
+		Tag.__cache_store__ = orm._ReadCache(**Tag.__cache__)
+		for i in range(1, 4):
+			Tag(id=i, name='tag%d' % i).insert()
+
+	def test_hits_misses_and_eviction(self):
+		Tag.get(1)
+		Tag.get(1)
+		self.assertIsNone(Tag.get(9))
+		self.assertIsNone(Tag.get(9))
+		Tag.get(2)
+		stats = Tag.cache_stats()
+		self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses'], stats['evictions']), (1, 1, 3, 1))
+
+	def test_expiry(self):
+		Tag.__cache_store__.ttl = 0.01
+		Tag.get(1)
+		time.sleep(0.02)
+		Tag.get(1)
+		self.assertEqual(Tag.cache_stats()['expirations'], 1)
+
+	def test_writes_invalidate(self):
+		t = Tag.get(1)
+		t.name = 'changed'
+		t.update()
+		self.assertEqual(Tag.get(1).name, 'changed')
+		self.assertIsNone(Tag.get(4))
+		Tag(id=4, name='tag4').insert()
+		self.assertEqual(Tag.get(4).name, 'tag4')
+		db.update('update tag set name=? where id=?', 'raw', 4)
+		self.assertEqual(Tag.get(4).name, 'raw')
+
+	def test_rollback_keeps_the_cached_row(self):
+		Tag.get(1)
+		with self.assertRaises(ValueError):
+			with db.transaction():
+				t = Tag.get(1)
+				t.name = 'rolled back'
+				t.update()
+				raise ValueError('rollback')
+		hits = Tag.cache_stats()['hits']
+		self.assertEqual(Tag.get(1).name, 'tag1')
+		self.assertEqual(Tag.cache_stats()['hits'], hits + 1)
+
+	def test_read_during_write_transaction(self):
+		written, committed = threading.Event(), threading.Event()
+		def writer():
+			with db.transaction():
+				t = Tag.get(1)
+				t.name = 'new'
+				t.update()
+				written.set()
+				committed.wait(5)
+		thread = threading.Thread(target=writer)
+		thread.start()
+		self.assertTrue(written.wait(5))
+		# the reader sees and caches the committed row while the writer has not committed:
+		self.assertEqual(Tag.get(1).name, 'tag1')
+		self.assertEqual(Tag.get(1).name, 'tag1')
+		committed.set()
+		thread.join()
+		self.assertEqual(Tag.get(1).name, 'new')
+
+	def test_read_during_async_write_transaction(self):
+		db.close_engine()
+		db.create_engine('test', 'test', self.database + 'async', engine='fake')
+		self.wait(db.update_async(self.tables[0]))
+		self.wait(Tag(id=1, name='tag1').insert_async())
+		@asyncio.coroutine
+		def writer(written, committed):
+			@asyncio.coroutine
+			def work():
+				t = yield from Tag.get_async(1)
+				t.name = 'new'
+				yield from t.update_async()
+				written.set()
+				yield from committed.wait()
+			yield from db.transaction_async(work)
+		@asyncio.coroutine
+		def main():
+			written, committed = asyncio.Event(), asyncio.Event()
+			task = asyncio.ensure_future(writer(written, committed))
+			yield from written.wait()
+			during = (yield from Tag.get_async(1)).name
+			committed.set()
+			yield from task
+			return during, (yield from Tag.get_async(1)).name
+		self.assertEqual(self.wait(main()), ('tag1', 'new'))
+
+class PrefetchTest(BlogTestCase):
+
+	def test_one_query_per_relation(self):
+		Blog(id=5, user_id=None, title='orphan', content='', created_at=5.0).insert()
+		db.reset_query_stats()
+		L = Blog.find_all(prefetch=['user_id'])
+		self.assertEqual(self.queries('user'), 1)
+		self.assertEqual(dict([(b.id, b.user and b.user.name) for b in L]),
+			{1: 'user2', 2: 'user3', 3: 'user1', 4: 'user2', 5: None})
+		self.assertIs(type(L[0].user), User)
+
+	def test_standalone_and_async(self):
+		L = Blog.find_by('id<?', 3)
+		orm.prefetch(L, 'user_id')
+		self.assertEqual([b.user.id for b in L], [2, 3])
+		L = self.wait(Blog.find_all_async(prefetch=['user_id']))
+		self.assertEqual(len([b for b in L if b.user is not None]), 4)
+		b = self.wait(Blog.find_first_async('id=?', 4, prefetch=['user_id']))
+		self.assertEqual(b.user.name, 'user2')
+
+	def test_unknown_relation(self):
+		with self.assertRaises(ValueError):
+			Blog.find_all(prefetch=['title'])
+
+class GetBatchingTest(EngineTestCase):
+
+	engine = 'fake'
+	tables = _TABLES
+
+	def setUp(self):
+		super(GetBatchingTest, self).setUp()
+		self.wait(User.insert_all_async([User(id=i, name='user%d' % i, created_at=float(i)) for i in range(1, 4)]))
+		orm.enable_get_batching()
+		self.addCleanup(orm.disable_get_batching)
+
+	def gather(self, *aws, return_exceptions=False):
+		return self.wait(asyncio.wait_for(asyncio.gather(*aws, return_exceptions=return_exceptions), 5))
+
+	def test_coalesces_and_dedupes(self):
+		L = self.gather(User.get_async(1), User.get_async(2), User.get_async(1), User.get_async(9))
+		self.assertEqual([u and u.name for u in L], ['user1', 'user2', 'user1', None])
+		stats = orm.get_batching_stats()['User']
+		self.assertEqual((stats['requests'], stats['deduped'], stats['queries'], stats['saved']), (4, 1, 1, 3))
+
+	def test_mixed_key_types(self):
+		L = self.gather(User.get_async(1), User.get_async('1'), User.get_async('2'), User.get_async('3 '))
+		self.assertEqual([u and u.name for u in L], ['user1', 'user1', 'user2', 'user3'])
+		self.assertEqual(orm.get_batching_stats()['User']['queries'], 1)
+
+	def test_keys_of_another_type(self):
+		# the server converts them to the column's type, a batched get_async() too:
+		for key, name in (('01', 'user1'), (2.0, 'user2')):
+			self.assertEqual(self.wait(db.select_one_async(User.__get_sql__, key)).name, name)
+		L = self.gather(User.get_async(3), User.get_async('01'), User.get_async(2.0), User.get_async('9'), User.get_async(9))
+		self.assertEqual([u and u.name for u in L], ['user3', 'user1', 'user2', None, None])
+		stats = orm.get_batching_stats()['User']
+		# one batch, then a query per unmatched key of another type:
+		self.assertEqual((stats['queries'], stats['fallbacks']), (4, 3))
+
+	def test_not_batched_in_transaction(self):
+		@asyncio.coroutine
+		def work():
+			return (yield from User.get_async(2))
+		self.assertEqual(self.wait(db.transaction_async(work)).name, 'user2')
+		self.assertEqual(orm.get_batching_stats(), {})
+
+	def test_failed_batch_fails_every_caller(self):
+		with mock.patch.object(db, 'select_async', side_effect=db.DBError('gone')):
+			L = self.gather(User.get_async(1), User.get_async(2), return_exceptions=True)
+		self.assertEqual([type(e) for e in L], [db.DBError, db.DBError])
+
+	def test_cancelled_batch_does_not_hang_callers(self):
+		with mock.patch.object(db, 'select_async', side_effect=asyncio.CancelledError()):
+			L = self.gather(User.get_async(1), User.get_async(2), return_exceptions=True)
+		self.assertEqual([type(e) for e in L], [asyncio.CancelledError, asyncio.CancelledError])
+		self.assertEqual(self.gather(User.get_async(1))[0].name, 'user1')
+
+class IterByTest(ModelTestCase):
+
+	def test_yields_models(self):
+		L = list(User.iter_by('id>?', 1, batch_size=1))
+		self.assertEqual([u.name for u in L], ['user2', 'user3'])
+		self.assertIsInstance(L[0], User)
+
+class FindPageTest(EngineTestCase):
+
+	tables = _TABLES
+
+	def setUp(self):
+		super(FindPageTest, self).setUp()
+		# two rows per created_at, so the primary key breaks the ties:
+		User.insert_all([User(id=i, name='user%d' % i, created_at=float(i // 2)) for i in range(10)])
+
+	def _pages(self, **kw):
+		pages = []
+		after = None
+		while True:
+			L, after = User.find_page(after=after, **kw)
+			pages.append([u.id for u in L])
+			if after is None:
+				return pages
+
+	def test_walks_every_row_once(self):
+		self.assertEqual(self._pages(limit=3), [[9, 8, 7], [6, 5, 4], [3, 2, 1], [0]])
+		self.assertEqual(self._pages(limit=4, desc=False), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+		self.assertEqual(self._pages(limit=5, where='id<>?', args=(5,)), [[9, 8, 7, 6, 4], [3, 2, 1, 0]])
+
+	def test_only_keeps_cursor_columns(self):
+		L, after = User.find_page(limit=2, only=['name'])
+		self.assertEqual([u.name for u in L], ['user9', 'user8'])
+		L, after = User.find_page(after=after, limit=2, defer=['created_at'])
+		self.assertEqual([u.id for u in L], [7, 6])
+
+	def test_invalid_arguments(self):
+		for limit in (0, -1, '2'):
+			with self.assertRaises(ValueError):
+				User.find_page(limit=limit)
+		with self.assertRaises(ValueError):
+			User.find_page(order_by='nope')
+
+	def test_async(self):
+		L, after = self.wait(User.find_page_async(limit=6, only=['name']))
+		L, after = self.wait(User.find_page_async(after=after, limit=6, only=['name']))
+		self.assertEqual(([u.id for u in L], after), ([3, 2, 1, 0], None))
+
+class Comment(Model):
+	__table__ = 'comment'
+	id = IntegerField(primary_key=True)
+	content = StringField(default='')
+	created_at = FloatField()
+	def pre_insert(self):
+		self.created_at = 42.0
+
+class InsertAllTest(EngineTestCase):
+
+	tables = ('create table comment (id int primary key, content text, created_at real)',)
+
+	def test_defaults_and_triggers(self):
+		objs = [Comment(id=i) for i in range(5)]
+		self.assertEqual(Comment.insert_all(objs, max_rows=2), 5)
+		rows = Comment.find_all()
+		self.assertEqual(len(rows), 5)
+		self.assertEqual(set([(c.content, c.created_at) for c in rows]), set([('', 42.0)]))
+		objs[0].content = 'changed'
+		self.assertIn('content', objs[0]._update_query(False)[0])
+
+	def test_async(self):
+		self.assertEqual(self.wait(Comment.insert_all_async([Comment(id=1), Comment(id=2)])), 2)
+		self.assertEqual(Comment.count_all(), 2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jiejing Shan'
+
+'''
+Asynchronous database engine that runs on the asyncio event loop.
+Connections speak the MySQL protocol through aiomysql, so a query waiting for the
+server costs a suspended coroutine instead of a blocked thread:
+	db.create_engine(user, password, database, engine='aiomysql')
+	rows = yield from select('select * from users where id=?', id)
+	async with transaction():
+		await update('update users set name=? where id=?', name, id)
+The 'fake' engine replaces aiomysql by transwarp.fakedb, a sqlite database with an
+optional per round trip latency, so the async path can be tested and
+benchmarked without any server.
+'''
+
+import asyncio, collections, contextvars, logging, time
+from transwarp import db, fakedb
+from transwarp.common import Row as Row
+
+class _AsyncPool(object):
+	'''
+	Bounded pool of async connections, counterpart of db._ConnectionPool.
+	'''
+	def __init__(self, connect, min_size=1, max_size=10, timeout=10.0, max_lifetime=3600.0, max_idle=600.0, ping=30.0):
+		if max_size < 1 or min_size < 0 or min_size > max_size:
+			raise db.DBError('Invalid pool size: min=%s, max=%s.' % (min_size, max_size))
+		self._connect = connect
+		self.min_size = min_size
+		self.max_size = max_size
+		self.timeout = timeout
+		self.max_lifetime = max_lifetime
+		self.max_idle = max_idle
+		self.ping = ping
+		self._idle = collections.deque()
+		self._cond = None
+		self._size = 0
+		self._in_use = 0
+		self._closed = False
+		self._counters = dict(created=0, closed=0, checkouts=0, waits=0, wait_time=0.0, timeouts=0, ping_failures=0)
+
+	def _condition(self):
+		# created lazily so the pool binds to the loop that runs the server:
+		if self._cond is None:
+			self._cond = asyncio.Condition()
+		return self._cond
+
+	@asyncio.coroutine
+	def _create(self):
+		conn = db._PooledConnection((yield from self._connect()))
+		self._counters['created'] += 1
+		db._log.info('open async connection <0x%x>...', id(conn))
+		return conn
+
+	@asyncio.coroutine
+	def _discard(self, conns):
+		for conn in conns:
+			db._log.info('close async connection <0x%x>...', id(conn))
+			try:
+				yield from conn.raw.close()
+			except Exception:
+				db._log.warning('close async connection <0x%x> failed.', id(conn))
+			self._counters['closed'] += 1
+
+	def _expired(self, conn, now):
+		return self.max_lifetime is not None and now - conn.created_at > self.max_lifetime
+
+	def _reap(self, now):
+		reaped = []
+		for conn in list(self._idle):
+			too_idle = self.max_idle is not None and now - conn.last_used > self.max_idle \
+				and self._size - len(reaped) > self.min_size
+			if too_idle or self._expired(conn, now):
+				self._idle.remove(conn)
+				reaped.append(conn)
+		self._size = self._size - len(reaped)
+		return reaped
+
+	@asyncio.coroutine
+	def warm_up(self):
+		while not self._closed and self._size < self.min_size:
+			self._size = self._size + 1
+			try:
+				conn = yield from self._create()
+			except:
+				self._size = self._size - 1
+				raise
+			self._idle.append(conn)
+
+	@asyncio.coroutine
+	def acquire(self):
+		cond = self._condition()
+		start = time.time()
+		deadline = None
+		while True:
+			conn = None
+			reaped = []
+			yield from cond.acquire()
+			try:
+				while True:
+					if self._closed:
+						raise db.DBError('Connection pool is closed.')
+					now = time.time()
+					reaped.extend(self._reap(now))
+					if self._idle:
+						conn = self._idle.pop()
+						break
+					if self._size < self.max_size:
+						self._size = self._size + 1
+						break
+					if deadline is None:
+						deadline = start + self.timeout
+						self._counters['waits'] += 1
+					try:
+						yield from asyncio.wait_for(cond.wait(), deadline - now)
+					except asyncio.TimeoutError:
+						self._counters['timeouts'] += 1
+						self._counters['wait_time'] += time.time() - start
+						raise db.PoolTimeoutError('Timeout waiting for connection after %.3f seconds.' % (time.time() - start))
+				self._in_use = self._in_use + 1
+			finally:
+				cond.release()
+				yield from self._discard(reaped)
+			if conn is None:
+				try:
+					conn = yield from self._create()
+				except:
+					yield from self._forget()
+					raise
+			elif self.ping is not None and now - conn.last_used >= self.ping:
+				try:
+					yield from conn.raw.ping()
+				except Exception:
+					self._counters['ping_failures'] += 1
+					yield from self._forget()
+					yield from self._discard([conn])
+					continue
+			self._counters['checkouts'] += 1
+			if deadline is not None:
+				self._counters['wait_time'] += time.time() - start
+			return conn
+
+	@asyncio.coroutine
+	def _forget(self):
+		cond = self._condition()
+		yield from cond.acquire()
+		try:
+			self._in_use = self._in_use - 1
+			self._size = self._size - 1
+			cond.notify()
+		finally:
+			cond.release()
+
+	@asyncio.coroutine
+	def release(self, conn, discard=False):
+		if not discard and conn.raw.in_transaction:
+			try:
+				yield from conn.raw.rollback()
+			except Exception:
+				discard = True
+		cond = self._condition()
+		now = time.time()
+		yield from cond.acquire()
+		try:
+			self._in_use = self._in_use - 1
+			if discard or self._closed or self._expired(conn, now):
+				self._size = self._size - 1
+			else:
+				conn.last_used = now
+				self._idle.append(conn)
+				conn = None
+			cond.notify()
+		finally:
+			cond.release()
+		if conn is not None:
+			yield from self._discard([conn])
+
+	@asyncio.coroutine
+	def close(self):
+		self._closed = True
+		if self._cond is not None:
+			# the tasks waiting in acquire() wake up and raise DBError:
+			yield from self._cond.acquire()
+			try:
+				self._cond.notify_all()
+			finally:
+				self._cond.release()
+		conns = list(self._idle)
+		self._idle.clear()
+		self._size = self._size - len(conns)
+		yield from self._discard(conns)
+
+	def stats(self):
+		d = dict(self._counters)
+		d.update(size=self._size, idle=len(self._idle), in_use=self._in_use, min_size=self.min_size, max_size=self.max_size)
+		return d
+
+class _AsyncEngine(object):
+	'''
+	Engine whose connections live on the event loop. Only the coroutine API of this
+	module (and the *_async functions of db, which delegate here) can use it.
+	'''
+	is_async = True
+
+	def __init__(self, connect, **pool_kw):
+		self._pool = _AsyncPool(connect, **pool_kw)
+
+	def connect(self):
+		raise db.DBError('Blocking db calls are not supported by the async engine, use the *_async functions.')
+
+	def acquire(self):
+		return self._pool.acquire()
+
+	def release(self, connection, discard=False):
+		return self._pool.release(connection, discard)
+
+	def warm_up(self):
+		return self._pool.warm_up()
+
+	def stats(self):
+		return self._pool.stats()
+
+	def close(self):
+		return self._pool.close()
+
+class _AiomysqlConnection(object):
+	'''
+	Adapt an aiomysql connection (or a fakedb.AsyncConnection) to the interface used
+	by this module. A connection runs one statement at a time: a second task issuing
+	a statement while one is in flight gets DBError instead of a corrupted protocol.
+	'''
+	def __init__(self, conn):
+		self._conn = conn
+		self._busy = False
+
+	@asyncio.coroutine
+	def execute(self, sql, args):
+		if self._busy:
+			raise db.DBError('Connection <0x%x> is already running a statement in another task.' % id(self))
+		self._busy = True
+		try:
+			cursor = yield from self._conn.cursor()
+			try:
+				yield from cursor.execute(sql, args)
+				names = [x[0] for x in cursor.description] if cursor.description else []
+				rows = (yield from cursor.fetchall()) if cursor.description else []
+				return names, rows, cursor.rowcount
+			finally:
+				yield from cursor.close()
+		finally:
+			self._busy = False
+
+	@property
+	def in_transaction(self):
+		return self._conn.get_transaction_status()
+
+	def commit(self):
+		return self._conn.commit()
+
+	def rollback(self):
+		return self._conn.rollback()
+
+	def ping(self):
+		return self._conn.ping(reconnect=False)
+
+	@asyncio.coroutine
+	def close(self):
+		self._conn.close()
+
+# create_engine() keyword -> _AsyncPool argument, same names as the blocking engine:
+_POOL_ARGS = db._POOL_ARGS
+
+def create_engine(kind, user, password, database, host='127.0.0.1', port=3306, **kw):
+	'''
+	Create an async engine, called by db.create_engine() when engine= is 'aiomysql' or 'fake'.
+	The fake engine accepts fake_latency (seconds per round trip, default 0).
+	'''
+	pool_kw = dict()
+	for k, v in _POOL_ARGS.items():
+		if k in kw:
+			pool_kw[v] = kw.pop(k)
+	# options of the blocking engine only:
+	kw.pop('executor_workers', None)
+	kw.pop('prepared_statements', None)
+	if kind == 'fake':
+		latency = kw.pop('fake_latency', 0.0)
+		@asyncio.coroutine
+		def connect():
+			return _AiomysqlConnection((yield from fakedb.connect_async(database, latency)))
+		fakedb.reset(database)
+	elif kind == 'aiomysql':
+		import aiomysql
+		params = dict(user=user, password=password, db=database, host=host, port=port)
+		defaults = dict(use_unicode=True, charset='utf8', autocommit=False)
+		for k, v in defaults.items():
+			params[k] = kw.pop(k, v)
+		kw.pop('collation', None)
+		params.update(kw)
+		@asyncio.coroutine
+		def connect():
+			return _AiomysqlConnection((yield from aiomysql.connect(**params)))
+	else:
+		raise db.DBError('Unknown engine: %s' % kind)
+	engine = _AsyncEngine(connect, **pool_kw)
+	db._log.info('Init %s async engine <0x%x> ok.', kind, id(engine))
+	return engine
+
+class _AsyncDbCtx(object):
+	'''
+	Connection info of the current task, the async counterpart of db._DbCtx.
+	'''
+	def __init__(self, connection):
+		self.connection = connection
+		self.transactions = 0
+		self.task = asyncio.current_task()
+		# see db.after_commit():
+		self.after_commit = []
+
+# context variable instead of thread local. Tasks copy the context of the task that
+# created them, but an aiomysql connection cannot serve two tasks at once, so only
+# the task that opened an _AsyncDbCtx uses it, see _current():
+_db_ctx = contextvars.ContextVar('transwarp_aiodb_ctx', default=None)
+
+def _current():
+	'''
+	Return the _AsyncDbCtx of the running task. A task spawned inside a connection or
+	transaction block does not join it, it runs its statements on its own connection.
+	'''
+	ctx = _db_ctx.get()
+	if ctx is None:
+		return None
+	try:
+		task = asyncio.current_task()
+	except RuntimeError:
+		# no running loop, such as db.in_transaction() called from a thread:
+		task = None
+	return ctx if ctx.task is task else None
+
+def _engine():
+	engine = db.engine
+	if engine is None or not getattr(engine, 'is_async', False):
+		raise db.DBError('Async engine is not initialized.')
+	return engine
+
+class _AsyncConnectionCtx(object):
+	'''
+	Hold one pooled connection for the enclosed block, can be nested and only the
+	outermost context has effect:
+	async with connection():
+		pass
+	'''
+	@asyncio.coroutine
+	def __aenter__(self):
+		self._token = None
+		if _current() is None:
+			self._token = _db_ctx.set(_AsyncDbCtx((yield from _engine().acquire())))
+		return self
+
+	@asyncio.coroutine
+	def __aexit__(self, exctype, excvalue, traceback):
+		if self._token is not None:
+			connection = _current().connection
+			_db_ctx.reset(self._token)
+			yield from _engine().release(connection)
+
+class _AsyncTransactionCtx(_AsyncConnectionCtx):
+	'''
+	Async transaction with the same nesting semantics as db._TransactionCtx: only the
+	outermost transaction commits or rolls back.
+	async with transaction():
+		pass
+	'''
+	@asyncio.coroutine
+	def __aenter__(self):
+		yield from super(_AsyncTransactionCtx, self).__aenter__()
+		ctx = _current()
+		ctx.transactions = ctx.transactions + 1
+		db._log.info('begin async transaction...' if ctx.transactions==1 else 'join current async transaction...')
+		return self
+
+	@asyncio.coroutine
+	def __aexit__(self, exctype, excvalue, traceback):
+		ctx = _current()
+		ctx.transactions = ctx.transactions - 1
+		try:
+			if ctx.transactions==0:
+				queue, ctx.after_commit = ctx.after_commit, []
+				if exctype is None and not db._aborting:
+					yield from self.commit()
+					db._run_after_commit(queue)
+				else:
+					yield from self.rollback()
+		finally:
+			yield from super(_AsyncTransactionCtx, self).__aexit__(exctype, excvalue, traceback)
+
+	@asyncio.coroutine
+	def commit(self):
+		raw = _current().connection.raw
+		db._log.info('commit async transaction...')
+		try:
+			yield from raw.commit()
+			db._log.info('commit ok.')
+		except:
+			db._log.warning('commit failed. try rollback...')
+			yield from raw.rollback()
+			db._log.warning('rollback ok.')
+			raise
+
+	@asyncio.coroutine
+	def rollback(self):
+		db._log.warning('rollback async transaction...')
+		yield from _current().connection.raw.rollback()
+		db._log.info('rollback ok.')
+
+def connection():
+	'''
+	Return an async connection context: async with connection(): ...
+	'''
+	return _AsyncConnectionCtx()
+
+def transaction():
+	'''
+	Return an async transaction context: async with transaction(): ...
+	'''
+	return _AsyncTransactionCtx()
+
+@asyncio.coroutine
+def run_in_transaction(func, *args, **kw):
+	'''
+	Run coroutine function func inside a transaction and return its result, for
+	generator based coroutines that cannot use async with.
+	'''
+	tx = _AsyncTransactionCtx()
+	yield from tx.__aenter__()
+	try:
+		r = yield from func(*args, **kw)
+	except BaseException as e:
+		yield from tx.__aexit__(type(e), e, e.__traceback__)
+		raise
+	yield from tx.__aexit__(None, None, None)
+	return r
+
+@asyncio.coroutine
+def _execute(sql, args, autocommit=False):
+	'''
+	Execute sql on the task's connection, or on a connection checked out for this
+	statement only. Return (names, rows, rowcount).
+	'''
+	translated = sql.replace('?', '%s')
+	if db._sql_log.isEnabledFor(logging.INFO):
+		db._sql_log.info('SQL: %s, ARGS: %s', translated, args)
+	ctx = _current()
+	connection = None
+	wait = 0.0
+	if ctx is None:
+		engine = _engine()
+		start = time.time()
+		connection = yield from engine.acquire()
+		wait = time.time() - start
+	raw = connection.raw if ctx is None else ctx.connection.raw
+	start = time.time()
+	try:
+		r = yield from raw.execute(translated, args)
+		if autocommit and (ctx is None or ctx.transactions==0):
+			db._sql_log.info('auto commit')
+			yield from raw.commit()
+		elapsed = time.time() - start
+	except Exception:
+		db._query_stats.record(sql, time.time() - start, wait=wait, error=True)
+		raise
+	finally:
+		if connection is not None:
+			yield from engine.release(connection)
+	names, rows, rowcount = r
+	db._query_stats.record(sql, elapsed, names and len(rows) or 0, not names and max(rowcount, 0) or 0, wait)
+	return r
+
+@asyncio.coroutine
+def _select(sql, first, *args):
+	names, rows, rowcount = yield from _execute(sql, args)
+	columns = Row.Columns(names)
+	if first:
+		return Row.Row(columns, rows[0]) if rows else None
+	return [Row.Row(columns, x) for x in rows]
+
+@asyncio.coroutine
+def select_one(sql, *args):
+	'''
+	Async select_one(): return the first row or None.
+	'''
+	return (yield from _select(sql, True, *args))
+
+@asyncio.coroutine
+def select_int(sql, *args):
+	'''
+	Async select_int(): return the only column of the first row.
+	'''
+	d = yield from _select(sql, True, *args)
+	if len(d)!=1:
+		raise db.MultiColumnsError('Expect only one column.')
+	return list(d.values())[0]
+
+@asyncio.coroutine
+def select(sql, *args):
+	'''
+	Async select(): return list of rows.
+	'''
+	return (yield from _select(sql, False, *args))
+
+@asyncio.coroutine
+def update(sql, *args):
+	'''
+	Async update(): return affected rows, commits unless inside a transaction.
+	'''
+	names, rows, rowcount = yield from _execute(sql, args, autocommit=True)
+	db._notify_write(sql)
+	return rowcount
+
+def insert(table, **kw):
+	'''
+	Async insert().
+	'''
+	cols, args = zip(*kw.items())
+	sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+	return update(sql, *args)
+
+@asyncio.coroutine
+def insert_many(table, rows, max_rows=None, max_bytes=None):
+	'''
+	Async insert_many(): every batch runs on one connection, committed per batch
+	unless inside a transaction.
+	'''
+	n = 0
+	ctx = connection()
+	yield from ctx.__aenter__()
+	try:
+		for sql, args in db._insert_batches(table, rows, max_rows, max_bytes):
+			n = n + (yield from update(sql, *args))
+	finally:
+		yield from ctx.__aexit__(None, None, None)
+	return n
+
+if __name__ == '__main__':
+	# offline smoke test and benchmark against the fake engine: python3 -m transwarp.aiodb
+	logging.basicConfig(level=logging.WARNING)
+	db.create_engine('web-data', 'web-data', 'aiodb_bench', engine='fake', fake_latency=0.01, pool_max_size=20)
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(update('create table user (id int primary key, name text)'))
+	loop.run_until_complete(insert('user', id=1, name='Alice'))
+	n = 1000
+	start = time.time()
+	loop.run_until_complete(asyncio.gather(*[select_one('select * from user where id=?', 1) for i in range(n)]))
+	t = time.time() - start
+	print('%d concurrent queries with 10ms latency in %.3f seconds (%.0f queries/s).' % (n, t, n / t))
+	print('pool: %s' % db.engine.stats())
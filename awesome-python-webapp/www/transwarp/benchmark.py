@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jiejing Shan'
+
+'''
+Offline micro benchmarks of the transwarp hot paths, no database server needed:
+	python3 -m transwarp.benchmark [rows]
+'''
+
+import asyncio, gc, io, logging, sys, time, timeit, tracemalloc
+from transwarp import db, log, orm
+from transwarp.common import Dict, Row
+
+class _BenchUser(orm.Model):
+	__table__ = 'bench_users'
+
+	id = orm.StringField(primary_key=True, ddl='varchar(50)')
+	email = orm.StringField(ddl='varchar(50)')
+	passwd = orm.StringField(ddl='varchar(50)')
+	admin = orm.BooleanField()
+	name = orm.StringField(ddl='varchar(50)')
+	image = orm.StringField(ddl='varchar(500)')
+	created_at = orm.FloatField()
+
+def _cursor(n):
+	' description names and fetchall() tuples of a n rows result set. '
+	names = ['id', 'email', 'passwd', 'admin', 'name', 'image', 'created_at']
+	now = time.time()
+	rows = [('%050d' % i, 'user%d@example.com' % i, 'x' * 32, False, 'user%d' % i, 'http://example.com/%d.png' % i, now + i) for i in range(n)]
+	return names, rows
+
+def _dict_rows(names, rows):
+	return [Dict.Dict(names, x) for x in rows]
+
+def _row_rows(names, rows):
+	columns = Row.Columns(names)
+	return [Row.Row(columns, x) for x in rows]
+
+def _dict_models(names, rows):
+	# the old path: a Dict per row then a copy of it by cls(**d)
+	return [_BenchUser(**d) for d in _dict_rows(names, rows)]
+
+def _row_models(names, rows):
+	return _BenchUser._load(_row_rows(names, rows))
+
+def _measure(func, names, rows):
+	' return (seconds, bytes kept by the result, peak bytes) of func(names, rows). '
+	gc.collect()
+	start = time.perf_counter()
+	result = func(names, rows)
+	t = time.perf_counter() - start
+	del result
+	gc.collect()
+	tracemalloc.start()
+	result = func(names, rows)
+	size, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del result
+	return t, size, peak
+
+def bench_rows(n=100000):
+	'''
+	Compare the Dict and Row select results, alone and hydrated into models.
+	'''
+	names, rows = _cursor(n)
+	print('%d rows of %d columns:' % (n, len(names)))
+	for title, func in (('Dict rows', _dict_rows), ('Row rows', _row_rows), ('Dict + Model', _dict_models), ('Row + Model', _row_models)):
+		t, size, peak = _measure(func, names, rows)
+		print('  %-14s %8.3f s %10.0f rows/s %8.1f MB kept %8.1f MB peak %6d bytes/row' % (title, t, n / t, size / 1048576.0, peak / 1048576.0, size // n))
+
+class _StubDb(object):
+	'''
+	Replace the db functions used by Model with ones that only count their calls and
+	return canned results, so timing Model methods shows the ORM's own overhead.
+	'''
+	_names = ('select_one', 'select', 'select_int', 'insert', 'update')
+
+	def __init__(self, row):
+		self.row = row
+		self.calls = 0
+
+	def select_one(self, sql, *args):
+		self.calls = self.calls + 1
+		return self.row
+
+	def select(self, sql, *args):
+		self.calls = self.calls + 1
+		return [self.row]
+
+	def select_int(self, sql, *args):
+		self.calls = self.calls + 1
+		return 1
+
+	def insert(self, table, **kw):
+		self.calls = self.calls + 1
+		return 1
+
+	def update(self, sql, *args):
+		self.calls = self.calls + 1
+		return 1
+
+	def __enter__(self):
+		self._saved = [(name, getattr(db, name)) for name in self._names]
+		for name in self._names:
+			setattr(db, name, getattr(self, name))
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		for name, func in self._saved:
+			setattr(db, name, func)
+
+def bench_orm(n=100000):
+	'''
+	Time Model.get(), insert(), update(), save(), delete() and count_all() against the
+	stub db. update() of an unchanged object skips the db, "update 1 col" changes a field first.
+	'''
+	names, rows = _cursor(1)
+	row = _row_rows(names, rows)[0]
+	u = _BenchUser._hydrate(row)
+	print('ORM overhead per operation, db stubbed out, %d calls each:' % n)
+	with _StubDb(row):
+		for title, func in (('get', lambda: _BenchUser.get(u.id)), ('insert', u.insert), ('update', lambda: u.update()), ('update 1 col', lambda: dict.__setitem__(u, 'name', not u['name']) or u.update()), ('save(force)', lambda: u.save(force=True)), ('delete', u.delete), ('count_all', _BenchUser.count_all)):
+			t = min(timeit.repeat(func, number=n, repeat=3))
+			print('  %-12s %8.2f us' % (title, t / n * 1000000))
+
+def _eager_request(kw, queries):
+	# the log calls of one request and its queries before transwarp.log, formatted
+	# whether they are emitted or not:
+	logging.info('Request: %s %s' % ('GET', '/blog/1'))
+	logging.info('app is %s, handler is %s' % (bench_logging, _eager_request))
+	logging.info('call with args:%s' % str(kw))
+	for sql, args in queries:
+		logging.info('open connection <%s>...' % hex(id(args)))
+		logging.info('SQL: %s, ARGS: %s' % (sql, args))
+		logging.info('auto commit')
+		logging.info('release connection <%s>...' % hex(id(args)))
+	logging.info('Response handler.')
+
+class _BenchRequest(dict):
+	'''
+	The attributes of a GET aiohttp request read by framework.logger_factory and
+	RequestHandler, with the match info of the route.
+	'''
+	method = 'GET'
+	path = '/blog/1'
+	remote = '127.0.0.1'
+	query_string = ''
+
+	def __init__(self, match_info):
+		super(_BenchRequest, self).__init__()
+		self.match_info = match_info
+
+def _run(coro):
+	# the coroutines of a request that never waits finish at the first send():
+	try:
+		coro.send(None)
+	except StopIteration as e:
+		return e.value
+	raise RuntimeError('The benchmarked request is waiting.')
+
+def _blog_handler(queries):
+	'''
+	The coroutine of a /blog/{id} handler running queries on the db engine.
+	'''
+	@asyncio.coroutine
+	def get_blog(id):
+		for sql, args in queries:
+			db.select_one(sql, *args)
+		return dict(id=id)
+	return get_blog
+
+def bench_logging(n=100000):
+	'''
+	Time the logging of one request with 3 queries, written to a memory stream. The
+	eager calls of before are timed alone, at INFO (app.py's level) and WARNING. The
+	others serve the request with framework.logger_factory, RequestHandler and db on a
+	fake_mysql engine, with the levels and sampling of config_default and with
+	everything at WARNING: their difference is what logging costs a request now.
+	'''
+	import framework
+	kw = dict(id='0014xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx')
+	queries = [('select * from `blogs` where `id`=?', (kw['id'],)), ('select * from `users` where `id`=?', ('0015',)),
+		('select * from `comments` where `blog_id`=? order by created_at desc', (kw['id'],))]
+	db.create_engine('bench', 'bench', 'bench_logging', engine='fake_mysql')
+	for table in ('blogs', 'users'):
+		db.update('create table `%s` (`id` varchar(50) primary key)' % table)
+	db.update('create table `comments` (`id` varchar(50) primary key, `blog_id` varchar(50), `created_at` real)')
+	handler = _run(framework.logger_factory(None, framework.RequestHandler(_blog_handler(queries))))
+	request = lambda: _run(handler(_BenchRequest(kw)))
+	root = logging.getLogger()
+	names = ['transwarp.db', 'transwarp.sql', 'framework.request', 'framework.access']
+	saved = (root.level, list(root.handlers), [logging.getLogger(name).level for name in names], log.sampler('framework.request').every)
+	root.handlers = [logging.StreamHandler(io.StringIO())]
+	print('logging of one request with %d queries, %d requests:' % (len(queries), n))
+	try:
+		for title, func, setup in (
+				('eager calls, INFO', lambda: _eager_request(kw, queries), dict(level='INFO')),
+				('eager calls, WARNING', lambda: _eager_request(kw, queries), dict(level='WARNING')),
+				('request, production', request, dict(level='INFO', levels={'transwarp.sql': 'WARNING', 'transwarp.db': 'WARNING', 'framework.access': 'INFO'}, sample={'framework.request': 100})),
+				('request, WARNING', request, dict(level='WARNING', levels={'framework.access': 'WARNING'}))):
+			for name in names:
+				logging.getLogger(name).setLevel(logging.NOTSET)
+			log.configure(**setup)
+			t = min(timeit.repeat(func, number=n, repeat=3))
+			print('  %-20s %8.2f us' % (title, t / n * 1000000))
+	finally:
+		root.setLevel(saved[0])
+		root.handlers = saved[1]
+		for name, level in zip(names, saved[2]):
+			logging.getLogger(name).setLevel(level)
+		log.sampler('framework.request').every = saved[3]
+		db.close_engine()
+		db.reset_query_stats()
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	bench_rows(n)
+	bench_orm(n)
+	bench_logging(n)
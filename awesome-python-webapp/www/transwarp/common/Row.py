@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Jiejing Shan'
+
+'''
+define compact read-only row returned by db select functions.
+'''
+
+from collections.abc import Mapping
+
+class Columns(dict):
+    '''
+    Map column name to its index in a row, made once per result set and shared by
+    all rows of it.
+    >>> c = Columns(('id', 'name'))
+    >>> c['name']
+    1
+    '''
+    def __init__(self, names):
+        super(Columns, self).__init__([(name, i) for i, name in enumerate(names)])
+
+class Row(Mapping):
+    '''
+    Read-only row that keeps only the values tuple and a reference to the shared
+    Columns, but supports access as x.y and x['y'] style like Dict. Columns whose
+    name starts with '_' are only available as x['_y'].
+    >>> c = Columns(('a', 'b', 'c'))
+    >>> r = Row(c, (1, 2, '3'))
+    >>> r.a
+    1
+    >>> r['c']
+    '3'
+    >>> len(r), list(r.keys()), 'b' in r
+    (3, ['a', 'b', 'c'], True)
+    >>> r == dict(a=1, b=2, c='3')
+    True
+    >>> r.to_dict()
+    {'a': 1, 'b': 2, 'c': '3'}
+    >>> r['empty']
+    Traceback (most recent call last):
+        ...
+    KeyError: 'empty'
+    >>> r.empty
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'Row' object has no attribute 'empty'
+    >>> import copy, pickle
+    >>> copy.copy(r) == r, copy.deepcopy(r) == r
+    (True, True)
+    >>> p = pickle.loads(pickle.dumps(r))
+    >>> p.b, p
+    (2, Row({'a': 1, 'b': 2, 'c': '3'}))
+    >>> Row.__new__(Row)._values
+    Traceback (most recent call last):
+        ...
+    AttributeError: _values
+    '''
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key]]
+
+    def __getattr__(self, key):
+        # only called for missing attributes: an unset slot (from __new__ without
+        # __init__, as copy and pickle do) or a special method lookup must not
+        # look up the columns, which would recurse through _columns.
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self._values[self._columns[key]]
+        except KeyError:
+            raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+    def __reduce__(self):
+        return (Row, (self._columns, self._values))
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def get(self, key, default=None):
+        i = self._columns.get(key)
+        return default if i is None else self._values[i]
+
+    def to_dict(self):
+        return dict(zip(self._columns, self._values))
+
+    def __repr__(self):
+        return 'Row(%r)' % self.to_dict()
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
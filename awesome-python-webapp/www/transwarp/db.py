@@ -7,11 +7,19 @@ __author__ = 'Michael Liao'
 Database operation module.
 '''
 
-import time, uuid, functools, threading, logging
+import time, uuid, functools, threading, logging, collections, asyncio, contextvars, re, random
+from concurrent.futures import ThreadPoolExecutor
 if __name__ == '__main__':
-    from common import Dict as Dict
+    from common import Row as Row
+    import log
 else:
-    from transwarp.common import Dict as Dict
+    from transwarp.common import Row as Row
+    from transwarp import log
+
+# connections, pool and transactions:
+_log = log.get_logger('transwarp.db')
+# every statement, checked with isEnabledFor() before formatting its arguments:
+_sql_log = log.get_logger('transwarp.sql')
 
 
 def next_id(t=None):
@@ -27,9 +35,9 @@ def next_id(t=None):
 def _profiling(start, sql=''):
     t = time.time() - start
     if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
+        _log.warning('[PROFILING] [DB] %s: %s', t, sql)
     else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+        _log.info('[PROFILING] [DB] %s: %s', t, sql)
 
 class DBError(Exception):
     pass
@@ -37,17 +45,146 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
     pass
 
+class PoolTimeoutError(DBError):
+    pass
+
+class _PreparedStats(object):
+    '''
+    Counts how often the server side prepared statements kept per pooled connection
+    are reused. The statements themselves are translated to the driver's paramstyle
+    inline, a str.replace() is cheaper than looking them up in any cache.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict(prepared_hits=0, prepared_misses=0)
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+# global prepared statement counters of all connections:
+_statements = _PreparedStats()
+
+def statement_cache_stats():
+    '''
+    Return hit/miss counters of prepared statement reuse.
+    '''
+    return _statements.stats()
+
+# normalizing rules of _QueryStats, literals become ? and lists of ? become ?+:
+_NORMALIZE = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\?(?: ?, ?\?)+'), '?+'),
+    (re.compile(r'(\([^()]*\))(?: ?, ?\1)+'), r'\1,...'),
+]
+
+class _QueryStats(object):
+    '''
+    Statistics by normalized statement: calls, errors, latency (total, mean, max and
+    p50/p95/p99 of a bounded random sample), rows returned, rows affected and time
+    waited for a pooled connection. At most max_statements statements are kept,
+    later ones are summed up as '<other>'.
+    '''
+    def __init__(self, max_statements=500, samples=256):
+        self.max_statements = max_statements
+        self.samples = samples
+        self._normalized = dict()
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def normalize(self, sql):
+        n = self._normalized.get(sql)
+        if n is None:
+            n = sql.strip()
+            for pattern, repl in _NORMALIZE:
+                n = pattern.sub(repl, n)
+            if len(self._normalized) >= 4 * self.max_statements:
+                self._normalized.clear()
+            self._normalized[sql] = n
+        return n
+
+    def record(self, sql, elapsed, rows=0, affected=0, wait=0.0, error=False):
+        key = self.normalize(sql)
+        with self._lock:
+            st = self._stats.get(key)
+            if st is None:
+                if len(self._stats) >= self.max_statements:
+                    key = '<other>'
+                    st = self._stats.get(key)
+                if st is None:
+                    # calls, errors, total, max, rows, affected, wait, sample:
+                    st = self._stats[key] = [0, 0, 0.0, 0.0, 0, 0, 0.0, []]
+            st[0] += 1
+            st[1] += error and 1 or 0
+            st[2] += elapsed
+            if elapsed > st[3]:
+                st[3] = elapsed
+            st[4] += rows
+            st[5] += affected
+            st[6] += wait
+            sample = st[7]
+            if len(sample) < self.samples:
+                sample.append(elapsed)
+            else:
+                # reservoir sampling keeps every call equally likely in the sample:
+                i = random.randrange(st[0])
+                if i < self.samples:
+                    sample[i] = elapsed
+
+    def stats(self, order_by='total', top=None):
+        with self._lock:
+            items = [(key, list(st), list(st[7])) for key, st in self._stats.items()]
+        L = []
+        for key, st, sample in items:
+            sample.sort()
+            n = len(sample)
+            pct = lambda p: sample[min(n - 1, int(p * n))] if n else 0.0
+            L.append(dict(sql=key, calls=st[0], errors=st[1], total=st[2], mean=st[2] / st[0], max=st[3],
+                p50=pct(0.50), p95=pct(0.95), p99=pct(0.99), rows=st[4], affected=st[5], wait=st[6]))
+        L.sort(key=lambda d: d[order_by], reverse=True)
+        return L[:top] if top else L
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+# global statistics of all statements run by this process:
+_query_stats = _QueryStats()
+
+def query_stats(order_by='total', top=None):
+    '''
+    Return the per statement statistics as a list of dicts sorted by order_by desc,
+    see _QueryStats. Times are in seconds.
+    '''
+    return _query_stats.stats(order_by, top)
+
+def reset_query_stats():
+    _query_stats.reset()
+
 class _LasyConnection(object):
 
     def __init__(self):
         self.connection = None
+        self.wait = 0.0
 
-    def cursor(self):
+    def _connect(self):
         if self.connection is None:
+            start = time.time()
             connection = engine.connect()
-            logging.info('open connection <%s>...' % hex(id(connection)))
+            # charged to the first statement run on the connection:
+            self.wait = time.time() - start
+            _log.info('open connection <0x%x>...', id(connection))
             self.connection = connection
-        return self.connection.cursor()
+        return self.connection
+
+    def cursor(self):
+        return self._connect().cursor()
 
     def commit(self):
         self.connection.commit()
@@ -59,19 +196,35 @@ class _LasyConnection(object):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logging.info('close connection <%s>...' % hex(id(connection)))
-            connection.close()
+            _log.info('release connection <0x%x>...', id(connection))
+            engine.release(connection)
 
     def execute(self, sql, *args):
-        sql = sql.replace('?', '%s')
-        logging.info('SQL: %s, ARGS: %s' % (sql, args))
-        self._cursor = None
-        try :
-            self._cursor = self.cursor()
-            self._cursor.execute(sql, *args)
-            return self._cursor
-        except :
+        '''
+        Execute sql and return the cursor, which must be given back by close_cursor().
+        '''
+        translated = sql.replace('?', '%s')
+        if _sql_log.isEnabledFor(logging.INFO):
+            _sql_log.info('SQL: %s, ARGS: %s', translated, args)
+        connection = self._connect()
+        cursor = connection.prepared_cursor(translated) if engine.prepared else None
+        if cursor is None:
+            cursor = connection.cursor()
+        try:
+            cursor.execute(translated, *args)
+        except:
+            self.close_cursor(cursor, broken=True)
+            self.record(sql, 0.0, error=True)
             raise
+        return cursor
+
+    def record(self, sql, start, rows=0, affected=0, error=False):
+        ' add a statement started at time start to the query statistics. '
+        wait, self.wait = self.wait, 0.0
+        _query_stats.record(sql, start and time.time() - start, rows, affected, wait, error)
+
+    def close_cursor(self, cursor, broken=False):
+        self.connection.close_cursor(cursor, broken)
 
 class _DbCtx(threading.local):
     '''
@@ -80,14 +233,17 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        # functions to call when the outermost transaction commits, see after_commit():
+        self.after_commit = []
 
     def is_init(self):
         return not self.connection is None
 
     def init(self):
-        logging.info('open lazy connection...')
+        _log.info('open lazy connection...')
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.after_commit = []
 
     def cleanup(self):
         self.connection.cleanup()
@@ -105,28 +261,403 @@ _db_ctx = _DbCtx()
 # global engine object:
 engine = None
 
-class _Engine(object):
+# set by abort_transactions():
+_aborting = False
+
+class _PooledConnection(object):
+    '''
+    Wrap a raw driver connection with the bookkeeping needed by the pool.
+    '''
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        # translated sql -> prepared cursor, only used by the thread holding the connection:
+        self.statements = collections.OrderedDict()
+        self._prepared = dict()
+
+    def cursor(self, **kw):
+        return self.raw.cursor(**kw)
+
+    def prepared_cursor(self, sql):
+        '''
+        Return the server side prepared cursor kept for sql, preparing it on first use.
+        Return None if the driver does not support prepared cursors. Experimental, see
+        create_engine().
+        '''
+        cursor = self.statements.get(sql)
+        if cursor is not None:
+            self.statements.move_to_end(sql)
+            _statements.count('prepared_hits')
+            return cursor
+        try:
+            cursor = self.raw.cursor(prepared=True, buffered=False)
+        except (TypeError, ValueError, NotImplementedError):
+            return None
+        _statements.count('prepared_misses')
+        self.statements[sql] = cursor
+        self._prepared[id(cursor)] = sql
+        while len(self.statements) > _MAX_PREPARED:
+            old_sql, old = self.statements.popitem(last=False)
+            self._close_prepared(old)
+        return cursor
+
+    def _close_prepared(self, cursor):
+        self._prepared.pop(id(cursor), None)
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+    def close_cursor(self, cursor, broken=False):
+        '''
+        Close a plain cursor. A prepared cursor stays open for reuse, only its unread
+        rows are consumed, unless it is broken.
+        '''
+        sql = self._prepared.get(id(cursor))
+        if sql is None:
+            cursor.close()
+            return
+        if not broken:
+            try:
+                if cursor.description:
+                    cursor.fetchall()
+                return
+            except Exception:
+                pass
+        self.statements.pop(sql, None)
+        self._close_prepared(cursor)
+
+    def commit(self):
+        self.raw.commit()
 
-    def __init__(self, connect):
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        for cursor in list(self.statements.values()):
+            self._close_prepared(cursor)
+        self.statements.clear()
+        try:
+            self.raw.close()
+        except Exception:
+            _log.warning('close connection <0x%x> failed.', id(self))
+
+# max prepared statements kept per connection:
+_MAX_PREPARED = 64
+
+class _ConnectionPool(object):
+    '''
+    Bounded, thread-safe pool of database connections.
+    min_size: connections opened by warm_up() and kept even when idle.
+    max_size: hard limit of open connections, acquire() waits when reached.
+    timeout: seconds acquire() waits for a free connection before PoolTimeoutError.
+    max_lifetime: seconds after which a connection is closed instead of reused.
+    max_idle: seconds an idle connection above min_size is kept before reaped.
+    ping: ping connections idle longer than this many seconds on checkout,
+          0 pings on every checkout and None disables health checks.
+    '''
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10.0, max_lifetime=3600.0, max_idle=600.0, ping=30.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise DBError('Invalid pool size: min=%s, max=%s.' % (min_size, max_size))
         self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.ping = ping
+        self._idle = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._counters = dict(created=0, closed=0, checkouts=0, waits=0, wait_time=0.0, timeouts=0, ping_failures=0)
+
+    def _create(self):
+        conn = _PooledConnection(self._connect())
+        with self._cond:
+            self._counters['created'] += 1
+        _log.info('open connection <0x%x>...', id(conn))
+        return conn
+
+    def _discard(self, conns):
+        for conn in conns:
+            _log.info('close connection <0x%x>...', id(conn))
+            conn.close()
+        if conns:
+            with self._cond:
+                self._counters['closed'] += len(conns)
+
+    def _expired(self, conn, now):
+        return self.max_lifetime is not None and now - conn.created_at > self.max_lifetime
+
+    def _reap(self, now):
+        '''
+        Remove expired and long idle connections, must be called with the lock held.
+        The idle deque is ordered by last use so the stale ones are at the left.
+        '''
+        reaped = []
+        for conn in list(self._idle):
+            too_idle = self.max_idle is not None and now - conn.last_used > self.max_idle \
+                and self._size - len(reaped) > self.min_size
+            if too_idle or self._expired(conn, now):
+                self._idle.remove(conn)
+                reaped.append(conn)
+        self._size = self._size - len(reaped)
+        return reaped
+
+    def _healthy(self, conn, now):
+        if self.ping is None or now - conn.last_used < self.ping:
+            return True
+        try:
+            conn.raw.ping()
+            return True
+        except Exception:
+            with self._cond:
+                self._counters['ping_failures'] += 1
+            _log.warning('connection <0x%x> failed health check.', id(conn))
+            return False
+
+    def warm_up(self):
+        '''
+        Open connections until min_size connections are in the pool.
+        '''
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size = self._size + 1
+            try:
+                conn = self._create()
+            except:
+                with self._cond:
+                    self._size = self._size - 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def acquire(self):
+        '''
+        Check out a connection, waiting up to timeout seconds if the pool is exhausted.
+        '''
+        start = time.time()
+        deadline = None
+        while True:
+            conn = None
+            reaped = []
+            try:
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            raise DBError('Connection pool is closed.')
+                        now = time.time()
+                        reaped.extend(self._reap(now))
+                        if self._idle:
+                            conn = self._idle.pop()
+                            break
+                        if self._size < self.max_size:
+                            self._size = self._size + 1
+                            break
+                        if deadline is None:
+                            deadline = start + self.timeout
+                            self._counters['waits'] += 1
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self._counters['timeouts'] += 1
+                            self._counters['wait_time'] += now - start
+                            raise PoolTimeoutError('Timeout waiting for connection after %.3f seconds.' % (now - start))
+                        self._cond.wait(remaining)
+                    self._in_use = self._in_use + 1
+            finally:
+                self._discard(reaped)
+            if conn is None:
+                try:
+                    conn = self._create()
+                except:
+                    self._forget()
+                    raise
+            elif not self._healthy(conn, now):
+                self._forget()
+                self._discard([conn])
+                continue
+            with self._cond:
+                self._counters['checkouts'] += 1
+                if deadline is not None:
+                    self._counters['wait_time'] += time.time() - start
+            return conn
+
+    def _forget(self):
+        with self._cond:
+            self._in_use = self._in_use - 1
+            self._size = self._size - 1
+            self._cond.notify()
+
+    def release(self, conn, discard=False):
+        '''
+        Return a checked out connection. Any open transaction is rolled back first so
+        the next user does not see a stale snapshot.
+        '''
+        if not discard and getattr(conn.raw, 'in_transaction', True):
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        now = time.time()
+        with self._cond:
+            self._in_use = self._in_use - 1
+            if discard or self._closed or self._expired(conn, now):
+                self._size = self._size - 1
+            else:
+                conn.last_used = now
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._discard([conn])
+
+    def close(self):
+        '''
+        Close idle connections and refuse new checkouts. Connections still in use are
+        closed when they are released.
+        '''
+        with self._cond:
+            self._closed = True
+            conns = list(self._idle)
+            self._idle.clear()
+            self._size = self._size - len(conns)
+            self._cond.notify_all()
+        self._discard(conns)
+
+    def stats(self):
+        with self._cond:
+            d = dict(self._counters)
+            d.update(size=self._size, idle=len(self._idle), in_use=self._in_use, min_size=self.min_size, max_size=self.max_size)
+        return d
+
+class _Engine(object):
+
+    is_async = False
+
+    def __init__(self, connect, executor_workers=None, prepared=False, **pool_kw):
+        self._pool = _ConnectionPool(connect, **pool_kw)
+        self.prepared = prepared
+        # no more threads than connections, so a worker never waits for the pool:
+        workers = executor_workers or self._pool.max_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transwarp-db')
 
     def connect(self):
-        return self._connect()
+        return self._pool.acquire()
+
+    def release(self, connection, discard=False):
+        self._pool.release(connection, discard)
+
+    def warm_up(self):
+        self._pool.warm_up()
+
+    def stats(self):
+        return self._pool.stats()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self._pool.close()
+
+# create_engine() keyword -> _ConnectionPool argument:
+_POOL_ARGS = dict(pool_min_size='min_size', pool_max_size='max_size', pool_timeout='timeout',
+    pool_max_lifetime='max_lifetime', pool_max_idle='max_idle', pool_ping='ping')
 
 def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
-    import mysql.connector
-    global engine
+    '''
+    Create the global engine. Keyword arguments starting with 'pool_' configure the
+    connection pool (see _ConnectionPool), executor_workers bounds the threads used by
+    the *_async functions, prepared_statements=True keeps server side prepared
+    statements per pooled connection (experimental, so far only tested against
+    transwarp.fakedb) and the others are passed to mysql.connector.
+    engine selects the engine type: 'mysql' (default) is the blocking engine used by
+    all functions of this module, 'aiomysql' and 'fake' create an async engine (see
+    transwarp.aiodb) that only serves the *_async functions. 'fake_mysql' is the
+    blocking engine over transwarp.fakedb instead of a server, with fake_latency
+    seconds per round trip.
+    '''
+    global engine, _aborting
     if engine is not None:
         raise DBError('Engine is already initialized.')
-    params = dict(user=user, password=password, database=database, host=host, port=port)
-    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
-    for k, v in defaults.items():
-        params[k] = kw.pop(k, v)
-    params.update(kw)
-    params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
-    # test connection...
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    _aborting = False
+    kind = kw.pop('engine', 'mysql')
+    # statement_cache_size has no cache to bound any more, accepted for old configs:
+    kw.pop('statement_cache_size', None)
+    if kind not in ('mysql', 'fake_mysql'):
+        from transwarp import aiodb
+        engine = aiodb.create_engine(kind, user, password, database, host, port, **kw)
+        return
+    engine_kw = dict(executor_workers=kw.pop('executor_workers', None), prepared=kw.pop('prepared_statements', False))
+    for k, v in _POOL_ARGS.items():
+        if k in kw:
+            engine_kw[v] = kw.pop(k)
+    if kind == 'fake_mysql':
+        from transwarp import fakedb
+        latency = kw.pop('fake_latency', 0.0)
+        fakedb.reset(database)
+        connect = lambda: fakedb.connect(database, latency)
+    else:
+        import mysql.connector
+        params = dict(user=user, password=password, database=database, host=host, port=port)
+        defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
+        for k, v in defaults.items():
+            params[k] = kw.pop(k, v)
+        params.update(kw)
+        params['buffered'] = True
+        connect = lambda: mysql.connector.connect(**params)
+    e = _Engine(connect, **engine_kw)
+    # open min_size connections, which also tests the connection settings, and only
+    # publish the engine when they work:
+    try:
+        e.warm_up()
+    except:
+        e.close()
+        raise
+    engine = e
+    _log.info('Init %s engine <0x%x> ok.', kind, id(engine))
+
+def close_engine():
+    '''
+    Close the global engine and forget it, so create_engine() can be called again. The
+    blocking engine waits for the statements running in its executor, so this blocks;
+    an async engine returns an awaitable that closes its pool.
+    '''
+    global engine
+    e, engine = engine, None
+    if e is None:
+        return None
+    _log.info('close engine <0x%x>...', id(e))
+    return e.close()
+
+def abort_transactions():
+    '''
+    Make the outermost transactions still running roll back instead of commit, for the
+    work of requests cut off at shutdown: a statement running in an executor thread
+    cannot be cancelled, but its transaction will not commit.
+    '''
+    global _aborting
+    _aborting = True
+
+def resume_transactions():
+    '''
+    Let transactions commit again after abort_transactions(), for a server that serves
+    again after a shutdown with the engine it already had.
+    '''
+    global _aborting
+    _aborting = False
+
+def pool_stats():
+    '''
+    Return statistics of the engine's connection pool as dict.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    return engine.stats()
 
 class _ConnectionCtx(object):
     '''
@@ -188,7 +719,7 @@ class _TransactionCtx(object):
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions = _db_ctx.transactions + 1
-        logging.info('begin transaction...' if _db_ctx.transactions==1 else 'join current transaction...')
+        _log.info('begin transaction...' if _db_ctx.transactions==1 else 'join current transaction...')
         return self
 
     def __exit__(self, exctype, excvalue, traceback):
@@ -196,8 +727,10 @@ class _TransactionCtx(object):
         _db_ctx.transactions = _db_ctx.transactions - 1
         try:
             if _db_ctx.transactions==0:
-                if exctype is None:
+                queue, _db_ctx.after_commit = _db_ctx.after_commit, []
+                if exctype is None and not _aborting:
                     self.commit()
+                    _run_after_commit(queue)
                 else:
                     self.rollback()
         finally:
@@ -206,21 +739,21 @@ class _TransactionCtx(object):
 
     def commit(self):
         global _db_ctx
-        logging.info('commit transaction...')
+        _log.info('commit transaction...')
         try:
             _db_ctx.connection.commit()
-            logging.info('commit ok.')
+            _log.info('commit ok.')
         except:
-            logging.warning('commit failed. try rollback...')
+            _log.warning('commit failed. try rollback...')
             _db_ctx.connection.rollback()
-            logging.warning('rollback ok.')
+            _log.warning('rollback ok.')
             raise
 
     def rollback(self):
         global _db_ctx
-        logging.warning('rollback transaction...')
+        _log.warning('rollback transaction...')
         _db_ctx.connection.rollback()
-        logging.info('rollback ok.')
+        _log.info('rollback ok.')
 
 def transaction():
     '''
@@ -270,9 +803,11 @@ def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kw):
         _start = time.time()
-        with _TransactionCtx():
-            return func(*args, **kw)
-        _profiling(_start)
+        try:
+            with _TransactionCtx():
+                return func(*args, **kw)
+        finally:
+            _profiling(_start, 'transaction %s' % func.__name__)
     return _wrapper
 
 def _select(sql, first, *args):
@@ -281,21 +816,25 @@ def _select(sql, first, *args):
     cursor = None
     #sql = sql.replace('?', '%s')
     #logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    start = time.time()
     try:
         #cursor = _db_ctx.connection.cursor()
         #cursor.execute(sql, args)
         cursor = _db_ctx.connection.execute(sql, args)
         if cursor.description:
-            names = [x[0] for x in cursor.description]
+            columns = Row.Columns([x[0] for x in cursor.description])
         if first:
             values = cursor.fetchone()
+            _db_ctx.connection.record(sql, start, values and 1 or 0)
             if not values:
                 return None
-            return Dict.Dict(names, values)
-        return [Dict.Dict(names, x) for x in cursor.fetchall()]
+            return Row.Row(columns, values)
+        L = [Row.Row(columns, x) for x in cursor.fetchall()]
+        _db_ctx.connection.record(sql, start, len(L))
+        return L
     finally:
-        if cursor:
-            cursor.close()
+        if cursor is not None:
+            _db_ctx.connection.close_cursor(cursor)
 
 @with_connection
 def select_one(sql, *args):
@@ -346,7 +885,7 @@ def select_int(sql, *args):
     d = _select(sql, True, *args)
     if len(d)!=1:
         raise MultiColumnsError('Expect only one column.')
-    return d.values()[0]
+    return list(d.values())[0]
 
 @with_connection
 def select(sql, *args):
@@ -372,24 +911,139 @@ def select(sql, *args):
     '''
     return _select(sql, False, *args)
 
+def iter_select(sql, *args, batch_size=100):
+    '''
+    Execute select SQL and yield rows one by one, reading them from an unbuffered
+    cursor batch_size rows at a time, so memory stays flat for any result size.
+    The generator checks out its own connection and holds it until it is exhausted or
+    closed; inside a transaction it reads through the transaction's connection, which
+    must not run other statements until the generator is done.
+    >>> [u.id for u in iter_select('select * from user where id in (?, ?) order by id', 200, 201, batch_size=1)]
+    [200, 201]
+    '''
+    global _db_ctx
+    if _db_ctx.is_init() and _db_ctx.transactions > 0:
+        connection = _db_ctx.connection._connect()
+        owned = False
+    else:
+        connection = engine.connect()
+        owned = True
+    cursor = None
+    exhausted = False
+    # time spent in the database only, not in the consumer of the rows:
+    elapsed = 0.0
+    n = 0
+    try:
+        translated = sql.replace('?', '%s')
+        if _sql_log.isEnabledFor(logging.INFO):
+            _sql_log.info('SQL: %s, ARGS: %s', translated, args)
+        start = time.time()
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(translated, args)
+        columns = Row.Columns([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            elapsed = elapsed + time.time() - start
+            if not rows:
+                break
+            n = n + len(rows)
+            for values in rows:
+                yield Row.Row(columns, values)
+            start = time.time()
+        exhausted = True
+        _query_stats.record(sql, elapsed, n)
+    finally:
+        if cursor is not None and not exhausted and not owned:
+            # the shared connection must be usable again, read the rest away:
+            while cursor.fetchmany(batch_size):
+                pass
+            exhausted = True
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                exhausted = False
+        if owned:
+            # a connection with unread rows is cheaper to drop than to drain:
+            engine.release(connection, discard=not exhausted)
+
+# functions called with the table name after a statement wrote to it:
+_write_listeners = []
+
+_WRITE_RE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update(?:\s+ignore)?|delete\s+from|truncate(?:\s+table)?)\s+`?(\w+)`?', re.I)
+
+def add_write_listener(func):
+    '''
+    Register func(table) to be called after insert(), insert_many() or update() ran a
+    statement that writes table, so caches over the table can be invalidated. Inside a
+    transaction the call waits until it commits (see after_commit()) and runs in the
+    context variables of the statement.
+    '''
+    _write_listeners.append(func)
+
+def _notify_write(sql):
+    if _write_listeners:
+        m = _WRITE_RE.match(sql)
+        if m:
+            ctx = contextvars.copy_context()
+            for func in _write_listeners:
+                after_commit(functools.partial(ctx.run, func, m.group(1)))
+
+def _after_commit_queue():
+    ' the after_commit() queue of the current transaction, None outside a transaction. '
+    if _db_ctx.transactions > 0:
+        return _db_ctx.after_commit
+    if _is_async():
+        ctx = _aiodb()._current()
+        if ctx is not None and ctx.transactions > 0:
+            return ctx.after_commit
+    return None
+
+def after_commit(func):
+    '''
+    Call func() when the current transaction commits, or at once outside a transaction.
+    The functions queued by a transaction that rolls back are dropped. Caches call
+    their invalidation through this, so another connection cannot read the old row
+    and cache it again after the invalidation but before the commit.
+    '''
+    queue = _after_commit_queue()
+    if queue is None:
+        func()
+    else:
+        queue.append(func)
+
+def _run_after_commit(queue):
+    for func in queue:
+        try:
+            func()
+        except Exception:
+            # the transaction is committed, a failing hook must not look like a rollback:
+            _log.exception('after commit function %r failed.', func)
+
+def in_transaction():
+    '''
+    Return True if the current thread, or task with an async engine, is in a transaction.
+    '''
+    return _after_commit_queue() is not None
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    start = time.time()
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        cursor = _db_ctx.connection.execute(sql, args)
         r = cursor.rowcount
         if _db_ctx.transactions==0:
             # no transaction enviroment:
-            logging.info('auto commit')
+            _sql_log.info('auto commit')
             _db_ctx.connection.commit()
+        _db_ctx.connection.record(sql, start, affected=max(r, 0))
+        _notify_write(sql)
         return r
     finally:
-        if cursor:
-            cursor.close()
+        if cursor is not None:
+            _db_ctx.connection.close_cursor(cursor)
 
 def insert(table, **kw):
     '''
@@ -405,10 +1059,65 @@ def insert(table, **kw):
       ...
     IntegrityError: 1062 (23000): Duplicate entry '2000' for key 'PRIMARY'
     '''
-    cols, args = zip(*kw.iteritems())
+    cols, args = zip(*kw.items())
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+# default batch limits of insert_many():
+INSERT_MANY_ROWS = 500
+INSERT_MANY_BYTES = 1024 * 1024
+
+def _arg_size(v):
+    if isinstance(v, (str, bytes)):
+        return len(v) + 2
+    return 8
+
+def _insert_batches(table, rows, max_rows, max_bytes):
+    '''
+    Split rows into multi-row insert statements, yield (sql, args) per batch.
+    '''
+    if max_rows is None:
+        max_rows = INSERT_MANY_ROWS
+    if max_bytes is None:
+        max_bytes = INSERT_MANY_BYTES
+    cols = None
+    batch = []
+    size = 0
+    for row in rows:
+        if cols is None:
+            cols = list(row.keys())
+            head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+            values = '(%s)' % ','.join(['?' for col in cols])
+        elif len(row) != len(cols):
+            raise DBError('All rows of insert_many must have the same columns.')
+        args = [row[col] for col in cols]
+        n = len(values) + 1 + sum([_arg_size(v) for v in args])
+        if batch and (len(batch) >= max_rows or size + n > max_bytes):
+            yield head + ','.join([values] * len(batch)), [v for r in batch for v in r]
+            batch = []
+            size = 0
+        batch.append(args)
+        size = size + n
+    if batch:
+        yield head + ','.join([values] * len(batch)), [v for r in batch for v in r]
+
+@with_connection
+def insert_many(table, rows, max_rows=None, max_bytes=None):
+    '''
+    Insert many rows (dicts with the same columns) with multi-row insert statements,
+    each batch holding at most max_rows rows and about max_bytes bytes of values.
+    Outside a transaction every batch is committed once, inside a transaction the
+    transaction decides. Return the number of inserted rows.
+    >>> insert_many('user', [dict(id=3000+i, name='u%s' % i, email='u%s@test.org' % i, passwd='', last_modified=time.time()) for i in range(3)], max_rows=2)
+    3
+    >>> select_int('select count(*) from user where id>=3000 and id<3003')
+    3
+    '''
+    n = 0
+    for sql, args in _insert_batches(table, rows, max_rows, max_bytes):
+        n = n + _update(sql, *args)
+    return n
+
 def update(sql, *args):
     r'''
     Execute update SQL.
@@ -432,6 +1141,90 @@ def update(sql, *args):
     '''
     return _update(sql, *args)
 
+def run_async(func, *args, **kw):
+    '''
+    Run blocking function func in the engine's executor and return an awaitable future:
+    users = yield from run_async(select, 'select * from user')
+    The whole call runs on one executor thread, so it sees one thread-local _DbCtx and
+    the connections and transactions opened by func stay on that thread. Context
+    variables of the caller (such as the ORM identity map) are visible to func.
+    '''
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    loop = asyncio.get_event_loop()
+    # run in a copy of the caller's context, so context variables follow the call:
+    ctx = contextvars.copy_context()
+    return loop.run_in_executor(engine.executor, functools.partial(ctx.run, func, *args, **kw))
+
+def _is_async():
+    return getattr(engine, 'is_async', False)
+
+def select_async(sql, *args):
+    '''
+    Awaitable version of select().
+    '''
+    if _is_async():
+        return _aiodb().select(sql, *args)
+    return run_async(select, sql, *args)
+
+def select_one_async(sql, *args):
+    '''
+    Awaitable version of select_one().
+    '''
+    if _is_async():
+        return _aiodb().select_one(sql, *args)
+    return run_async(select_one, sql, *args)
+
+def select_int_async(sql, *args):
+    '''
+    Awaitable version of select_int().
+    '''
+    if _is_async():
+        return _aiodb().select_int(sql, *args)
+    return run_async(select_int, sql, *args)
+
+def insert_async(table, **kw):
+    '''
+    Awaitable version of insert().
+    '''
+    if _is_async():
+        return _aiodb().insert(table, **kw)
+    return run_async(insert, table, **kw)
+
+def update_async(sql, *args):
+    '''
+    Awaitable version of update().
+    '''
+    if _is_async():
+        return _aiodb().update(sql, *args)
+    return run_async(update, sql, *args)
+
+def insert_many_async(table, rows, max_rows=None, max_bytes=None):
+    '''
+    Awaitable version of insert_many().
+    '''
+    if _is_async():
+        return _aiodb().insert_many(table, rows, max_rows, max_bytes)
+    return run_async(insert_many, table, rows, max_rows, max_bytes)
+
+def transaction_async(func, *args, **kw):
+    '''
+    Run func in a transaction and return an awaitable. With the blocking engine func is
+    a normal function that runs on a single executor thread:
+    def transfer(a, b):
+        update('update account set money=money-1 where id=?', a)
+        update('update account set money=money+1 where id=?', b)
+    yield from transaction_async(transfer, 1, 2)
+    With an async engine func must be a coroutine function using the *_async calls.
+    '''
+    if _is_async():
+        return _aiodb().run_in_transaction(func, *args, **kw)
+    return run_async(with_transaction(func), *args, **kw)
+
+def _aiodb():
+    from transwarp import aiodb
+    return aiodb
+
 if __name__=='__main__':
     logging.basicConfig(level=logging.DEBUG)
     create_engine('web-data', 'web-data', 'test')
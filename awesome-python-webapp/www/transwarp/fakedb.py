@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jiejing Shan'
+
+'''
+Stand-ins for the MySQL drivers backed by a sqlite database, so the engines of db and
+aiodb can be tested and benchmarked without a server. Only the driver is replaced:
+pools, adapters and transactions run their real code.
+connect() mimics a mysql.connector connection and connect_async() an aiomysql one,
+both take %s placeholders and wait latency seconds per round trip. The database is a
+temporary file in WAL mode, so like InnoDB a reader sees the last committed rows
+while another connection is in a transaction, instead of waiting for it.
+'''
+
+import asyncio, atexit, os, sqlite3, tempfile, time
+
+# database name -> file, created by reset():
+_files = dict()
+
+def _path(name):
+	path = _files.get(name)
+	if path is None:
+		reset(name)
+		path = _files[name]
+	return path
+
+def reset(name):
+	'''
+	Create the empty database name, dropping the rows of an older one.
+	'''
+	fd, path = tempfile.mkstemp(prefix='transwarp-fakedb-%s-' % name, suffix='.db')
+	os.close(fd)
+	conn = sqlite3.connect(path)
+	conn.execute('pragma journal_mode=wal')
+	conn.close()
+	_remove(_files.get(name))
+	_files[name] = path
+
+def _remove(path):
+	for f in path and (path, path + '-wal', path + '-shm') or ():
+		try:
+			os.remove(f)
+		except OSError:
+			pass
+
+@atexit.register
+def _cleanup():
+	for path in _files.values():
+		_remove(path)
+
+class Cursor(object):
+	'''
+	DB-API cursor with the attributes of a mysql.connector cursor used by db.
+	'''
+	def __init__(self, conn):
+		self._conn = conn
+		self._cursor = None
+		self.rowcount = -1
+		self.lastrowid = None
+
+	@property
+	def description(self):
+		return self._cursor.description if self._cursor is not None else None
+
+	def execute(self, sql, args=()):
+		self._conn._round_trip()
+		self._cursor = self._conn._sqlite.execute(sql.replace('%s', '?'), tuple(args or ()))
+		self.rowcount = self._cursor.rowcount
+		self.lastrowid = self._cursor.lastrowid
+
+	def fetchone(self):
+		return self._cursor.fetchone()
+
+	def fetchmany(self, size=1):
+		return self._cursor.fetchmany(size)
+
+	def fetchall(self):
+		return self._cursor.fetchall()
+
+	def close(self):
+		if self._cursor is not None:
+			self._cursor.close()
+			self._cursor = None
+
+class Connection(object):
+	'''
+	Blocking connection in the style of mysql.connector: autocommit off, a transaction
+	starts with the first write and ends with commit() or rollback().
+	'''
+	def __init__(self, name, latency=0.0, timeout=5.0):
+		# connections move between the threads of the engine's executor, timeout is
+		# how long a writer waits for the write lock held by another transaction:
+		self._sqlite = sqlite3.connect(_path(name), timeout=timeout, isolation_level='DEFERRED', check_same_thread=False)
+		self._latency = latency
+
+	def _round_trip(self):
+		if self._latency:
+			time.sleep(self._latency)
+
+	@property
+	def in_transaction(self):
+		return self._sqlite.in_transaction
+
+	def cursor(self, buffered=None, prepared=False):
+		# sqlite caches compiled statements by itself, a prepared cursor is a plain one:
+		return Cursor(self)
+
+	def commit(self):
+		self._round_trip()
+		self._sqlite.commit()
+
+	def rollback(self):
+		self._round_trip()
+		self._sqlite.rollback()
+
+	def ping(self, reconnect=False):
+		self._round_trip()
+
+	def close(self):
+		self._sqlite.close()
+
+def connect(name, latency=0.0):
+	'''
+	Open a blocking connection to database name.
+	>>> reset('fakedb_doctest')
+	>>> conn = connect('fakedb_doctest')
+	>>> cursor = conn.cursor()
+	>>> cursor.execute('create table t (id int primary key, name text)')
+	>>> cursor.execute('insert into t (id, name) values (%s, %s)', (1, 'Alice'))
+	>>> cursor.rowcount, cursor.lastrowid, conn.in_transaction
+	(1, 1, True)
+	>>> conn.commit()
+	>>> cursor.execute('select * from t where id=%s', (1,))
+	>>> [x[0] for x in cursor.description], cursor.fetchall()
+	(['id', 'name'], [(1, 'Alice')])
+	>>> cursor.execute('update t set name=%s', ('Bob',))
+	>>> connect('fakedb_doctest').cursor().execute('select name from t') is None
+	True
+	>>> other = connect('fakedb_doctest').cursor()
+	>>> other.execute('select name from t'); other.fetchall()
+	[('Alice',)]
+	>>> conn.rollback(); cursor.close(); conn.close()
+	'''
+	return Connection(name, latency)
+
+class AsyncCursor(object):
+	'''
+	Cursor in the style of aiomysql: execute, fetch and close are coroutines.
+	'''
+	def __init__(self, conn):
+		self._conn = conn
+		self._cursor = Cursor(conn._conn)
+
+	@property
+	def description(self):
+		return self._cursor.description
+
+	@property
+	def rowcount(self):
+		return self._cursor.rowcount
+
+	@property
+	def lastrowid(self):
+		return self._cursor.lastrowid
+
+	@asyncio.coroutine
+	def execute(self, sql, args=None):
+		yield from self._conn._round_trip()
+		self._cursor.execute(sql, args)
+
+	@asyncio.coroutine
+	def fetchall(self):
+		return self._cursor.fetchall()
+
+	@asyncio.coroutine
+	def close(self):
+		self._cursor.close()
+
+class AsyncConnection(object):
+	'''
+	Connection in the style of aiomysql, the latency is awaited on the loop. A writer
+	blocked by another transaction fails at once, waiting would block the loop.
+	'''
+	def __init__(self, name, latency=0.0):
+		self._conn = Connection(name, timeout=0)
+		self._latency = latency
+
+	@asyncio.coroutine
+	def _round_trip(self):
+		yield from asyncio.sleep(self._latency)
+
+	@asyncio.coroutine
+	def cursor(self):
+		return AsyncCursor(self)
+
+	def get_transaction_status(self):
+		return self._conn.in_transaction
+
+	@asyncio.coroutine
+	def commit(self):
+		yield from self._round_trip()
+		self._conn.commit()
+
+	@asyncio.coroutine
+	def rollback(self):
+		yield from self._round_trip()
+		self._conn.rollback()
+
+	@asyncio.coroutine
+	def ping(self, reconnect=True):
+		yield from self._round_trip()
+
+	def close(self):
+		self._conn.close()
+
+@asyncio.coroutine
+def connect_async(name, latency=0.0):
+	'''
+	Open an async connection to database name.
+	'''
+	yield from asyncio.sleep(latency)
+	return AsyncConnection(name, latency)
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jiejing Shan'
+
+'''
+Logging helpers for the request and SQL hot paths.
+Every subsystem logs through its own standard logger, so its level can be set apart
+from the others:
+	transwarp.db       connections, pool and transactions
+	transwarp.sql      every statement with its arguments
+	framework          server start, routes and stop
+	framework.request  request details, sampled, see Sampler
+	framework.access   one structured line per request
+Messages are passed as format and arguments and hot paths check isEnabledFor()
+first, so a disabled message costs neither formatting nor str() of its arguments:
+	if _sql_log.isEnabledFor(logging.INFO):
+		_sql_log.info('SQL: %s, ARGS: %s', sql, args)
+'''
+
+import itertools, json, logging
+
+def get_logger(name):
+	return logging.getLogger(name)
+
+class Sampler(object):
+	'''
+	Say yes to 1 of every `every` calls:
+	>>> s = Sampler(3)
+	>>> [s() for i in range(6)]
+	[True, False, False, True, False, False]
+	'''
+	def __init__(self, every=1):
+		self.every = every
+		self._count = itertools.count()
+
+	def __call__(self):
+		return self.every <= 1 or next(self._count) % self.every == 0
+
+# subsystem name -> Sampler:
+_samplers = dict()
+
+def sampler(name):
+	'''
+	Return the Sampler of subsystem name, shared by all its users.
+	'''
+	s = _samplers.get(name)
+	if s is None:
+		s = _samplers.setdefault(name, Sampler())
+	return s
+
+def _level(level):
+	return level if isinstance(level, int) else logging.getLevelName(level.upper())
+
+def configure(level=None, levels=None, sample=None):
+	'''
+	Set the root level, the levels of subsystems ({name: level}) and their sampling
+	({name: every}), levels are numbers or names like 'INFO'.
+	'''
+	if level is not None:
+		logging.getLogger().setLevel(_level(level))
+	for name, l in (levels or {}).items():
+		logging.getLogger(name).setLevel(_level(l))
+	for name, every in (sample or {}).items():
+		sampler(name).every = every
+
+class Fields(object):
+	'''
+	key=value pairs formatted as one logfmt line when (and only if) the record is emitted:
+	>>> str(Fields(method='GET', path='/a b', status=200, ms=1.5))
+	'method=GET path="/a b" status=200 ms=1.50'
+	'''
+	__slots__ = ('_fields',)
+
+	def __init__(self, **kw):
+		self._fields = kw
+
+	def __str__(self):
+		L = []
+		for k, v in self._fields.items():
+			if isinstance(v, float):
+				v = '%.2f' % v
+			elif v is None:
+				v = '-'
+			else:
+				v = str(v)
+				if not v or ' ' in v or '"' in v or '=' in v:
+					v = json.dumps(v, ensure_ascii=False)
+			L.append('%s=%s' % (k, v))
+		return ' '.join(L)
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
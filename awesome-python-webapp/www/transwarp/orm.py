@@ -7,7 +7,8 @@ __author__ = "Jiejing Shan"
 	using this module for easy to create User, Comment, Blog .etc from database
 '''
 from transwarp import db as db
-import  logging, time
+from transwarp.common import Row as Row
+import  asyncio, base64, collections, contextvars, functools, json, logging, threading, time, weakref
 
 class Field(object):
 	"""define the database's Field"""
@@ -25,6 +26,7 @@ class Field(object):
 		self.foreign_key = kw.get('foreign_key', False)
 		self.foreign_table_name = kw.get('foreign_table_name', None)
 		self.foreign_field = kw.get('foreign_field', None)
+		self.deferrable = kw.get('deferrable', False)
 		self._order = Field._count
 		Field._count = Field._count + 1
 
@@ -81,6 +83,8 @@ class TextField(Field):
 	def __init__(self, **kw):
 		if not 'default' in kw:
 			kw['default'] = ''
+		if not 'deferrable' in kw:
+			kw['deferrable'] = True
 		if not 'ddl' in kw:
 			kw['ddl'] = 'text'
 		super(TextField, self).__init__(**kw)
@@ -89,6 +93,8 @@ class BlobField(Field):
 	def __init__(self, **kw):
 		if not 'default' in kw :
 			kw['default'] = ''
+		if not 'deferrable' in kw:
+			kw['deferrable'] = True
 		if not 'ddl' in kw:
 			kw['ddl'] = 'blob'
 		super(BlobField, self).__init__(**kw)
@@ -104,7 +110,7 @@ def _gen_sql(table_name, mapping):
 	pk = None
 	foreign_keys = []
 	sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
-	for f in sorted(mapping.values(), lambda x, y: cmp(x._order, y._order)):
+	for f in sorted(mapping.values(), key=lambda f: f._order):
 		if not hasattr(f, 'ddl'):
 			raise StandardError('no ddl in field: %s' % f)
 		ddl = f.ddl
@@ -122,6 +128,468 @@ def _gen_sql(table_name, mapping):
 	sql.append(');')
 	return '\n'.join(sql)
 
+def _encode_cursor(order_by, value, key):
+	''' encode the position after the last row of a page as opaque url safe string'''
+	s = json.dumps([order_by, value, key], separators=(',', ':'))
+	return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor, order_by):
+	''' decode a cursor made by _encode_cursor, return (value, key)'''
+	try:
+		name, value, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+	except Exception:
+		raise ValueError('Invalid page cursor: %s' % cursor)
+	if name != order_by:
+		raise ValueError('Page cursor is for order by %s, not %s.' % (name, order_by))
+	return value, key
+
+# max number of keys in one "where pk in (...)" query:
+_IN_CHUNK = 500
+
+class _DeferredGroup(object):
+	'''
+	Objects loaded by one query without their deferred fields. The first access to a
+	deferred field of any of them loads that field for all of them still alive and
+	missing it, with one "where pk in (...)" query per chunk of keys.
+	Attribute access can only load with the blocking db functions, so it raises
+	DBError on a thread running an event loop; coroutines load deferred fields with
+	yield from Model.load_deferred_async(), which goes through the *_async functions.
+	'''
+	def __init__(self, cls, names, objs):
+		self.cls = cls
+		self.names = frozenset(names)
+		pk = cls.__primary_key__.name
+		self._objs = weakref.WeakValueDictionary()
+		for obj in objs:
+			self._objs[obj[pk]] = obj
+
+	def _queries(self, name):
+		' return the objects missing name by key and the queries that load it. '
+		pk = self.cls.__primary_key__.name
+		missing = dict([(key, obj) for key, obj in list(self._objs.items()) if not name in obj])
+		keys = list(missing.keys())
+		queries = []
+		for i in range(0, len(keys), _IN_CHUNK):
+			chunk = keys[i:i + _IN_CHUNK]
+			sql = 'select `%s`, `%s` from `%s` where `%s` in (%s)' % (pk, name, self.cls.__table__, pk, ','.join(['?'] * len(chunk)))
+			queries.append([sql] + chunk)
+		return missing, queries
+
+	def _store(self, name, missing, rows):
+		pk = self.cls.__primary_key__.name
+		for d in rows:
+			obj = missing.pop(d[pk], None)
+			if obj is not None:
+				obj._set_loaded(name, d[name])
+		# rows deleted since the objects were loaded:
+		for obj in missing.values():
+			obj._set_loaded(name, None)
+
+	def load(self, name):
+		if _loop_running():
+			raise db.DBError('Deferred field %s.%s read on the event loop, load it with load_deferred_async() first.' % (self.cls.__name__, name))
+		missing, queries = self._queries(name)
+		rows = []
+		for query in queries:
+			rows.extend(db.select(*query))
+		self._store(name, missing, rows)
+
+	@asyncio.coroutine
+	def load_async(self, name):
+		missing, queries = self._queries(name)
+		rows = []
+		for query in queries:
+			rows.extend((yield from db.select_async(*query)))
+		self._store(name, missing, rows)
+
+def _loop_running():
+	' True on a thread running an event loop, where blocking db calls must not run. '
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		return False
+	return True
+
+def _model_of(table):
+	'''
+	Return the model class of a foreign_table_name, which may name the table or the
+	model class ('user' for class User on table 'users').
+	'''
+	models = _table_models.get(table) or _table_models.get(table + 's')
+	if not models:
+		models = [c for L in _table_models.values() for c in L if c.__name__.lower() == table]
+	return models[-1] if models else None
+
+def _relation(cls, name):
+	'''
+	Return (related model class, its key field, attribute name) of foreign key field
+	name of cls. The related object is attached as name without '_id'.
+	'''
+	field = cls.__mappings__.get(name)
+	if field is None or not field.foreign_key:
+		raise ValueError('%s has no foreign key field: %s' % (cls.__name__, name))
+	related = _model_of(field.foreign_table_name)
+	if related is None:
+		raise ValueError('No model for table %s of %s.%s' % (field.foreign_table_name, cls.__name__, name))
+	attr = name[:-3] if name.endswith('_id') else name + '_obj'
+	if hasattr(cls, attr):
+		raise ValueError('Cannot attach %s.%s as %s, the name is taken' % (cls.__name__, name, attr))
+	return related, field.foreign_field or related.__primary_key__.name, attr
+
+def _prefetch_plan(objs, name):
+	'''
+	Return (related class, key field, attribute name, [(sql, keys)]) to prefetch name
+	of objs, with one "where key in (...)" query per chunk of distinct keys.
+	'''
+	related, key, attr = _relation(type(objs[0]), name)
+	keys = list(set([getattr(obj, name) for obj in objs]) - set([None]))
+	queries = []
+	for i in range(0, len(keys), _IN_CHUNK):
+		chunk = keys[i:i + _IN_CHUNK]
+		queries.append(('select * from `%s` where `%s` in (%s)' % (related.__table__, key, ','.join(['?'] * len(chunk))), chunk))
+	return related, key, attr, queries
+
+def _attach(objs, name, related, key, attr, rows):
+	found = dict([(obj[key], obj) for obj in related._load(rows)])
+	for obj in objs:
+		obj.__dict__[attr] = found.get(obj[name])
+
+def _prefetch(objs, names):
+	for name in names:
+		if objs:
+			related, key, attr, queries = _prefetch_plan(objs, name)
+			rows = []
+			for sql, keys in queries:
+				rows.extend(db.select(sql, *keys))
+			_attach(objs, name, related, key, attr, rows)
+	return objs
+
+@asyncio.coroutine
+def _prefetch_async(objs, names):
+	for name in names:
+		if objs:
+			related, key, attr, queries = _prefetch_plan(objs, name)
+			rows = []
+			for sql, keys in queries:
+				rows.extend((yield from db.select_async(sql, *keys)))
+			_attach(objs, name, related, key, attr, rows)
+	return objs
+
+def prefetch(objs, *names):
+	'''
+	Load the objects referenced by foreign key fields names of objs, all of one model,
+	and attach them as attributes named without '_id': prefetch(comments, 'blog_id',
+	'user_id') sets comment.blog and comment.user (None if the row is gone).
+	Each field costs one query per chunk of distinct keys, however many objs there are.
+	Return objs.
+	'''
+	return _prefetch(objs, names)
+
+@asyncio.coroutine
+def prefetch_async(objs, *names):
+	'''
+	Awaitable version of prefetch().
+	'''
+	return (yield from _prefetch_async(objs, names))
+
+# (model class, primary key) -> object, set by identity_map() for the current context:
+_identity = contextvars.ContextVar('transwarp_orm_identity', default=None)
+
+class _IdentityMapCtx(object):
+	'''
+	Within the context repeated primary key lookups return the same object, see identity_map().
+	'''
+	def __enter__(self):
+		self._token = None
+		if _identity.get() is None:
+			self._token = _identity.set(dict())
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		if self._token is not None:
+			_identity.reset(self._token)
+
+def identity_map():
+	'''
+	Return an identity map context, can be nested and only the outermost has effect:
+	with identity_map():
+		u1 = User.get(id)
+		u2 = User.find_first('id=?', id)  # u1 is u2
+	Model.get() returns the mapped object without a query and the finders return mapped
+	objects instead of new copies. insert/update/delete keep the map up to date, raw
+	db.update() calls do not. The map lives in a context variable, so it follows
+	coroutines and the *_async calls into the db executor; the framework middleware
+	framework.identity_map_factory gives every request its own map.
+	'''
+	return _IdentityMapCtx()
+
+def _identity_get(cls, pk):
+	identity = _identity.get()
+	return identity.get((cls, pk)) if identity is not None else None
+
+def _identity_put(obj):
+	identity = _identity.get()
+	if identity is not None:
+		identity[(obj.__class__, obj[obj.__primary_key__.name])] = obj
+
+def _identity_pop(obj):
+	identity = _identity.get()
+	if identity is not None:
+		identity.pop((obj.__class__, obj[obj.__primary_key__.name]), None)
+
+class _ReadCache(object):
+	'''
+	Thread-safe LRU cache of rows by primary key with TTL, in front of Model.get().
+	Missing rows are cached as None for negative_ttl seconds (0 disables it).
+	Every invalidation bumps the generation, so a row read before an invalidation
+	is not stored after it.
+	'''
+	def __init__(self, size=1000, ttl=60.0, negative_ttl=5.0):
+		self.size = size
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.generation = 0
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._counters = dict(hits=0, negative_hits=0, misses=0, evictions=0, expirations=0, invalidations=0)
+
+	def get(self, pk):
+		'''
+		Return (True, row or None) on a hit, (False, None) on a miss.
+		'''
+		with self._lock:
+			entry = self._data.get(pk)
+			if entry is not None:
+				if entry[0] > time.time():
+					self._data.move_to_end(pk)
+					self._counters[entry[1] is None and 'negative_hits' or 'hits'] += 1
+					return True, entry[1]
+				del self._data[pk]
+				self._counters['expirations'] += 1
+			self._counters['misses'] += 1
+			return False, None
+
+	def put(self, pk, row, generation):
+		ttl = self.ttl if row is not None else self.negative_ttl
+		if not ttl:
+			return
+		with self._lock:
+			if generation != self.generation:
+				return
+			self._data[pk] = (time.time() + ttl, row)
+			self._data.move_to_end(pk)
+			while len(self._data) > self.size:
+				self._data.popitem(last=False)
+				self._counters['evictions'] += 1
+
+	def invalidate(self, pk=None):
+		'''
+		Drop the row of pk, or every row if pk is None.
+		'''
+		with self._lock:
+			self.generation = self.generation + 1
+			self._counters['invalidations'] += 1
+			if pk is None:
+				self._data.clear()
+			else:
+				self._data.pop(pk, None)
+
+	def stats(self):
+		with self._lock:
+			d = dict(self._counters)
+			d.update(size=len(self._data), max_size=self.size)
+		return d
+
+class _GetBatcher(object):
+	'''
+	DataLoader style batcher of Model.get_async(): the keys asked within one event loop
+	tick, or window seconds, are deduped and loaded with one "where pk in (...)" query
+	per chunk, then every waiting caller gets its row.
+	The server compares keys with the column's type and collation, so 1 finds the row
+	'1' and 'ABC' the row 'abc': rows are matched to keys by _batch_key(), and a key
+	matching several rows that way is loaded on its own, like a key matching none
+	whose type is not the column's ('01' or 1.0 for an integer column), so batching
+	never changes what get_async() returns.
+	'''
+	def __init__(self, cls, window=0.0):
+		self.cls = cls
+		self.window = window
+		self._loop = None
+		self._pending = collections.OrderedDict()
+		self._counters = dict(requests=0, deduped=0, batches=0, queries=0, fallbacks=0)
+
+	def load(self, pk):
+		'''
+		Return a future of the row of pk, None if there is no such row.
+		'''
+		loop = asyncio.get_event_loop()
+		if loop is not self._loop:
+			self._loop = loop
+			self._pending = collections.OrderedDict()
+		self._counters['requests'] += 1
+		future = self._pending.get(pk)
+		if future is not None:
+			self._counters['deduped'] += 1
+		else:
+			if not self._pending:
+				if self.window:
+					loop.call_later(self.window, self._dispatch)
+				else:
+					loop.call_soon(self._dispatch)
+			future = self._pending[pk] = loop.create_future()
+		# a cancelled caller must not cancel the others waiting for the same key:
+		return asyncio.shield(future)
+
+	def _dispatch(self):
+		pending = self._pending
+		self._pending = collections.OrderedDict()
+		self._counters['batches'] += 1
+		task = asyncio.ensure_future(self._run(pending))
+		task.add_done_callback(functools.partial(self._finish, pending))
+
+	@asyncio.coroutine
+	def _run(self, pending):
+		pk = self.cls.__primary_key__.name
+		types = _key_types(self.cls.__primary_key__)
+		keys = list(pending.keys())
+		for i in range(0, len(keys), _IN_CHUNK):
+			chunk = keys[i:i + _IN_CHUNK]
+			self._counters['queries'] += 1
+			sql = 'select * from `%s` where `%s` in (%s)' % (self.cls.__table__, pk, ','.join(['?'] * len(chunk)))
+			found = dict()
+			for d in (yield from db.select_async(sql, *chunk)):
+				found.setdefault(_batch_key(d[pk]), []).append(d)
+			for key in chunk:
+				rows = found.get(_batch_key(key), ())
+				if len(rows) > 1 or not rows and type(key) not in types:
+					self._counters['fallbacks'] += 1
+					self._counters['queries'] += 1
+					rows = [(yield from db.select_one_async(self.cls.__get_sql__, key))]
+				future = pending[key]
+				if not future.done():
+					future.set_result(rows[0] if rows else None)
+
+	def _finish(self, pending, task):
+		' fail the callers left waiting when the batch raised or was cancelled. '
+		error = None if task.cancelled() else task.exception()
+		for future in pending.values():
+			if future.done():
+				continue
+			if error is None:
+				future.cancel()
+			else:
+				future.set_exception(error)
+
+	def stats(self):
+		d = dict(self._counters)
+		d['saved'] = d['requests'] - d['queries']
+		return d
+
+def _batch_key(key):
+	'''
+	Normalize a primary key the way MySQL compares it with the default collation:
+	numbers and strings by their text, strings case-insensitive and without trailing
+	spaces.
+	'''
+	if isinstance(key, bytes):
+		key = key.decode('utf-8', 'replace')
+	elif isinstance(key, bool) or not isinstance(key, (str, int)):
+		return key
+	return str(key).rstrip(' ').lower()
+
+def _key_types(field):
+	' the types of the keys _batch_key() matches exactly to the values of field. '
+	if isinstance(field, (IntegerField, VersionField)):
+		return (int,)
+	if isinstance(field, (StringField, TextField)):
+		return (str,)
+	return ()
+
+# model class -> _GetBatcher, set by enable_get_batching():
+_get_batchers = dict()
+_get_batch_window = None
+
+def enable_get_batching(window=0.0):
+	'''
+	Batch the concurrent get_async() calls of every model, made within one event loop
+	tick or window seconds. Calls in a transaction or with only/defer are not batched.
+	'''
+	global _get_batch_window
+	_get_batch_window = window
+	_get_batchers.clear()
+
+def disable_get_batching():
+	global _get_batch_window
+	_get_batch_window = None
+	_get_batchers.clear()
+
+def get_batching_stats():
+	'''
+	Return batcher counters by model name; saved is the number of queries not run.
+	'''
+	return dict([(cls.__name__, b.stats()) for cls, b in list(_get_batchers.items())])
+
+def _get_batcher(cls):
+	if _get_batch_window is None or db.in_transaction():
+		return None
+	batcher = _get_batchers.get(cls)
+	if batcher is None:
+		batcher = _get_batchers[cls] = _GetBatcher(cls, _get_batch_window)
+	return batcher
+
+# table name -> model classes mapped to it:
+_table_models = dict()
+
+# set while a Model method writes, so its own statement does not flush the whole cache:
+_model_write = contextvars.ContextVar('transwarp_orm_model_write', default=False)
+
+class _ModelWriteCtx(object):
+
+	def __enter__(self):
+		self._token = _model_write.set(True)
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		_model_write.reset(self._token)
+
+def _on_table_write(table):
+	'''
+	raw statements may change any row of table, drop all cached rows of its models.
+	Called by db after the statement's transaction commits.
+	'''
+	if _model_write.get():
+		return
+	for cls in _table_models.get(table, ()):
+		if cls.__cache_store__ is not None:
+			cls.__cache_store__.invalidate()
+
+db.add_write_listener(_on_table_write)
+
+def _default_factory(field):
+	d = field._default
+	return d if callable(d) else lambda: d
+
+def _compile(attrs, mapping, primary_key):
+	'''
+	Store the statements of get(), insert(), update(), delete() and count_all() and the
+	ordered (name, default callable) lists of insertable and updatable fields in attrs,
+	so the per call work of those methods is collecting the arguments.
+	'''
+	table = attrs['__table__']
+	pk = primary_key.name
+	fields = sorted(mapping.items(), key=lambda kv: kv[1]._order)
+	inserts = tuple([(k, _default_factory(v)) for k, v in fields if v.insertable])
+	updates = tuple([(k, _default_factory(v)) for k, v in fields if v.updatable])
+	attrs['__insert_fields__'] = inserts
+	attrs['__update_fields__'] = updates
+	attrs['__get_sql__'] = 'select * from `%s` where `%s`=?' % (table, pk)
+	attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % k for k, d in inserts]), ','.join(['?'] * len(inserts)))
+	attrs['__update_sql__'] = updates and 'update `%s` set %s where `%s`=?' % (table, ','.join(['`%s`=?' % k for k, d in updates]), pk) or None
+	# column names tuple -> update SQL of only those columns, see Model._update_sql():
+	attrs['__update_sqls__'] = updates and {tuple([k for k, d in updates]): attrs['__update_sql__']} or {}
+	attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table, pk)
+	attrs['__count_sql__'] = 'select count(`%s`) from `%s`' % (pk, table)
+
 class ModelMetaClass(type):
 	'''
 	Metaclass for model class object
@@ -142,7 +610,7 @@ class ModelMetaClass(type):
 		logging.info('Scan ORMapping %s ....' % name)
 		mapping = dict()
 		primary_key = None
-		for k, v in attrs.iteritems():
+		for k, v in attrs.items():
 			if isinstance(v, Field):
 				if not v.name:
 					v.name = k
@@ -164,7 +632,7 @@ class ModelMetaClass(type):
 		if not primary_key:
 			raise TypeError('Primary key not defined in class : %s' % name)
 		# pop all attributes form attrs which in the mapping
-		for k in mapping.iterkeys():
+		for k in mapping.keys():
 			attrs.pop(k)
 		#define default table name in class
 		if not '__table__' in attrs:
@@ -172,12 +640,18 @@ class ModelMetaClass(type):
 		attrs['__mappings__'] = mapping
 		attrs['__primary_key__'] = primary_key
 		attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mapping)
+		_compile(attrs, mapping, primary_key)
 		for trigger in _triggers:
 			if not trigger in attrs:
 				attrs[trigger] = None
-		return type.__new__(cls, name, base, attrs)
+		# per class read-through cache of get(), configured by __cache__ = dict(size=, ttl=, negative_ttl=):
+		cache = attrs.get('__cache__')
+		attrs['__cache_store__'] = _ReadCache(**cache) if cache else None
+		new_cls = type.__new__(cls, name, base, attrs)
+		_table_models.setdefault(attrs['__table__'], []).append(new_cls)
+		return new_cls
 
-class Model(dict):
+class Model(dict, metaclass=ModelMetaClass):
 	'''
     Base class for ORM.
     >>> class User(Model):
@@ -224,61 +698,153 @@ class Model(dict):
     );
     '''
 
-	__metaclass__ = ModelMetaClass
+	# read cache config, see _ReadCache:
+	__cache__ = None
+	__cache_store__ = None
+
+	# per object state in slots, so loading an object allocates no __dict__:
+	# _original, _original_columns: values tuple and name -> index Columns of the values
+	#     as loaded or last written, for the dirty check of _update_query(), or None.
+	# _deferred: the _DeferredGroup loading the fields left out of the select, or None.
+	__slots__ = ('_original', '_original_columns', '_deferred')
 
 	def __init__(self, **kw):
    		super(Model, self).__init__(**kw)
+   		_set_original(self, None)
+   		_set_original_columns(self, None)
+   		_set_deferred(self, None)
 
 	def __getattr__(self, key):
    		try :
    			return self[key]
    		except KeyError:
+   			if not key in Model.__slots__ and self._is_deferred(key):
+   				self._deferred.load(key)
+   				return self[key]
    			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
 	def __setattr__(self, key, value):
    		self[key] = value
 
 	@classmethod
-	def get(cls, pk):
+	def get(cls, pk, only=None, defer=None):
    		'''
-   		Get by primary key
+   		Get by primary key.
+   		only and defer limit the loaded columns, see _columns().
    		'''
-   		d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-   		return cls(**d) if d else None
+   		obj = _identity_get(cls, pk)
+   		if obj is not None:
+   			return obj
+   		cache = cls._read_cache(only, defer)
+   		if cache is not None:
+   			found, d = cache.get(pk)
+   			if found:
+   				return cls._load_one(d)
+   			generation = cache.generation
+   		cols, deferred = cls._columns(only, defer)
+   		d = db.select_one(*cls._get_query(pk, cols))
+   		if cache is not None and not db.in_transaction():
+   			cache.put(pk, d, generation)
+   		return cls._load_one(d, deferred)
 
 	@classmethod
-	def find_first(cls, where, *args):
+	def find_first(cls, where, *args, only=None, defer=None, prefetch=None):
    		'''
    		Find by where clause and return one result. If multiple results found,
    		only the first one returned. If no results found, return None.
    		'''
-   		d = db.select_one('select * from %s where %s' % (cls.__table__, where), *args)
-   		return cls(**d) if d else None
+   		cols, deferred = cls._columns(only, defer)
+   		d = db.select_one('select %s from %s where %s' % (cols, cls.__table__, where), *args)
+   		obj = cls._load_one(d, deferred)
+   		prefetch and obj is not None and _prefetch([obj], prefetch)
+   		return obj
 
 	@classmethod
-	def find_by(cls, where, *args):
+	def find_by(cls, where, *args, only=None, defer=None, prefetch=None):
    		'''
    		Find by where clause and return list.
+   		prefetch names foreign key fields whose related objects are attached to the
+   		results with one query per chunk of keys, see prefetch().
    		'''
-   		sql = 'select * from %s where %s' % (cls.__table__, where)
+   		cols, deferred = cls._columns(only, defer)
+   		sql = 'select %s from %s where %s' % (cols, cls.__table__, where)
 
    		d = db.select(sql, *args)
-   		return [cls(**i) for l in d]
+   		L = cls._load(d, deferred)
+   		prefetch and _prefetch(L, prefetch)
+   		return L
 
 	@classmethod
-	def find_all(cls, *args):
+	def find_all(cls, *args, only=None, defer=None, prefetch=None):
    		'''
    		Find all and return list.
    		'''
-   		L = db.select('select * from %s' % cls.__table__)
-   		return [cls(**l) for l in L]
+   		cols, deferred = cls._columns(only, defer)
+   		L = cls._load(db.select('select %s from %s' % (cols, cls.__table__)), deferred)
+   		prefetch and _prefetch(L, prefetch)
+   		return L
+
+	@classmethod
+	def iter_by(cls, where, *args, batch_size=100):
+   		'''
+   		Find by where clause and yield objects one by one (see db.iter_select), for
+   		scanning big tables without loading them into memory.
+   		'''
+   		for d in db.iter_select('select * from %s where %s' % (cls.__table__, where), *args, batch_size=batch_size):
+   			yield cls._hydrate(d)
+
+	@classmethod
+	def find_page(cls, order_by='created_at', after=None, limit=20, desc=True, where=None, args=(), only=None, defer=None, prefetch=None):
+   		'''
+   		Keyset (seek) pagination ordered by column order_by with the primary key as tie
+   		breaker, so an index on order_by serves every page in O(limit) however deep it is.
+   		after is the cursor returned for the previous page, None for the first page,
+   		limit the page size (at least 1). where and args optionally filter the rows.
+   		order_by and the primary key are always loaded, even when only/defer leave them out. Return (list, next_cursor), where
+   		next_cursor is None on the last page.
+   		'''
+   		cols, deferred = cls._columns(only, defer, (order_by,))
+   		L = db.select(*cls._page_query(order_by, after, limit, desc, where, args, cols))
+   		L, next_cursor = cls._page_result(L, order_by, limit, deferred)
+   		prefetch and _prefetch(L, prefetch)
+   		return L, next_cursor
+
+	@classmethod
+	def _page_query(cls, order_by, after, limit, desc, where, args, cols='*'):
+   		if not order_by in cls.__mappings__:
+   			raise ValueError('Cannot order %s by unknown field: %s' % (cls.__name__, order_by))
+   		if not isinstance(limit, int) or limit < 1:
+   			raise ValueError('Page limit must be a positive integer: %r' % (limit,))
+   		pk = cls.__primary_key__.name
+   		L = []
+   		args = list(args)
+   		if where:
+   			L.append('(%s)' % where)
+   		if after is not None:
+   			value, key = _decode_cursor(after, order_by)
+   			op = desc and '<' or '>'
+   			L.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (order_by, op, order_by, pk, op))
+   			args.extend([value, value, key])
+   		direction = desc and 'desc' or 'asc'
+   		sql = 'select %s from `%s`%s order by `%s` %s, `%s` %s limit ?' % \
+   			(cols, cls.__table__, L and ' where %s' % ' and '.join(L) or '', order_by, direction, pk, direction)
+   		return [sql] + args + [limit + 1]
+
+	@classmethod
+	def _page_result(cls, rows, order_by, limit, deferred=()):
+   		next_cursor = None
+   		if len(rows) > limit:
+   			rows = rows[:limit]
+   			last = rows[-1]
+   			next_cursor = _encode_cursor(order_by, last[order_by], last[cls.__primary_key__.name])
+   		return cls._load(rows, deferred), next_cursor
 
 	@classmethod
 	def count_all(cls):
    		'''
    		Get count of rows in table.
    		'''
-   		return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+   		return db.select_int(cls.__count_sql__)
 
 	@classmethod
 	def count_by(cls, where, *args):
@@ -290,54 +856,396 @@ class Model(dict):
 	def update(self):
    		'''
    		Update class's property to database.
+   		An object loaded from database only writes the columns changed since it was
+   		loaded or last written, and nothing at all if none changed, in which case
+   		pre_update is not called either.
    		'''
-   		self.pre_update and self.pre_update()
-   		L = []
-   		args = []
-   		for k, v in self.__mappings__.iteritems():
-   			if v.updatable:
-   				if hasattr(self, k):
-   					arg = getattr(self, k)
-   				else:
-   					arg = v.default()
-   					setattr(self, k, arg)
-   				L.append('`%s`=?' % k)
-   				args.append(arg)
-   		pk = self.__primary_key__.name
-   		args.append(getattr(self, pk))
-   		db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+   		return self.save()
+
+	def save(self, force=False):
+   		'''
+   		Like update(), but with force=True write every updatable column whether it
+   		changed or not.
+   		'''
+   		query = self._update_query(force)
+   		if query is None:
+   			return self
+   		with _ModelWriteCtx():
+   			db.update(*query)
+   		self._after_update()
    		return self
 
 	def insert(self):
    		'''
    		Insert this object into database.
    		'''
-   		self.pre_insert and self.pre_insert()
-   		args = {}
-   		for k, v in self.__mappings__.iteritems():
-   			if v.insertable:
-   				# if hasattr(self, k):
-   				# 	arg = getattr(self, k)
-   				# else:
-   				# 	arg = v.default()
-   				# 	setattr(self, k, arg)
-   				if not hasattr(self, k):
-   					setattr(self, k, v.default)
-   				args[k] = getattr(self, k)
-   		db.insert(self.__table__, **args)
+   		with _ModelWriteCtx():
+   			db.update(self.__insert_sql__, *self._insert_values())
+   		self._after_insert()
    		return self
 
 	def delete(self):
    		'''
    		Delete row from database.
    		'''
+   		with _ModelWriteCtx():
+   			db.update(*self._delete_query())
+   		self._after_delete()
+   		return self
+
+	@classmethod
+	def insert_all(cls, objs, max_rows=None, max_bytes=None):
+   		'''
+   		Insert many objects with multi-row insert statements (see db.insert_many).
+   		Defaults and pre_insert are applied to every object first.
+   		Return the number of inserted rows.
+   		'''
+   		with _ModelWriteCtx():
+   			n = db.insert_many(cls.__table__, [obj._insert_args() for obj in objs], max_rows, max_bytes)
+   		for obj in objs:
+   			obj._after_insert()
+   		return n
+
+	@classmethod
+	def _get_query(cls, pk, cols='*'):
+   		if cols == '*':
+   			return (cls.__get_sql__, pk)
+   		return ('select %s from %s where %s=?' % (cols, cls.__table__, cls.__primary_key__.name), pk)
+
+	@classmethod
+	def _columns(cls, only=None, defer=None, required=()):
+   		'''
+   		Return (select list, deferred field names) for the column options of the finders:
+   		only: names of the fields to load, the primary key is always loaded.
+   		defer: names of the fields not to load, or True for all deferrable fields
+   			   (TextField and BlobField are deferrable by default).
+   		required: names of fields loaded whatever only and defer say, such as the
+   			   order_by column find_page() builds its cursor from.
+   		Deferred fields are loaded on first access, in coroutines by load_deferred_async(),
+   		see _DeferredGroup.
+   		'''
+   		if only is None and not defer:
+   			return '*', ()
+   		names = [k for k, v in sorted(cls.__mappings__.items(), key=lambda kv: kv[1]._order)]
+   		if defer is True:
+   			defer = [k for k in names if cls.__mappings__[k].deferrable]
+   		defer = set(defer or ())
+   		for name in defer.union(only or ()):
+   			if not name in cls.__mappings__:
+   				raise ValueError('%s has no field: %s' % (cls.__name__, name))
+   		pk = cls.__primary_key__.name
+   		selected = [k for k in names if k == pk or k in required or ((only is None or k in only) and not k in defer)]
+   		deferred = [k for k in names if not k in selected]
+   		return ','.join(['`%s`' % k for k in selected]), deferred
+
+	@classmethod
+	def _load(cls, rows, deferred=()):
+   		'''
+   		Make objects from rows, objects missing deferred fields share one _DeferredGroup.
+   		Inside identity_map() a row whose object is already mapped returns that object.
+   		'''
+   		identity = _identity.get()
+   		if identity is None:
+   			hydrate = cls._hydrate
+   			L = [hydrate(d) for d in rows]
+   			created = L
+   		else:
+   			pk = cls.__primary_key__.name
+   			L = []
+   			created = []
+   			for d in rows:
+   				obj = identity.get((cls, d[pk]))
+   				if obj is None:
+   					obj = cls._hydrate(d)
+   					identity[(cls, d[pk])] = obj
+   					created.append(obj)
+   				L.append(obj)
+   		if deferred and created:
+   			group = _DeferredGroup(cls, deferred, created)
+   			for obj in created:
+   				_set_deferred(obj, group)
+   		return L
+
+	@classmethod
+	def _hydrate(cls, d):
+   		'''
+   		Make one object from a db row: the values of a Row go straight into the new
+   		object with its shared column names, no intermediate dict is built, and its
+   		values tuple is kept as the original values.
+   		'''
+   		obj = dict.__new__(cls)
+   		if isinstance(d, Row.Row):
+   			dict.update(obj, zip(d._columns, d._values))
+   			_set_original(obj, d._values)
+   			_set_original_columns(obj, d._columns)
+   		else:
+   			dict.update(obj, d)
+   			obj._snapshot()
+   		_set_deferred(obj, None)
+   		return obj
+
+	@classmethod
+	def _load_one(cls, d, deferred=()):
+   		return cls._load([d], deferred)[0] if d else None
+
+	def _snapshot(self):
+   		' remember the current values as the original values. '
+   		_set_original(self, tuple(self.values()))
+   		_set_original_columns(self, Row.Columns(self))
+
+	def _set_loaded(self, key, value):
+   		' set a field loaded after the object, it is one of the original values too. '
+   		self[key] = value
+   		if self._original is not None:
+   			original = dict(zip(self._original_columns, self._original))
+   			original[key] = value
+   			_set_original(self, tuple(original.values()))
+   			_set_original_columns(self, Row.Columns(original))
+
+	def _is_deferred(self, key):
+   		group = self._deferred
+   		return group is not None and key in group.names and not key in self
+
+	def _update_query(self, force=False):
+   		'''
+   		Return the update SQL followed by its arguments, or None if there is nothing
+   		to write. Without force, an object that remembers its original values (see
+   		_hydrate) writes only the columns that differ from them. Deferred fields never
+   		loaded are never changed, so never written.
+   		pre_update runs only when an UPDATE is issued: after the check that something
+   		changed, so a pre_update setting a timestamp does not make an unchanged object
+   		dirty, and before the columns are collected, so what it sets is written too.
+   		'''
+   		if self.__update_sql__ is None:
+   			return None
+   		original = None if force else self._original
+   		if original is not None and not self._changed_fields(original):
+   			return None
+   		self.pre_update and self.pre_update()
+   		if original is None and self._deferred is None:
+   			fields = self.__update_fields__
+   			sql = self.__update_sql__
+   		else:
+   			fields = self._changed_fields(original)
+   			if not fields:
+   				return None
+   			sql = self._update_sql(tuple([k for k, default in fields]))
+   		args = [sql]
+   		for k, default in fields:
+   			if not k in self:
+   				self[k] = default()
+   			args.append(self[k])
+   		args.append(self[self.__primary_key__.name])
+   		return args
+
+	def _changed_fields(self, original):
+   		'''
+   		Return the (name, default callable) pairs of the updatable fields to write,
+   		original is the original values tuple, None for an object that has none.
+   		'''
+   		fields = []
+   		columns = self._original_columns
+   		for field in self.__update_fields__:
+   			k = field[0]
+   			if k in self:
+   				if original is not None and k in columns and original[columns[k]] == self[k]:
+   					continue
+   			elif original is not None or self._is_deferred(k):
+   				continue
+   			fields.append(field)
+   		return fields
+
+	@classmethod
+	def _update_sql(cls, names):
+   		' update SQL of the columns in names, cached per column set. '
+   		sql = cls.__update_sqls__.get(names)
+   		if sql is None:
+   			sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(['`%s`=?' % k for k in names]), cls.__primary_key__.name)
+   			cls.__update_sqls__[names] = sql
+   		return sql
+
+	def _insert_values(self):
+   		'''
+   		Run pre_insert, fill defaults and return the values of __insert_sql__.
+   		'''
+   		self.pre_insert and self.pre_insert()
+   		args = []
+   		for k, default in self.__insert_fields__:
+   			if not k in self:
+   				self[k] = default()
+   			args.append(self[k])
+   		return args
+
+	def _insert_args(self):
+   		' like _insert_values() but return a dict of column values for db.insert_many. '
+   		return dict(zip([k for k, default in self.__insert_fields__], self._insert_values()))
+
+	@classmethod
+	def _read_cache(cls, only=None, defer=None):
+   		''' the read cache only holds complete rows'''
+   		if only is None and not defer:
+   			return cls.__cache_store__
+   		return None
+
+	@classmethod
+	def cache_stats(cls):
+   		'''
+   		Return hit/miss/eviction counters of the class's read cache, None if it has none.
+   		'''
+   		return cls.__cache_store__.stats() if cls.__cache_store__ is not None else None
+
+	def _invalidate(self):
+   		' drop the cached row, when the transaction writing it commits '
+   		if self.__cache_store__ is not None:
+   			db.after_commit(functools.partial(self.__cache_store__.invalidate, self[self.__primary_key__.name]))
+
+	def _after_insert(self):
+   		self._snapshot()
+   		self._invalidate()
+   		_identity_put(self)
+
+	def _after_update(self):
+   		self._snapshot()
+   		self._invalidate()
+   		_identity_put(self)
+
+	def _after_delete(self):
+   		self._invalidate()
+   		_identity_pop(self)
+
+	def _delete_query(self):
    		self.pre_delete and self.pre_delete()
-   		pk = self.__primary_key__.name
-   		#args = (getattr(self, pk), )
-   		#db.update('delete from %s where %s=?' %(self.__table__, pk), *args)
-   		db.update('delete from %s where %s=?' % (self.__table__, pk), getattr(self, pk))
+   		return (self.__delete_sql__, self[self.__primary_key__.name])
+
+	# Awaitable versions of the methods above. They go through the *_async functions
+	# of db, so they run in the db executor with the blocking engine and natively on
+	# the event loop with an async engine.
+
+	@asyncio.coroutine
+	def load_deferred_async(self, *names):
+   		'''
+   		Load the deferred fields names, or all deferred fields if none is given, of this
+   		object and of the objects loaded with it. Return the object.
+   		'''
+   		group = self._deferred
+   		if group is not None:
+   			for name in names or sorted(group.names):
+   				if self._is_deferred(name):
+   					yield from group.load_async(name)
    		return self
 
+	@classmethod
+	@asyncio.coroutine
+	def get_async(cls, pk, only=None, defer=None):
+   		obj = _identity_get(cls, pk)
+   		if obj is not None:
+   			return obj
+   		cache = cls._read_cache(only, defer)
+   		if cache is not None:
+   			found, d = cache.get(pk)
+   			if found:
+   				return cls._load_one(d)
+   			generation = cache.generation
+   		cols, deferred = cls._columns(only, defer)
+   		batcher = _get_batcher(cls) if cols == '*' else None
+   		if batcher is not None:
+   			d = yield from batcher.load(pk)
+   		else:
+   			d = yield from db.select_one_async(*cls._get_query(pk, cols))
+   		if cache is not None and not db.in_transaction():
+   			cache.put(pk, d, generation)
+   		return cls._load_one(d, deferred)
+
+	@classmethod
+	@asyncio.coroutine
+	def find_first_async(cls, where, *args, only=None, defer=None, prefetch=None):
+   		cols, deferred = cls._columns(only, defer)
+   		d = yield from db.select_one_async('select %s from %s where %s' % (cols, cls.__table__, where), *args)
+   		obj = cls._load_one(d, deferred)
+   		if prefetch and obj is not None:
+   			yield from _prefetch_async([obj], prefetch)
+   		return obj
+
+	@classmethod
+	@asyncio.coroutine
+	def find_by_async(cls, where, *args, only=None, defer=None, prefetch=None):
+   		cols, deferred = cls._columns(only, defer)
+   		L = yield from db.select_async('select %s from %s where %s' % (cols, cls.__table__, where), *args)
+   		L = cls._load(L, deferred)
+   		if prefetch:
+   			yield from _prefetch_async(L, prefetch)
+   		return L
+
+	@classmethod
+	@asyncio.coroutine
+	def find_all_async(cls, *args, only=None, defer=None, prefetch=None):
+   		cols, deferred = cls._columns(only, defer)
+   		L = yield from db.select_async('select %s from %s' % (cols, cls.__table__))
+   		L = cls._load(L, deferred)
+   		if prefetch:
+   			yield from _prefetch_async(L, prefetch)
+   		return L
+
+	@classmethod
+	@asyncio.coroutine
+	def find_page_async(cls, order_by='created_at', after=None, limit=20, desc=True, where=None, args=(), only=None, defer=None, prefetch=None):
+   		cols, deferred = cls._columns(only, defer, (order_by,))
+   		L = yield from db.select_async(*cls._page_query(order_by, after, limit, desc, where, args, cols))
+   		L, next_cursor = cls._page_result(L, order_by, limit, deferred)
+   		if prefetch:
+   			yield from _prefetch_async(L, prefetch)
+   		return L, next_cursor
+
+	@classmethod
+	def count_all_async(cls):
+   		return db.select_int_async(cls.__count_sql__)
+
+	@classmethod
+	def count_by_async(cls, where, *args):
+   		return db.select_int_async('select count(`%s`) from `%s` where %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+
+	@classmethod
+	@asyncio.coroutine
+	def insert_all_async(cls, objs, max_rows=None, max_bytes=None):
+   		with _ModelWriteCtx():
+   			n = yield from db.insert_many_async(cls.__table__, [obj._insert_args() for obj in objs], max_rows, max_bytes)
+   		for obj in objs:
+   			obj._after_insert()
+   		return n
+
+	@asyncio.coroutine
+	def update_async(self):
+   		return (yield from self.save_async())
+
+	@asyncio.coroutine
+	def save_async(self, force=False):
+   		query = self._update_query(force)
+   		if query is None:
+   			return self
+   		with _ModelWriteCtx():
+   			yield from db.update_async(*query)
+   		self._after_update()
+   		return self
+
+	@asyncio.coroutine
+	def insert_async(self):
+   		with _ModelWriteCtx():
+   			yield from db.update_async(self.__insert_sql__, *self._insert_values())
+   		self._after_insert()
+   		return self
+
+	@asyncio.coroutine
+	def delete_async(self):
+   		with _ModelWriteCtx():
+   			yield from db.update_async(*self._delete_query())
+   		self._after_delete()
+   		return self
+
+# Model maps attribute assignment to its items, the slots are set through their descriptors:
+_set_original = Model._original.__set__
+_set_original_columns = Model._original_columns.__set__
+_set_deferred = Model._deferred.__set__
+
 if __name__ == '__main__' :
 	logging.basicConfig(level=logging.DEBUG)
 	db.create_engine('web-data', 'web-data', 'test')
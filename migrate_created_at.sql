@@ -0,0 +1,15 @@
+-- migrate_created_at.sql
+
+-- models.User, Blog and Comment used to map a `create_at` column while awesome.sql
+-- creates `created_at`. The models now map `created_at`, so a database created from
+-- awesome.sql needs nothing. Run this once on a database whose tables were generated
+-- from the old models (Model.__sql__()): it renames the column and adds the index
+-- that Model.find_page() seeks on.
+
+use awesome;
+
+alter table users change `create_at` `created_at` real not null, add key `idx_created_at` (`created_at`);
+
+alter table blogs change `create_at` `created_at` real not null, add key `idx_created_at` (`created_at`);
+
+alter table comments change `create_at` `created_at` real not null, add key `idx_created_at` (`created_at`);